@@ -0,0 +1,132 @@
+import asyncio
+import json
+import logging
+import random
+
+import aiohttp
+
+from ai_module.chatpdf_client import FALLBACK_MESSAGE, RETRY_STATUS_CODES, CircuitBreaker
+from metrics_module.histogram import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+def is_connect_error(error):
+    """Tell if a request failed before it reached ChatPDF, as chatpdf_client.is_connect_error."""
+
+    if isinstance(error, aiohttp.ClientConnectorError):
+        return True
+    # aiohttp 3.9 raises a connect timeout as a ServerTimeoutError, like a read timeout
+    return isinstance(error, aiohttp.ServerTimeoutError) and str(error).startswith('Connection timeout')
+
+class AsyncChatPDFClient:
+    """aiohttp counterpart of ChatPDFClient, with the same timeouts, retries and circuit breaker.
+    A question waiting for ChatPDF only holds a coroutine, so max_connections questions can be in flight
+    at once without a thread each."""
+
+    def __init__(self, api_key, source_id, base_url='https://api.chatpdf.com/v1',
+                 connect_timeout=3.05, read_timeout=30, max_retries=2, backoff=0.5,
+                 max_connections=1000, failure_threshold=5, reset_timeout=30, fallback_message=FALLBACK_MESSAGE):
+        self.api_key = api_key
+        self.source_id = source_id
+        self.url = f"{base_url.rstrip('/')}/chats/message"
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_connections = max_connections
+        self.fallback_message = fallback_message
+        self.session = None
+
+        self.circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        self.attempt_latency = LatencyHistogram()
+        self.ask_latency = LatencyHistogram()
+
+        # Only touched by the event loop thread
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.short_circuited = 0
+
+    async def open(self):
+        """Create the keep-alive session, must be called from the event loop that will use it."""
+
+        self.session = aiohttp.ClientSession(
+            headers={
+                'x-api-key': self.api_key,
+                "Content-Type": "application/json",
+            },
+            timeout=self.timeout,
+            connector=aiohttp.TCPConnector(limit=self.max_connections)
+        )
+
+    async def request_answer(self, user_message, context=None):
+        """Ask ChatPDF a question, return its answer or None if ChatPDF could not answer."""
+
+        self.requests += 1
+
+        if not self.circuit_breaker.allow_request():
+            self.short_circuited += 1
+            return None
+
+        with self.ask_latency.time():
+            answer = await self._post_with_retries((context or []) + [{'role': "user", 'content': user_message}])
+
+        if answer is None:
+            self.failures += 1
+        return answer
+
+    async def _post_with_retries(self, messages):
+        data = {
+            'sourceId': self.source_id,
+            'messages': messages,
+        }
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retries += 1
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+
+            try:
+                with self.attempt_latency.time():
+                    async with self.session.post(self.url, json=data) as response:
+                        status = response.status
+                        body = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("ChatPDF request failed: %s", e)
+                if is_connect_error(e):
+                    continue
+                break
+
+            if status == 200:
+                # A body without an answer is a failure of ChatPDF, the user gets the fallback message
+                try:
+                    answer = json.loads(body)['content']
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning("ChatPDF returned an invalid body: %r (%s)", body[:200], e)
+                    self.circuit_breaker.record_failure()
+                    return None
+                self.circuit_breaker.record_success()
+                return answer
+
+            logger.warning("ChatPDF returned %s: %s", status, body[:200])
+            if status not in RETRY_STATUS_CODES:
+                self.circuit_breaker.record_success()
+                return None
+
+        self.circuit_breaker.record_failure()
+        return None
+
+    def get_stats(self):
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'failures': self.failures,
+            'short_circuited': self.short_circuited,
+            'circuit_state': self.circuit_breaker.state,
+            'attempt_latency': self.attempt_latency.get_stats(),
+            'ask_latency': self.ask_latency.get_stats(),
+        }
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
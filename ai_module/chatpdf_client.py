@@ -0,0 +1,195 @@
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from metrics_module.histogram import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+FALLBACK_MESSAGE = "Sorry, it seems that there is something wrong with the AI right now. Please ask AI later, thank you."
+
+# Status codes worth retrying, every other error status fails right away
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def is_connect_error(error):
+    """Tell if a request failed before it reached ChatPDF, so retrying the POST cannot ask the question twice.
+    A read timeout or a dropped connection may come after ChatPDF got the question, it is not retried."""
+
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+class CircuitBreaker:
+    """Stop calling an upstream that keeps failing.
+    After failure_threshold failures in a row the circuit opens and calls fail fast. Once reset_timeout seconds
+    have passed a single trial call is let through (half-open): it closes the circuit on success
+    and opens it again on failure. A trial that reports neither within reset_timeout counts as failed,
+    so the circuit can never stay half-open."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.half_opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN and now - self.half_opened_at >= self.reset_timeout:
+                # The trial call never reported back, open the circuit again
+                self.state = self.OPEN
+                self.opened_at = now
+
+            if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+                # Let one trial call through
+                self.state = self.HALF_OPEN
+                self.half_opened_at = now
+                return True
+
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+class ChatPDFClient:
+    """Long-lived ChatPDF API client.
+    Keeps a pooled keep-alive session, applies connect/read timeouts, retries 429/5xx and the failures to connect
+    with jittered exponential backoff, and fails fast while the circuit is open."""
+
+    def __init__(self, api_key, source_id, base_url='https://api.chatpdf.com/v1',
+                 connect_timeout=3.05, read_timeout=30, max_retries=2, backoff=0.5,
+                 pool_size=10, failure_threshold=5, reset_timeout=30, fallback_message=FALLBACK_MESSAGE):
+        self.source_id = source_id
+        self.url = f"{base_url.rstrip('/')}/chats/message"
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.fallback_message = fallback_message
+
+        # One session for the life of the app, its connections are kept alive and reused
+        self.session = requests.Session()
+        self.session.headers.update({
+            'x-api-key': api_key,
+            "Content-Type": "application/json",
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        # Latency of every HTTP attempt, and of the whole request_answer() call including retries
+        self.attempt_latency = LatencyHistogram()
+        self.ask_latency = LatencyHistogram()
+
+        self.stats_lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.short_circuited = 0
+
+    def request_answer(self, user_message, context=None):
+        """Ask ChatPDF a question, return its answer or None if ChatPDF could not answer.
+        context is the list of earlier messages ({'role', 'content'}) of the conversation."""
+
+        with self.stats_lock:
+            self.requests += 1
+
+        if not self.circuit_breaker.allow_request():
+            with self.stats_lock:
+                self.short_circuited += 1
+            return None
+
+        with self.ask_latency.time():
+            answer = self._post_with_retries((context or []) + [{'role': "user", 'content': user_message}])
+
+        if answer is None:
+            with self.stats_lock:
+                self.failures += 1
+        return answer
+
+    def _post_with_retries(self, messages):
+        """Return the answer, or None once the retries are used up or the error is not worth retrying."""
+
+        data = {
+            'sourceId': self.source_id,
+            'messages': messages,
+        }
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                with self.stats_lock:
+                    self.retries += 1
+                # Full jitter, so the retries of a burst do not hit the upstream at the same moment
+                time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+
+            try:
+                with self.attempt_latency.time():
+                    response = self.session.post(self.url, json=data, timeout=self.timeout)
+            except requests.RequestException as e:
+                logger.warning("ChatPDF request failed: %s", e)
+                if is_connect_error(e):
+                    continue
+                break
+
+            if response.status_code == 200:
+                # A body without an answer is a failure of ChatPDF, the user gets the fallback message
+                try:
+                    answer = response.json()['content']
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning("ChatPDF returned an invalid body: %r (%s)", response.text[:200], e)
+                    self.circuit_breaker.record_failure()
+                    return None
+                self.circuit_breaker.record_success()
+                return answer
+
+            logger.warning("ChatPDF returned %s: %s", response.status_code, response.text[:200])
+            if response.status_code not in RETRY_STATUS_CODES:
+                # A client error will not get better by retrying, but it does mean ChatPDF is up
+                self.circuit_breaker.record_success()
+                return None
+
+        self.circuit_breaker.record_failure()
+        return None
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = {
+                'requests': self.requests,
+                'retries': self.retries,
+                'failures': self.failures,
+                'short_circuited': self.short_circuited,
+            }
+        stats['circuit_state'] = self.circuit_breaker.state
+        stats['attempt_latency'] = self.attempt_latency.get_stats()
+        stats['ask_latency'] = self.ask_latency.get_stats()
+        return stats
+
+    def close(self):
+        self.session.close()
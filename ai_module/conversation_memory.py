@@ -0,0 +1,179 @@
+import functools
+import logging
+import threading
+from collections import deque
+
+import tiktoken
+
+from cache_module.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Load the tokenizer of a model once, loading it is much slower than encoding with it."""
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+class ConversationMemory:
+    """Per-user conversation history, so follow-up questions are answered in context.
+
+    A history is a ring buffer of the last max_messages messages ({'role', 'content', 'tokens'}), each message
+    keeping its token count so it is only encoded once. The messages sent to the AI are the newest ones that fit
+    in max_tokens together with the new question.
+    The history is persisted by the store (an object with load_conversation/save_conversation, e.g. the
+    PostgreSQLHandler keeping it next to the users row), or only kept in memory when there is no store.
+
+    With batch_writes the histories are not saved by add_exchange: they wait in pending, and run() saves all of
+    them every flush_interval seconds with one save_conversations() call, so an AI message costs no DB write of
+    its own. latest_history() returns a history still waiting to be saved instead of the stored one. A follow-up
+    handled by another worker within flush_interval misses the last exchange."""
+
+    def __init__(self, max_messages=6, max_tokens=1000, model='gpt-3.5-turbo', store=None, max_users=10000, ttl=3600,
+                 batch_writes=False, flush_interval=0.5):
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.model = model
+        self.store = store
+        self.batch_writes = batch_writes
+        self.flush_interval = flush_interval
+
+        # Only used without a store
+        self.local_histories = TTLCache(max_size=max_users, ttl=ttl)
+
+        # user_id -> history waiting to be saved, and the ones being saved, guarded by pending_lock
+        self.pending_lock = threading.Lock()
+        self.pending = {}
+        self.flushing = {}
+        self.flushes = 0
+        self.flush_failures = 0
+
+        # Size of the prompts sent, guarded by stats_lock
+        self.stats_lock = threading.Lock()
+        self.prompts = 0
+        self.prompt_tokens = 0
+        self.max_prompt_tokens = 0
+
+    def count_tokens(self, text):
+        return len(get_encoding(self.model).encode(text))
+
+    def get_history(self, user_id):
+        history = self.latest_history(user_id, None)
+        if history is not None:
+            return history
+        if self.store is not None:
+            return self.store.load_conversation(user_id) or []
+        return self.local_histories.get(user_id, [])
+
+    def build_context(self, history, user_message):
+        """Return the history messages ({'role', 'content'}) to send before the new question:
+        the newest ones that fit in the token budget together with the question, which is always sent."""
+
+        prompt_tokens = self.count_tokens(user_message)
+        context = []
+        for message in reversed(history):
+            if prompt_tokens + message['tokens'] > self.max_tokens:
+                break
+            prompt_tokens += message['tokens']
+            context.insert(0, message)
+
+        # Start the context with a question, not with the answer to a dropped one
+        if context and context[0]['role'] == 'assistant':
+            prompt_tokens -= context.pop(0)['tokens']
+
+        with self.stats_lock:
+            self.prompts += 1
+            self.prompt_tokens += prompt_tokens
+            self.max_prompt_tokens = max(self.max_prompt_tokens, prompt_tokens)
+        return [{'role': message['role'], 'content': message['content']} for message in context]
+
+    def append_exchange(self, history, user_message, answer):
+        """Return a new history with a question and its answer appended and the oldest messages dropped."""
+
+        ring = deque(history, maxlen=self.max_messages)
+        ring.append({'role': 'user', 'content': user_message, 'tokens': self.count_tokens(user_message)})
+        ring.append({'role': 'assistant', 'content': answer, 'tokens': self.count_tokens(answer)})
+        return list(ring)
+
+    def add_exchange(self, user_id, history, user_message, answer):
+        """Append a question and its answer to the history and save it (or queue it, with batch_writes)."""
+
+        history = self.append_exchange(history, user_message, answer)
+        if self.batch_writes:
+            with self.pending_lock:
+                self.pending[user_id] = history
+        elif self.store is not None:
+            self.store.save_conversation(user_id, history)
+        else:
+            self.local_histories.put(user_id, history)
+        return history
+
+    def latest_history(self, user_id, stored_history):
+        """Return the user's history waiting to be saved, or else stored_history (e.g. the one of the users row)."""
+
+        with self.pending_lock:
+            history = self.pending.get(user_id)
+            if history is None:
+                history = self.flushing.get(user_id)
+        return history if history is not None else stored_history
+
+    def take_pending(self):
+        """Return the histories waiting to be saved, they stay readable by latest_history() until flushed()."""
+
+        with self.pending_lock:
+            self.flushing, self.pending = self.pending, {}
+            return dict(self.flushing)
+
+    def flushed(self, histories, saved=True):
+        """Mark the histories returned by take_pending() as saved, or queue them again if saving failed."""
+
+        with self.pending_lock:
+            self.flushing = {}
+            if saved:
+                self.flushes += 1
+            else:
+                self.flush_failures += 1
+                # A newer history of the same user replaces the failed one
+                for user_id, history in histories.items():
+                    self.pending.setdefault(user_id, history)
+
+    def flush(self):
+        """Save the pending histories with the store in one call."""
+
+        histories = self.take_pending()
+        if not histories:
+            self.flushed(histories)
+            return
+        try:
+            self.store.save_conversations(histories)
+        except Exception:
+            self.flushed(histories, saved=False)
+            raise
+        self.flushed(histories)
+
+    def run(self, exit_event):
+        """Save the pending histories every flush_interval seconds until exit_event is set, and once more on exit."""
+
+        while not exit_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Could not save the conversation histories")
+        self.flush()
+
+    def get_stats(self):
+        with self.stats_lock:
+            return {
+                'max_messages': self.max_messages,
+                'max_tokens': self.max_tokens,
+                'users_in_memory': len(self.local_histories),
+                'pending_writes': len(self.pending),
+                'flushes': self.flushes,
+                'flush_failures': self.flush_failures,
+                'prompts': self.prompts,
+                'avg_prompt_tokens': self.prompt_tokens / self.prompts if self.prompts else 0.0,
+                'max_prompt_tokens': self.max_prompt_tokens,
+            }
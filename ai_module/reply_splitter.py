@@ -0,0 +1,46 @@
+import re
+
+# LINE accepts up to 5 messages per reply, of up to 5000 characters each
+MAX_REPLY_MESSAGES = 5
+MAX_MESSAGE_LENGTH = 5000
+
+# A sentence ends at English punctuation followed by whitespace (so "3.5" or "www.x.com" are not cut),
+# right after Chinese punctuation, or at a line break. The whitespace is captured to be kept between sentences
+SENTENCE_END = re.compile(r'((?<=[.!?])\s+|(?<=[。！？])\s*|\s*\n\s*)')
+
+def split_sentences(text):
+    """Return the (sentence, whitespace following it) pairs of a text."""
+
+    parts = SENTENCE_END.split(text) + ['']
+    return [(parts[i], parts[i + 1]) for i in range(0, len(parts) - 1, 2) if parts[i] or parts[i + 1]]
+
+def split_reply(text, max_messages=MAX_REPLY_MESSAGES, max_length=MAX_MESSAGE_LENGTH):
+    """Split a long answer at sentence boundaries into at most max_messages messages of max_length characters.
+    Sentences are packed greedily with the whitespace (line breaks included) that separated them, a sentence
+    longer than max_length is cut, and what does not fit is dropped. A blank answer gives no message at all,
+    LINE rejects an empty text message."""
+
+    if not text.strip():
+        return []
+
+    messages = []
+    current = ''
+    separator = ''
+    for sentence, whitespace in split_sentences(text):
+        # Cut the sentences that do not fit in one message on their own
+        pieces = [sentence[i:i + max_length] for i in range(0, len(sentence), max_length)]
+        for piece in pieces:
+            if not current or len(current) + len(separator) + len(piece) <= max_length:
+                current += (separator if current else '') + piece
+            else:
+                # The whitespace at a message boundary is dropped
+                messages.append(current)
+                if len(messages) == max_messages:
+                    return messages
+                current = piece
+            separator = ''
+        separator += whitespace
+
+    if current:
+        messages.append(current)
+    return messages[:max_messages]
@@ -1,21 +1,36 @@
 # Standard Library Imports
 import os
-import json
 import threading
-import time
-from datetime import datetime, timedelta
 import logging
 
 # Third-Party Imports
-from flask import Flask, request
+from flask import Flask, request, abort, jsonify, g, Response
 from linebot import LineBotApi
 from linebot.v3.webhook import WebhookHandler
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+from linebot.v3.exceptions import InvalidSignatureError
 from linebot.models import TextSendMessage
-import schedule
-import requests
 
 # Local Imports
 from db_module.db_operations import PostgreSQLHandler
+from db_module.migrations import run_migrations
+from db_module.sqlite_store import SQLiteUserStore
+from db_module.json_user_store import ShardedUserStore
+from db_module.user_cache import UserStateCache
+from worker_module.reply_worker import ReplyWorkerPool
+from worker_module.idle_scheduler import IdleExpiryScheduler
+from worker_module.job_scheduler import JobScheduler
+from worker_module.push_sender import PushSender
+from worker_module.outbound_queue import OutboundQueue
+from worker_module.rate_limiter import RateLimiter, parse_tiers
+from worker_module.admission_control import AdmissionController, Overloaded
+from ai_module.chatpdf_client import ChatPDFClient
+from ai_module.conversation_memory import ConversationMemory
+from cache_module.answer_cache import AnswerCache, normalize_question
+from cache_module.semantic_cache import SemanticCache, SentenceTransformerEmbedder
+from cache_module.single_flight import SingleFlight
+from cache_module.profile_cache import ProfileCache
+from metrics_module.prometheus import MetricsRegistry, CONTENT_TYPE, timed
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -23,8 +38,40 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-# Initialize LineBot API
+# Initialize the metrics exposed on /metrics, the hot-path latencies go in histograms from 50 microseconds
+metrics = MetricsRegistry()
+FAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Initialize LineBot API, timing the calls made on every message
 line_bot_api= LineBotApi(os.environ['CHANNEL_ACCESS_TOKEN'])
+line_bot_api.get_profile = timed(
+    metrics.histogram('line_get_profile_seconds', "Latency of the LINE get_profile calls."),
+    line_bot_api.get_profile
+)
+line_bot_api.reply_message = timed(
+    metrics.histogram('line_reply_message_seconds', "Latency of the LINE reply_message calls."),
+    line_bot_api.reply_message
+)
+
+# Initialize Webhook Handler, it only needs to be created once
+handler = WebhookHandler(os.environ['CHANNEL_SECRET'])
+handler.parser.signature_validator.validate = timed(
+    metrics.histogram('signature_verification_seconds', "Latency of the webhook signature verification.", buckets=FAST_BUCKETS),
+    handler.parser.signature_validator.validate
+)
+
+# Counters of the AI-mode and quota decisions
+quota_rejections = metrics.counter('quota_rejections_total', "AI questions rejected because the daily quota is used up.")
+aimode_entries = metrics.counter('aimode_entries_total', "'hi ai' greetings that entered (or restarted) AI mode.")
+aimode_quota_exits = metrics.counter('aimode_exits_total', "Users taken out of AI mode.", reason='quota')
+aimode_idle_exits = metrics.counter('aimode_exits_total', "Users taken out of AI mode.", reason='idle')
+ask_chatpdf_latency = metrics.histogram('ask_chatpdf_seconds', "Latency of askChatPDF, the answer caches included.")
+
+# Initialize the background reply workers, the webhook only queues the events for them
+reply_workers = ReplyWorkerPool(
+    num_workers=int(os.environ.get('REPLY_WORKERS', 4)),
+    max_queue_size=int(os.environ.get('REPLY_QUEUE_SIZE', 1000))
+)
 
 # Initialize the PostgreSQLHandler
 # db_handler = PostgreSQLHandler(
@@ -35,255 +82,454 @@ line_bot_api= LineBotApi(os.environ['CHANNEL_ACCESS_TOKEN'])
 #     port='YOUR_DB_SERVER_PORT' # Default PostgreSQL port
 # )
 DATABASE_URL = os.environ['DATABASE_URL']
-db_handler = PostgreSQLHandler(DATABASE_URL)
+
+# The daily quotas start again at midnight of this time zone (e.g. 'Asia/Taipei'), the server's one if unset
+QUOTA_TIMEZONE = os.environ.get('QUOTA_TIMEZONE')
+
+db_handler = PostgreSQLHandler(
+    DATABASE_URL,
+    min_connections=int(os.environ.get('DB_POOL_MIN', 1)),
+    max_connections=int(os.environ.get('DB_POOL_MAX', 10)),
+    prepare_statements=os.environ.get('DB_PREPARE_STATEMENTS', '1') == '1',
+    quota_timezone_name=QUOTA_TIMEZONE,
+    metrics=metrics
+)
+
+# Initialize the store of the users' state: 'postgres' (default), 'sqlite' or 'json'
+# The embedded engines suit small deployments and tests, the outbox and the shared answer cache stay on Postgres
+USER_STORE = os.environ.get('USER_STORE', 'postgres')
+if USER_STORE == 'sqlite':
+    user_store = SQLiteUserStore(os.environ.get('SQLITE_PATH', 'users.db'), quota_timezone_name=QUOTA_TIMEZONE)
+elif USER_STORE == 'json':
+    user_store = ShardedUserStore(os.environ.get('JSON_STORE_PATH', 'userInfo.json'), quota_timezone_name=QUOTA_TIMEZONE)
+else:
+    user_store = db_handler
+
+# Initialize the ChatPDF client, its keep-alive connections are reused by every question
+chatpdf_client = ChatPDFClient(
+    api_key=os.environ['CHATPDF_API_KEY'],
+    source_id=os.environ['CHATPDF_FILE_SOURCE'],
+    base_url=os.environ.get('CHATPDF_BASE_URL', 'https://api.chatpdf.com/v1'),
+    connect_timeout=float(os.environ.get('CHATPDF_CONNECT_TIMEOUT', 3.05)),
+    read_timeout=float(os.environ.get('CHATPDF_READ_TIMEOUT', 30)),
+    max_retries=int(os.environ.get('CHATPDF_MAX_RETRIES', 2)),
+    pool_size=int(os.environ.get('REPLY_WORKERS', 4))
+)
+
+# Initialize the users' conversation memory, kept in the users table and trimmed to a token budget
+# ChatPDF reads at most 6 messages per question
+conversation_memory = ConversationMemory(
+    max_messages=int(os.environ.get('CONVERSATION_MAX_MESSAGES', 6)),
+    max_tokens=int(os.environ.get('CONVERSATION_MAX_TOKENS', 1000)),
+    store=user_store,
+    batch_writes=True,
+    flush_interval=float(os.environ.get('CONVERSATION_FLUSH_INTERVAL', 0.5))
+)
+
+# Initialize the cache of ChatPDF answers, optionally shared by all workers through the DB
+answer_cache = AnswerCache(
+    source_id=os.environ['CHATPDF_FILE_SOURCE'],
+    max_size=int(os.environ.get('ANSWER_CACHE_SIZE', 1000)),
+    ttl=float(os.environ.get('ANSWER_CACHE_TTL', 86400)),
+    shared_store=db_handler if os.environ.get('ANSWER_CACHE_SHARED') == '1' else None
+)
+
+# Initialize the optional semantic cache, which also answers near-duplicate questions
+# It embeds questions with the sentence-transformers model saved in the SEMANTIC_CACHE_MODEL directory,
+# the threshold is calibrated for that model on labeled question pairs unless SEMANTIC_CACHE_THRESHOLD is set
+semantic_cache = None
+if os.environ.get('SEMANTIC_CACHE_MODEL'):
+    semantic_cache = SemanticCache(
+        embed=SentenceTransformerEmbedder(os.environ['SEMANTIC_CACHE_MODEL']),
+        capacity=int(os.environ.get('SEMANTIC_CACHE_SIZE', 1000)),
+        threshold=float(os.environ['SEMANTIC_CACHE_THRESHOLD']) if os.environ.get('SEMANTIC_CACHE_THRESHOLD') else None,
+        ttl=float(os.environ.get('ANSWER_CACHE_TTL', 86400))
+    )
+
+# Identical questions asked at the same time share one ChatPDF request
+chatpdf_single_flight = SingleFlight()
+
+# Initialize the cache of the users' profile names, so get_profile is not called for every message
+profile_cache = ProfileCache(
+    line_bot_api.get_profile,
+    max_size=int(os.environ.get('PROFILE_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('PROFILE_CACHE_TTL', 600))
+)
+
+# Initialize the sender of the push notifications to many users (e.g. the idle users)
+push_sender = PushSender(
+    line_bot_api,
+    max_concurrency=int(os.environ.get('PUSH_CONCURRENCY', 4)),
+    max_requests_per_second=float(os.environ.get('PUSH_RATE_LIMIT', 10))
+)
+
+# Initialize the outbound queue, the messages LINE does not accept are kept in the outbox table and retried
+outbound_queue = OutboundQueue(
+    line_bot_api,
+    db_handler,
+    max_attempts=int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8)),
+    poll_interval=float(os.environ.get('OUTBOX_POLL_INTERVAL', 1))
+)
+
+# Initialize the rate limits of the AI questions: a token bucket per user by tier ('name:rate:burst', rate in
+# questions per second), and one over every user. RATE_LIMIT_SHARED=1 shares the buckets of the workers in Postgres
+rate_limiter = RateLimiter(
+    parse_tiers(os.environ.get('RATE_LIMIT_TIERS', 'default:0.2:5,vip:1:20')),
+    global_rate=float(os.environ.get('RATE_LIMIT_GLOBAL_RATE', 20)),
+    global_burst=float(os.environ.get('RATE_LIMIT_GLOBAL_BURST', 40)),
+    shared_store=db_handler if os.environ.get('RATE_LIMIT_SHARED') == '1' else None,
+    sync_interval=float(os.environ.get('RATE_LIMIT_SYNC_INTERVAL', 1))
+)
+for vip_user_id in filter(None, os.environ.get('RATE_LIMIT_VIP_USERS', '').split(',')):
+    rate_limiter.set_tier(vip_user_id.strip(), 'vip')
+
+# Initialize the admission control of the ChatPDF calls: at most UPSTREAM_MAX_CONCURRENCY at once, the others
+# queue by tier (vip first) and get a "busy" reply instead of waiting more than ADMISSION_QUEUE_TIMEOUT seconds
+admission_controller = AdmissionController(
+    max_concurrency=int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', 8)),
+    queue_timeout=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10)),
+    max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', 100))
+)
+
+BUSY_MESSAGE = "目前詢問AI客服的人數較多，請稍後再試一次，謝謝！"
+
+# Initialize the write-through cache of the users rows
+user_cache = UserStateCache(
+    user_store,
+    max_size=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 30))
+)
+
+# The metrics the components already keep, read when /metrics is scraped
+metrics.register_histogram('chatpdf_request_seconds', "Latency of the ChatPDF requests, retries included.", chatpdf_client.ask_latency)
+metrics.register_histogram('admission_queue_wait_seconds', "Time the ChatPDF calls waited for a slot.", admission_controller.queue_wait)
+metrics.register_callback('reply_queue_depth', 'gauge', "Messages waiting for a reply worker.",
+                          lambda: sum(job_queue.qsize() for job_queue in reply_workers.job_queues))
+metrics.register_callback('admission_queue_depth', 'gauge', "ChatPDF calls waiting for a slot.", lambda: admission_controller.queued)
+metrics.register_callback('admission_shed_total', 'counter', "ChatPDF calls shed by the admission control.",
+                          lambda: admission_controller.shed + admission_controller.timed_out)
+metrics.register_callback('rate_limited_total', 'counter', "AI questions rejected by the rate limits.",
+                          lambda: rate_limiter.rejected_user + rate_limiter.rejected_global)
+metrics.register_callback('db_pool_in_use', 'gauge', "DB connections in use.", lambda: db_handler.in_use)
+metrics.register_callback('errors_total', 'counter', "Errors, by component.", lambda: reply_workers.failed, component='reply_worker')
+metrics.register_callback('errors_total', 'counter', "Errors, by component.", lambda: chatpdf_client.failures, component='chatpdf')
+metrics.register_callback('errors_total', 'counter', "Errors, by component.", lambda: outbound_queue.failed_attempts, component='line_send')
 
 @app.route("/", methods=['POST'])
 def linebot():
-    """This function would be ran upon there is POST request from webhook."""
+    """This function would be ran upon there is POST request from webhook.
+    It only verifies the signature and dispatches the events, the replies are sent by the background reply workers."""
 
     # Get the request body as text
     body = request.get_data(as_text=True)
 
-    # Parse the body asJSON
-    json_data = json.loads(body)
+    # Get signature from request headers
+    signature = request.headers.get('X-Line-Signature', '')
 
-    try:
-        # Inintialize Webhook Handler
-        handler = WebhookHandler(os.environ['CHANNEL_SECRET'])
-        
-        # Get signature from request headers
-        signature = request.headers['X-Line-Signature']
+    # Count how many events of this batch were queued or rejected by the reply workers
+    g.queued_events = 0
+    g.rejected_events = 0
 
-        # Handle the webhook events
+    # Verify the signature and dispatch every event of the batch to its handler
+    try:
         handler.handle(body, signature)
+    except InvalidSignatureError:
+        abort(400)
+
+    # Only ask LINE to redeliver when nothing was queued, otherwise the queued events would be answered twice
+    if g.rejected_events and not g.queued_events:
+        return 'Busy', 503
 
-        # Extract reply token and user's message from the JSON data
-        user_id = json_data['events'][0]['source']['userId']
-        reply_token = json_data['events'][0]['replyToken']
-        user_message = json_data['events'][0]['message']['text']
-        # Use user_id to get the profile of the user
-        profile = line_bot_api.get_profile(user_id)
-        user_name = profile.display_name
-
-        # Check if the message starts with 'hi ai:, if it does, enter AI mode.
-        if user_message[:5].lower() == 'hi ai' or checkUserModeStatus(user_id):
-
-            # Check if the user have enough quota to ask question
-            if checkUserMsgQuota(user_id, user_name):
-
-                # Enter AI mode if the message starts with 'hi ai'.(Assuming that the user use 'hi ai' to enter AI mode)
-                if user_message[:5].lower() == 'hi ai':
-                    enterAImode(user_id)
-
-                # Record last msg time
-                updateLastAImsgTime(user_id)
-
-                # Redirect the question to chatPDF
-                reply_msg = askChatPDF(user_message)
-
-            # The user does not have enough quota to ask question
-            else:
-                reply_msg = "很抱歉，由於您已達到每日詢問AI客服的次數上限:50次/日，AI客服將先行告退。您可以等待明日繼續詢問或是聯絡CRESTDiving客服專線，謝謝！"
-                exitAImode(user_id)
-                
-        # If not a special command, echo the user's message
-        # Use tradtional linebot mode
-        else:
-            reply_msg = user_message
-        
-        # Send the reply message back to the user
-        text_message = TextSendMessage(text=reply_msg)
-        line_bot_api.reply_message(reply_token,text_message)
-
-    except Exception as e:
-        # Print any exceptions for debugging purposes
-        print(e)
     return 'OK'
 
-def checkUserMsgQuota(user_id, user_name):
-    """First check if user has change his/her profile name (display name), if he/she has, modify it in userInfo.json.
-    Then, check if the userId exists and has enough quota of messages to ask question.
-    If the user has enough quota, return true to enable asking chatPDF question.
-    If the user has no quota, return false to reject the user from asking.
-    If the user is a new user to this LineBot, add his/her  userId to the userInfo.json, and return ture to enable asking question."""
+@handler.add(MessageEvent, message=TextMessageContent)
+def handleTextMessage(event):
+    """Queue a text message for the reply worker that owns this user, so each user's messages stay in order."""
 
-    selected_data = db_handler.select_data('users', condition=f"userid = '{user_id}'")
+    user_id = getattr(event.source, 'user_id', None)
+    if user_id is None:
+        logger.info("Ignoring a text message without userId from %s", event.source.type)
+        return
 
-    if selected_data != []:
-        userName = selected_data[0][1]
-        userQuota = selected_data[0][3]
+    queueEvent(user_id, replyToMessage, user_id, event.reply_token, event.message.text)
 
-        if userName != user_name:
-            modifyUserName(user_id, user_name)
+@handler.default()
+def handleOtherEvent(event):
+    """Events other than text messages (stickers, images, follow, unfollow...) do not need a reply."""
 
-        if userQuota == 0:
-            return False
+    logger.debug("Ignoring %s event", event.type)
+
+def queueEvent(user_id, func, *args):
+    """Submit a job to the reply workers and count the result for the current webhook request."""
+
+    if reply_workers.submit(user_id, func, *args):
+        g.queued_events += 1
+    else:
+        logger.warning("Reply queue is full, dropping the event of %s", user_id)
+        g.rejected_events += 1
+
+@app.route("/metrics", methods=['GET'])
+def prometheusMetrics():
+    """Expose the latency histograms and counters in the Prometheus text format."""
+
+    return Response(metrics.render(), mimetype=CONTENT_TYPE)
+
+@app.route("/stats", methods=['GET'])
+def stats():
+    """Expose the queue depth and wait-time metrics of the reply workers and the DB connection pool."""
+
+    return jsonify({
+        'reply_workers': reply_workers.get_stats(),
+        'db_pool': db_handler.get_stats(),
+        'user_cache': user_cache.get_stats(),
+        'idle_scheduler': idle_scheduler.get_stats(),
+        'job_scheduler': job_scheduler.get_stats(),
+        'chatpdf': chatpdf_client.get_stats(),
+        'answer_cache': answer_cache.get_stats(),
+        'semantic_cache': semantic_cache.get_stats() if semantic_cache is not None else None,
+        'chatpdf_single_flight': chatpdf_single_flight.get_stats(),
+        'profile_cache': profile_cache.get_stats(),
+        'conversation_memory': conversation_memory.get_stats(),
+        'push_sender': push_sender.get_stats(),
+        'outbound_queue': outbound_queue.get_stats(),
+        'rate_limiter': rate_limiter.get_stats(),
+        'admission_controller': admission_controller.get_stats(),
+    })
+
+def replyToMessage(user_id, reply_token, user_message):
+    """Ran by the reply workers, do the quota/AI-mode logic and send the reply back to the user."""
+
+    # Check if the message starts with 'hi ai:, if it does, enter AI mode.(Assuming that the user use 'hi ai' to enter AI mode)
+    # Users cached in AI mode skip the DB read, the others are checked in the DB before their message is echoed.
+    is_ai_greeting = user_message[:5].lower() == 'hi ai'
+    answer = None
+    if is_ai_greeting or checkUserModeStatus(user_id):
+
+        # The user is in AI mode (or enters it), so this is an AI question and counts in the rate limits
+        # Too many questions, from this user or from everyone: answer right away without using a quota
+        if not rate_limiter.allow(user_id):
+            outbound_queue.reply(user_id, reply_token, ["您的提問速度太快了，請稍候幾秒再詢問AI客服，謝謝！"])
+            return
+
+        # The ChatPDF calls of the user are admitted at the priority of its tier
+        priority = admission_controller.priority_of(rate_limiter.tier_of(user_id))
+
+        # Use user_id to get the profile name of the user, it is only needed to keep the DB up to date
+        user_name = profile_cache.get_display_name(user_id)
+
+        # Check if the user have enough quota to ask question, this also enters AI mode and records last msg time
+        user_state = checkUserMsgQuota(user_id, user_name, is_ai_greeting)
+        if user_state['consumed']:
+
+            # (Re)schedule the idle expiry of the user
+            idle_scheduler.touch(user_id, user_state['lastaimsgtime'])
+
+            # Redirect the question to chatPDF, with the recent conversation as context
+            # A 'hi ai' greeting starts a new conversation
+            # The last exchange may still be waiting to be saved with the next batch
+            history = [] if is_ai_greeting else conversation_memory.latest_history(user_id, user_state['history'])
+            if is_ai_greeting:
+                aimode_entries.inc()
+            # Only a question that has to wait for ChatPDF can be shed, the cached answers are always given
+            # ChatPDF is saturated and the question would wait too long: answer busy and give the quota back
+            try:
+                with ask_chatpdf_latency.time():
+                    answer = askChatPDF(user_message, conversation_memory.build_context(history, user_message), priority)
+                reply_msg = answer if answer is not None else chatpdf_client.fallback_message
+            except Overloaded:
+                refundUserMsgQuota(user_id)
+                reply_msg = BUSY_MESSAGE
+
+        # The user does not have enough quota to ask question, the user has been taken out of AI mode
+        elif user_state['requested_ai']:
+            quota_rejections.inc()
+            if not is_ai_greeting:
+                aimode_quota_exits.inc()
+            reply_msg = "很抱歉，由於您已達到每日詢問AI客服的次數上限:50次/日，AI客服將先行告退。您可以等待明日繼續詢問或是聯絡CRESTDiving客服專線，謝謝！"
+
+        # The user is not in AI mode after all (the cached row was stale), echo the user's message
+        # An echo does not count in the rate limits
         else:
-            userMsgQuotaDecreaseOne(selected_data)
-            return True
-    
+            rate_limiter.refund(user_id)
+            reply_msg = user_message
+
+    # If not a special command, echo the user's message
+    # Use tradtional linebot mode
     else:
-        # Cannot find this user_id, then it is a new user,
-        # Add this user to the DB table
-        addUser(user_id, user_name)
-        return True
+        reply_msg = user_message
+
+    # Send the reply message back to the user, it is retried from the outbox (as a push once the token expired) if it fails
+    outbound_queue.reply(user_id, reply_token, [reply_msg])
 
-def modifyUserName(user_id, user_name):
-    """Modify user's profile name (displayed name) in DB"""
+    # Remember the exchange once the user has the answer
+    if answer is not None:
+        conversation_memory.add_exchange(user_id, history, user_message, answer)
 
-    update_condition = f"userid = '{user_id}'"
-    update_data = {'username': user_name}
-    db_handler.update_data('users', update_data, update_condition)
+def checkUserMsgQuota(user_id, user_name, enter_aimode=False):
+    """Use one message quota of the user in a single atomic DB round-trip, and return the resulting user state.
+    The user is added to the DB if he/she is new, and his/her profile name (display name) is refreshed.
+    If the user is in AI mode (or enters it) and has enough quota, 'consumed' is true and the last msg time is recorded.
+    If the user has no quota, the user leaves AI mode and 'consumed' is false to reject the user from asking."""
 
-def addUser(user_id, user_name):
-    """Add the new user to DB, and set the quota to 49,
-    because the user would use 1 quota upon asking question."""
+    user_state = user_cache.consume_quota(user_id, user_name, enter_aimode=enter_aimode)
+    if user_state is None:
+        raise RuntimeError(f"Could not update the quota of user {user_id}")
 
-    data_to_insert = {'userid': user_id, 'username': user_name, 'quota': 49}
-    db_handler.insert_data('users', data_to_insert)
+    return user_state
 
-def userMsgQuotaDecreaseOne(select_data):
-    """Decrease user's message quota by 1"""
+def refundUserMsgQuota(user_id):
+    """Give back the message quota used by a question that was not answered, e.g. because ChatPDF was saturated."""
 
-    userId = select_data[0][2]
-    userQuota = select_data[0][3]
-    userQuota -= 1
-    
-    update_condition = f"userid ='{userId}'"
-    update_data = {'quota': userQuota}
-    db_handler.update_data('users', update_data, update_condition)
+    if user_cache.refund_quota(user_id) is None:
+        logger.warning("Could not give back the quota of user %s", user_id)
 
 def checkUserModeStatus(user_id):
-    """See if the user is in AI-mode"""
-
-    selected_data = db_handler.select_data('users', condition=f"userid = '{user_id}'")
-    userAImode = selected_data[0][4]
-    return userAImode
-
-def enterAImode(user_id):
-    """Turn the user's AImode status into active(true)."""
-
-    update_condition = f"userid = '{user_id}'"
-    update_data = {'aimode': True}
-    db_handler.update_data('users', update_data, update_condition)
-
-def updateLastAImsgTime(user_id):
-    """Update the user's lastAImsgTime to the current time."""
-
-    update_condition = f"userid = '{user_id}'"
-    update_data = {'lastaimsgtime': time.time()}
-    db_handler.update_data('users', update_data, update_condition)
-
-def askChatPDF(user_message):
-    """Call chatPDF API to ask questions."""
-
-    CHATPDF_API_KEY = os.environ['CHATPDF_API_KEY']
-    CHATPDF_FILE_SOURCE = os.environ['CHATPDF_FILE_SOURCE']
-    # Send the user_message to chatPDF for processing
-    headers = {
-        'x-api-key': f"{CHATPDF_API_KEY}",
-        "Content-Type": "application/json",
-    }
-
-    data = {
-        'sourceId': f"{CHATPDF_FILE_SOURCE}",
-        'messages': [
-            {
-                'role': "user",
-                'content': f"{user_message}",
-            }
-        ]
-    }
-
-    response = requests.post(
-        'https://api.chatpdf.com/v1/chats/message', headers=headers, json=data
-    )
-    if response.status_code == 200:
-        response_msg = response.json()['content']
-    else:
-        response_msg = "Sorry, it seems that there is something wrong with the AI right now. Please ask AI later, thank you."
-    
-    return response_msg
+    """See if the user is in AI-mode.
+    Only the AI mode is trusted from the user state cache, a user out of AI mode is always read from the DB,
+    so a row left stale by another worker never makes this worker echo an AI question."""
+
+    user_state = user_cache.get_user(user_id)
+    if user_state is None:
+        user_state = user_cache.load_user(user_id)
+        if user_state is None:
+            return False
 
-def check_idle_user(exit_event):
-    """Periodically check idle users and sends notifications if their idle time exceeds 5 mins"""
-    # Don't know why this while loop was executed twice every 5 sec,
+    return user_state['aimode']
 
-    # Periodically check idle users and send notifications
-    while not exit_event.is_set():
+def askChatPDF(user_message, context=None, priority=None):
+    """Call chatPDF API to ask questions, return None if ChatPDF could not answer.
+    context holds the earlier messages of the conversation. Questions without context do not depend on the user,
+    so repeated ones are answered from the answer caches.
+    ChatPDF is only called once admitted at this priority, raise Overloaded if the call was shed."""
 
-        # Check if there are any scheduled tasks that need to be executed
-        schedule.run_pending()
-        current_time = time.time()
+    # The answer to a follow-up depends on the conversation, it is neither looked up in the caches nor cached
+    if context:
+        with admission_controller.admit(priority):
+            return chatpdf_client.request_answer(user_message, context)
 
-        users = db_handler.select_data('users', columns=['username', 'userid', 'aimode', 'lastaimsgtime'])
-        
-        for user in users:
-            userId = user[1]
-            userLastAImsgTime = user[3]
+    answer = answer_cache.get(user_message)
+    if answer is not None:
+        return answer
 
-            # Only deactivate AI-mode and sends notification if the user is in AI-mode.
-            if checkUserModeStatus(userId):
+    # Then look for an already answered question with the same meaning
+    if semantic_cache is not None:
+        answer = semantic_cache.get(user_message, scope=answer_cache.source_id)
+        if answer is not None:
+            return answer
 
-                # Calculate user's idle time, and see if the user's idle time exceed 5 mins.
-                idle_time = current_time - userLastAImsgTime
-                if idle_time > 300:
-                    exitAImodeNotification(userId)
-                    exitAImode(userId)
+    # Identical questions already being asked to the same source wait for that answer instead of asking again
+    question_key = (answer_cache.source_id, normalize_question(user_message))
+    return chatpdf_single_flight.do(question_key, fetchChatPDFAnswer, user_message, priority)
 
-        time.sleep(5)
+def fetchChatPDFAnswer(user_message, priority=None):
+    """Ask ChatPDF and cache the answer, return None if ChatPDF could not answer."""
 
-def exitAImodeNotification(user_id):
-    """Notify specific user to let him/her know the AI customer service is signing off."""
+    # Timeouts, retries and the circuit breaker are handled by the client
+    with admission_controller.admit(priority):
+        answer = chatpdf_client.request_answer(user_message)
+    if answer is None:
+        # Do not cache the failure
+        return None
 
-    # Create a TextSendMessage object with the message content
-    notificationMsg = TextSendMessage(text = "親愛的客戶您好，由於您已超過5分鐘未互動，AI客服將先行告退~若需要AI客服的服務，請再次以'Hi ai'喚醒AI哦")
-    
-    # Use the push_message method to send the message
-    line_bot_api.push_message(user_id, messages=notificationMsg)
+    answer_cache.put(user_message, answer)
+    if semantic_cache is not None:
+        semantic_cache.put(user_message, answer, scope=answer_cache.source_id)
+    return answer
+
+def check_idle_user(exit_event):
+    """Sends notifications and deactivates AI mode when a user's idle time exceeds 5 mins.
+    The idle scheduler only wakes up at the deadlines of the users in AI mode, instead of polling every user."""
+
+    idle_scheduler.run(exit_event)
 
-def exitAImode(user_id):
-    """Turn user's AImode status into passive(false)."""
+def expireIdleUsers(cutoff):
+    """Deactivate the AI mode of every user idle since cutoff in one DB update, then notify them.
+    Return the userIds that have been taken out of AI mode."""
 
-    update_condition = f"userid = '{user_id}'"
-    update_data = {'aimode': False}
-    db_handler.update_data('users', update_data, update_condition)
+    # Only one worker can win this conditional update, so each user is notified once
+    expired_user_ids = [user_state['userid'] for user_state in user_cache.expire_idle_users(cutoff)]
+    if expired_user_ids:
+        aimode_idle_exits.inc(len(expired_user_ids))
+        exitAImodeNotification(expired_user_ids)
+
+    return expired_user_ids
+
+# Initialize the idle AI-mode expiry scheduler, the users touched by other workers are swept every minute
+idle_scheduler = IdleExpiryScheduler(
+    expire_idle_users=expireIdleUsers,
+    idle_timeout=float(os.environ.get('AI_IDLE_TIMEOUT', 300)),
+    resync_interval=float(os.environ.get('AI_IDLE_RESYNC_INTERVAL', 60))
+)
+
+def exitAImodeNotification(user_ids):
+    """Notify the users to let them know the AI customer service is signing off."""
+
+    # Create a TextSendMessage object with the message content
+    notificationText = "親愛的客戶您好，由於您已超過5分鐘未互動，AI客服將先行告退~若需要AI客服的服務，請再次以'Hi ai'喚醒AI哦"
+    notificationMsg = TextSendMessage(text = notificationText)
 
-def reset_status():
-    """Load the userInfo.json, reset the "quota" to 50 of every user, and save it back."""
+    # Send the message with LINE multicast, in concurrent rate limited batches
+    # The users of the failed batches get it from the outbox later
+    failed_user_ids = push_sender.send(user_ids, notificationMsg)
+    if failed_user_ids:
+        outbound_queue.queue_pushes(failed_user_ids, [notificationText])
 
-    update_condition = "True"
-    update_data = {"quota": 50}
-    db_handler.update_data('users', update_data, update_condition)
+# Initialize the periodic jobs, each due run is claimed in Postgres so only one gunicorn worker runs it
+# The daily quotas need no job, they start again lazily on the first message of a user on a new day
+job_scheduler = JobScheduler(store=db_handler, tick_interval=float(os.environ.get('JOB_TICK_INTERVAL', 30)))
+job_scheduler.add_interval('purge_shared_answers', answer_cache.purge_shared, 3600)
 
-def scheduled_reset(exit_event):
-    """Reset users' quota to 50 upon everyday midnight """
+def ensureSchema():
+    """Bring the Postgres schema (users, outbox and shared answer cache tables) up to date with the versioned
+    migrations, and prepare the user store when it is not Postgres. Then drop the stale shared answers."""
 
-    while not exit_event.is_set():
-        # Check if there are any scheduled tasks that need to be executed
-        schedule.run_pending()
-        schedule.every().day.at("00:00").do(reset_status)
+    run_migrations(db_handler)
+    if user_store is not db_handler:
+        user_store.ensure_user_schema()
 
-        # Introduces a small delay of 1 sec between iterations of the loop, 
-        # preventing the loop from consuming excessive CPU resources
-        time.sleep(30)
+    # The answers of a previous source document are dropped
+    answer_cache.purge_shared()
 
 def main():
-    """Ran as a background task and continuously check the time
-     to check if resetting users' quota of message is needed.
+    """Ran as a background task and continuously run the periodic jobs.
      Also continuously checking users' idle time and deactivate AImode when meeded"""
 
     # Create an Event to  signal the thread to exit.(Upon Ctrl+c is pressed)
     exit_event = threading.Event()
+
+    # Prepare the DB table before serving any message
+    ensureSchema()
+
     try:
+        # Start the background reply workers
+        reply_workers.start()
+
         # Start a thread for the scheduled task
-        schedule_thread = threading.Thread(target=scheduled_reset, args=(exit_event,))
+        schedule_thread = threading.Thread(target=job_scheduler.run, args=(exit_event,))
         schedule_thread.start()
 
         # Start a thread for consistently check users' idle time
         check_idle_thread = threading.Thread(target=check_idle_user, args=(exit_event,))
         check_idle_thread.start()
 
+        # Start a thread for retrying the messages of the outbox
+        outbox_thread = threading.Thread(target=outbound_queue.run, args=(exit_event,))
+        outbox_thread.start()
+
+        # Start a thread for saving the conversation histories in batches
+        conversation_thread = threading.Thread(target=conversation_memory.run, args=(exit_event,))
+        conversation_thread.start()
+
+        # Start a thread for syncing the rate limit buckets with the other workers
+        if rate_limiter.shared_store is not None:
+            rate_limit_thread = threading.Thread(target=rate_limiter.run, args=(exit_event,))
+            rate_limit_thread.start()
+
+        # Start a thread for snapshotting the user records of the JSON store
+        if isinstance(user_store, ShardedUserStore):
+            snapshot_thread = threading.Thread(target=user_store.run_snapshots, args=(exit_event,))
+            snapshot_thread.start()
+
     except KeyboardInterrupt:
         # Ctrl+c is pressed, set the exit event for threads to exit gracefully
         exit_event.set()
@@ -291,17 +537,31 @@ def main():
         # Wait for the threads to exit
         schedule_thread.join()
         check_idle_thread.join()
-
-        # Close the database connection
+        outbox_thread.join()
+        conversation_thread.join()
+        if rate_limiter.shared_store is not None:
+            rate_limit_thread.join()
+        if isinstance(user_store, ShardedUserStore):
+            snapshot_thread.join()
+        reply_workers.stop()
+        chatpdf_client.close()
+        profile_cache.close()
+        push_sender.close()
+
+        # Close the database connections
+        if user_store is not db_handler:
+            user_store.close_connection()
         db_handler.close_connection()
 
 if __name__ == "__main__":
     # When running this Flask app in development environment, this block would be ran
 
-    # Run the Flask app
-    app.run(debug=True)
+    # Start the background threads first, app.run() blocks until the server stops
     main()
 
+    # Run the Flask app, without the reloader so the background threads are not started twice
+    app.run(debug=True, use_reloader=False)
+
 else:
     # When running this Flask app on Heroku with Gunicorn, this block would be ran
     # Gunicorn would start the Flask app automatically, no need to explicitly run app here.
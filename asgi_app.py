@@ -0,0 +1,457 @@
+# Standard Library Imports
+import os
+import asyncio
+import threading
+import logging
+
+# Third-Party Imports
+from aiohttp import web
+from linebot.v3 import WebhookParser
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+from linebot.v3.messaging import (
+    AsyncApiClient, AsyncMessagingApi, Configuration,
+    PushMessageRequest, MulticastRequest, TextMessage
+)
+
+# Local Imports
+from db_module.db_operations import PostgreSQLHandler
+from db_module.async_db_operations import AsyncPostgreSQLHandler
+from worker_module.idle_scheduler import IdleExpiryScheduler
+from worker_module.push_sender import MAX_MULTICAST_RECIPIENTS
+from worker_module.rate_limiter import RateLimiter, parse_tiers
+from worker_module.admission_control import AsyncAdmissionController, Overloaded
+from worker_module.async_outbound_queue import AsyncOutboundQueue
+from ai_module.async_chatpdf_client import AsyncChatPDFClient
+from ai_module.conversation_memory import ConversationMemory
+from cache_module.answer_cache import AnswerCache, normalize_question
+from cache_module.semantic_cache import SemanticCache, SentenceTransformerEmbedder
+from cache_module.single_flight import AsyncSingleFlight
+from cache_module.ttl_cache import TTLCache
+
+# Asyncio counterpart of app.py: one process serves thousands of messages at once, each one is a coroutine
+# that only holds memory while it waits for LINE, ChatPDF or the DB. Run it with:
+#   gunicorn asgi_app:app --worker-class aiohttp.GunicornWebWorker
+
+# Set up logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+QUOTA_EXHAUSTED_MESSAGE = "很抱歉，由於您已達到每日詢問AI客服的次數上限:50次/日，AI客服將先行告退。您可以等待明日繼續詢問或是聯絡CRESTDiving客服專線，謝謝！"
+RATE_LIMITED_MESSAGE = "您的提問速度太快了，請稍候幾秒再詢問AI客服，謝謝！"
+BUSY_MESSAGE = "目前詢問AI客服的人數較多，請稍後再試一次，謝謝！"
+IDLE_NOTIFICATION_MESSAGE = "親愛的客戶您好，由於您已超過5分鐘未互動，AI客服將先行告退~若需要AI客服的服務，請再次以'Hi ai'喚醒AI哦"
+
+# Initialize the Webhook Parser, it only verifies the signature and parses the events
+parser = WebhookParser(os.environ['CHANNEL_SECRET'])
+
+# The LINE Messaging API client is created on startup, inside the event loop
+line_configuration = Configuration(access_token=os.environ['CHANNEL_ACCESS_TOKEN'])
+line_api_client = None
+line_bot_api = None
+
+# Initialize the asyncpg pool handler, a few connections serve every in-flight message
+DATABASE_URL = os.environ['DATABASE_URL']
+db_handler = AsyncPostgreSQLHandler(
+    DATABASE_URL,
+    min_connections=int(os.environ.get('DB_POOL_MIN', 1)),
+    max_connections=int(os.environ.get('DB_POOL_MAX', 10)),
+    quota_timezone_name=os.environ.get('QUOTA_TIMEZONE')
+)
+
+# The outbound queue of the replies, the same outbox table and settings as app.py, it gets the LINE client on startup
+outbound_queue = AsyncOutboundQueue(
+    None,
+    db_handler,
+    max_attempts=int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8)),
+    poll_interval=float(os.environ.get('OUTBOX_POLL_INTERVAL', 1))
+)
+
+# Initialize the ChatPDF client, up to CHATPDF_MAX_CONNECTIONS questions are sent at once
+chatpdf_client = AsyncChatPDFClient(
+    api_key=os.environ['CHATPDF_API_KEY'],
+    source_id=os.environ['CHATPDF_FILE_SOURCE'],
+    base_url=os.environ.get('CHATPDF_BASE_URL', 'https://api.chatpdf.com/v1'),
+    connect_timeout=float(os.environ.get('CHATPDF_CONNECT_TIMEOUT', 3.05)),
+    read_timeout=float(os.environ.get('CHATPDF_READ_TIMEOUT', 30)),
+    max_retries=int(os.environ.get('CHATPDF_MAX_RETRIES', 2)),
+    max_connections=int(os.environ.get('CHATPDF_MAX_CONNECTIONS', 1000))
+)
+
+# The conversation history comes with the users row and is saved through the async DB handler
+conversation_memory = ConversationMemory(
+    max_messages=int(os.environ.get('CONVERSATION_MAX_MESSAGES', 6)),
+    max_tokens=int(os.environ.get('CONVERSATION_MAX_TOKENS', 1000)),
+    batch_writes=True,
+    flush_interval=float(os.environ.get('CONVERSATION_FLUSH_INTERVAL', 0.5))
+)
+
+# Initialize the cache of ChatPDF answers, only the in-process tier (the shared tier uses the blocking DB handler)
+answer_cache = AnswerCache(
+    source_id=os.environ['CHATPDF_FILE_SOURCE'],
+    max_size=int(os.environ.get('ANSWER_CACHE_SIZE', 1000)),
+    ttl=float(os.environ.get('ANSWER_CACHE_TTL', 86400))
+)
+
+# Initialize the optional semantic cache, as in app.py
+semantic_cache = None
+if os.environ.get('SEMANTIC_CACHE_MODEL'):
+    semantic_cache = SemanticCache(
+        embed=SentenceTransformerEmbedder(os.environ['SEMANTIC_CACHE_MODEL']),
+        capacity=int(os.environ.get('SEMANTIC_CACHE_SIZE', 1000)),
+        threshold=float(os.environ['SEMANTIC_CACHE_THRESHOLD']) if os.environ.get('SEMANTIC_CACHE_THRESHOLD') else None,
+        ttl=float(os.environ.get('ANSWER_CACHE_TTL', 86400))
+    )
+
+# Identical questions asked at the same time share one ChatPDF request
+chatpdf_single_flight = AsyncSingleFlight()
+
+# Display names and AI modes of the recent users, so get_profile and the DB are not called for every message
+profile_names = TTLCache(
+    max_size=int(os.environ.get('PROFILE_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('PROFILE_CACHE_TTL', 600))
+)
+user_modes = TTLCache(
+    max_size=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 30))
+)
+
+# Rate limits of the AI questions, the same settings as app.py, kept in memory by each worker
+rate_limiter = RateLimiter(
+    parse_tiers(os.environ.get('RATE_LIMIT_TIERS', 'default:0.2:5,vip:1:20')),
+    global_rate=float(os.environ.get('RATE_LIMIT_GLOBAL_RATE', 20)),
+    global_burst=float(os.environ.get('RATE_LIMIT_GLOBAL_BURST', 40))
+)
+for vip_user_id in filter(None, os.environ.get('RATE_LIMIT_VIP_USERS', '').split(',')):
+    rate_limiter.set_tier(vip_user_id.strip(), 'vip')
+
+# Admission control of the ChatPDF calls, the same settings as app.py: at most UPSTREAM_MAX_CONCURRENCY at once,
+# the others queue by tier (vip first) and get a "busy" reply instead of waiting more than ADMISSION_QUEUE_TIMEOUT seconds
+admission_controller = AsyncAdmissionController(
+    max_concurrency=int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', 8)),
+    queue_timeout=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10)),
+    max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', 100))
+)
+
+# The messages being handled, and the lock of every user with messages in flight so they are answered in order
+MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', 10000))
+in_flight_tasks = set()
+user_locks = {}
+
+async def linebot(request):
+    """This function would be ran upon there is POST request from webhook.
+    It only verifies the signature and starts a task per message, the replies are sent by the tasks."""
+
+    # Get the request body as text
+    body = await request.text()
+
+    # Get signature from request headers
+    signature = request.headers.get('X-Line-Signature', '')
+
+    # Verify the signature and parse the events of the batch
+    try:
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        raise web.HTTPBadRequest()
+
+    # Start a task for every text message, events other than text messages do not need a reply
+    started_events = 0
+    rejected_events = 0
+    for event in events:
+        if not isinstance(event, MessageEvent) or not isinstance(event.message, TextMessageContent):
+            logger.debug("Ignoring %s event", event.type)
+            continue
+
+        user_id = getattr(event.source, 'user_id', None)
+        if user_id is None:
+            logger.info("Ignoring a text message without userId from %s", event.source.type)
+            continue
+
+        if len(in_flight_tasks) >= MAX_IN_FLIGHT:
+            logger.warning("Too many messages in flight, dropping the event of %s", user_id)
+            rejected_events += 1
+            continue
+
+        task = asyncio.create_task(runInUserOrder(user_id, replyToMessage, user_id, event.reply_token, event.message.text))
+        in_flight_tasks.add(task)
+        task.add_done_callback(in_flight_tasks.discard)
+        started_events += 1
+
+    # Only ask LINE to redeliver when nothing was started, otherwise the started events would be answered twice
+    if rejected_events and not started_events:
+        return web.Response(text='Busy', status=503)
+
+    return web.Response(text='OK')
+
+async def runInUserOrder(user_id, func, *args):
+    """Run a message coroutine once the previous messages of the same user are answered."""
+
+    # user_id -> [lock, number of messages holding or waiting for it]
+    entry = user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            await func(*args)
+    except Exception:
+        logger.exception("Could not answer the message of %s", user_id)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del user_locks[user_id]
+
+async def stats(request):
+    """Expose the in-flight messages and the metrics of the clients and caches."""
+
+    return web.json_response({
+        'in_flight': len(in_flight_tasks),
+        'users_in_flight': len(user_locks),
+        'db_pool': db_handler.get_stats(),
+        'idle_scheduler': idle_scheduler.get_stats(),
+        'chatpdf': chatpdf_client.get_stats(),
+        'answer_cache': answer_cache.get_stats(),
+        'semantic_cache': semantic_cache.get_stats() if semantic_cache is not None else None,
+        'chatpdf_single_flight': chatpdf_single_flight.get_stats(),
+        'profile_names': profile_names.get_stats(),
+        'user_modes': user_modes.get_stats(),
+        'conversation_memory': conversation_memory.get_stats(),
+        'rate_limiter': rate_limiter.get_stats(),
+        'outbound_queue': outbound_queue.get_stats(),
+        'admission_controller': admission_controller.get_stats(),
+    })
+
+async def replyToMessage(user_id, reply_token, user_message):
+    """Do the quota/AI-mode logic of app.replyToMessage and send the reply back to the user."""
+
+    # 'hi ai' enters AI mode, users cached in AI mode skip the DB read, the others are checked in the DB
+    # Only then does the message count in the rate limits, echoed messages never use a token
+    is_ai_greeting = user_message[:5].lower() == 'hi ai'
+    wants_ai = is_ai_greeting or await checkUserModeStatus(user_id)
+    answer = None
+
+    # Too many questions, from this user or from everyone: answer right away without using a quota
+    if wants_ai and not rate_limiter.allow(user_id):
+        reply_msg = RATE_LIMITED_MESSAGE
+
+    elif wants_ai:
+
+        # Use one message quota of the user, this also enters AI mode and records last msg time
+        user_name = await getDisplayName(user_id)
+        user_state = await db_handler.consume_user_quota(user_id, user_name, enter_aimode=is_ai_greeting)
+        if user_state is None:
+            raise RuntimeError(f"Could not update the quota of user {user_id}")
+        user_modes.put(user_id, user_state['aimode'])
+
+        if user_state['consumed']:
+
+            # (Re)schedule the idle expiry of the user
+            idle_scheduler.touch(user_id, user_state['lastaimsgtime'])
+
+            # Redirect the question to chatPDF, with the recent conversation as context
+            # The last exchange may still be waiting to be saved with the next batch
+            history = [] if is_ai_greeting else conversation_memory.latest_history(user_id, user_state['history'])
+            # ChatPDF is saturated and the question would wait too long: answer busy and give the quota back
+            priority = admission_controller.priority_of(rate_limiter.tier_of(user_id))
+            try:
+                answer = await askChatPDF(user_message, conversation_memory.build_context(history, user_message), priority)
+                reply_msg = answer if answer is not None else chatpdf_client.fallback_message
+            except Overloaded:
+                if await db_handler.refund_user_quota(user_id) is None:
+                    logger.warning("Could not give back the quota of user %s", user_id)
+                reply_msg = BUSY_MESSAGE
+
+        # The user does not have enough quota to ask question, the user has been taken out of AI mode
+        elif user_state['requested_ai']:
+            reply_msg = QUOTA_EXHAUSTED_MESSAGE
+
+        # The user is not in AI mode after all (the cached mode was stale), echo the user's message
+        else:
+            rate_limiter.refund(user_id)
+            reply_msg = user_message
+
+    # If not a special command, echo the user's message
+    else:
+        reply_msg = user_message
+
+    # Send the reply message back to the user, a reply LINE does not accept is retried from the outbox
+    await outbound_queue.reply(user_id, reply_token, [reply_msg])
+
+    # Remember the exchange once the user has the answer, it is saved with the next batch
+    if answer is not None:
+        conversation_memory.add_exchange(user_id, history, user_message, answer)
+
+async def checkUserModeStatus(user_id):
+    """See if the user is in AI-mode, as app.checkUserModeStatus: only the AI mode is trusted from user_modes,
+    a user out of AI mode is read from the DB."""
+
+    if user_modes.get(user_id):
+        return True
+
+    user_state = await db_handler.get_user(user_id)
+    aimode = user_state is not None and user_state['aimode']
+    user_modes.put(user_id, aimode)
+    return aimode
+
+async def getDisplayName(user_id):
+    """Return the cached profile name of the user, ask LINE for it on a miss."""
+
+    display_name = profile_names.get(user_id)
+    if display_name is None:
+        display_name = (await line_bot_api.get_profile(user_id)).display_name
+        profile_names.put(user_id, display_name)
+    return display_name
+
+async def askChatPDF(user_message, context=None, priority=None):
+    """Call chatPDF API to ask questions, return None if ChatPDF could not answer.
+    Questions without context are answered from the answer caches, as in app.askChatPDF.
+    ChatPDF is only called once admitted at this priority, raise Overloaded if the call was shed."""
+
+    if context:
+        async with admission_controller.admit(priority):
+            return await chatpdf_client.request_answer(user_message, context)
+
+    answer = answer_cache.get(user_message)
+    if answer is not None:
+        return answer
+
+    # The embedding runs on CPU, it is computed in the default executor instead of blocking the event loop
+    if semantic_cache is not None:
+        loop = asyncio.get_running_loop()
+        answer = await loop.run_in_executor(None, semantic_cache.get, user_message, answer_cache.source_id)
+        if answer is not None:
+            return answer
+
+    question_key = (answer_cache.source_id, normalize_question(user_message))
+    return await chatpdf_single_flight.do(question_key, fetchChatPDFAnswer, user_message, priority)
+
+async def fetchChatPDFAnswer(user_message, priority=None):
+    """Ask ChatPDF and cache the answer, return None if ChatPDF could not answer."""
+
+    async with admission_controller.admit(priority):
+        answer = await chatpdf_client.request_answer(user_message)
+    if answer is None:
+        return None
+
+    answer_cache.put(user_message, answer)
+    if semantic_cache is not None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, semantic_cache.put, user_message, answer, answer_cache.source_id)
+    return answer
+
+async def expireIdleUsers(cutoff):
+    """Deactivate the AI mode of every user idle since cutoff in one DB update, then notify them.
+    Return the userIds that have been taken out of AI mode."""
+
+    expired_user_ids = [user_state['userid'] for user_state in await db_handler.expire_idle_users(cutoff)]
+    for user_id in expired_user_ids:
+        user_modes.put(user_id, False)
+
+    if expired_user_ids:
+        await exitAImodeNotification(expired_user_ids)
+    return expired_user_ids
+
+async def exitAImodeNotification(user_ids):
+    """Notify the users to let them know the AI customer service is signing off, in concurrent multicast batches."""
+
+    messages = [TextMessage(text=IDLE_NOTIFICATION_MESSAGE)]
+    requests = []
+    for i in range(0, len(user_ids), MAX_MULTICAST_RECIPIENTS):
+        batch = user_ids[i:i + MAX_MULTICAST_RECIPIENTS]
+        if len(batch) == 1:
+            requests.append(line_bot_api.push_message(PushMessageRequest(to=batch[0], messages=messages)))
+        else:
+            requests.append(line_bot_api.multicast(MulticastRequest(to=batch, messages=messages)))
+
+    for result in await asyncio.gather(*requests, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error("Could not send a batch of idle notifications: %s", result)
+
+def expireIdleUsersFromScheduler(cutoff):
+    """Ran by the idle scheduler thread, run the expiry on the event loop and wait for it."""
+
+    return asyncio.run_coroutine_threadsafe(expireIdleUsers(cutoff), app['loop']).result()
+
+# The idle expiry scheduler keeps its own thread, it only hands the expiry itself over to the event loop
+idle_scheduler = IdleExpiryScheduler(
+    expire_idle_users=expireIdleUsersFromScheduler,
+    idle_timeout=float(os.environ.get('AI_IDLE_TIMEOUT', 300)),
+    resync_interval=float(os.environ.get('AI_IDLE_RESYNC_INTERVAL', 60))
+)
+
+async def saveConversations():
+    """Save the conversation histories waiting in conversation_memory with one statement."""
+
+    histories = conversation_memory.take_pending()
+    try:
+        if histories:
+            await db_handler.save_conversations(histories)
+    except Exception:
+        conversation_memory.flushed(histories, saved=False)
+        logger.exception("Could not save the conversation histories")
+        return
+    conversation_memory.flushed(histories)
+
+async def runConversationWrites():
+    """Save the conversation histories every flush_interval seconds until cancelled."""
+
+    while True:
+        await asyncio.sleep(conversation_memory.flush_interval)
+        await saveConversations()
+
+def ensureSchema():
+    """Prepare the users table with a short-lived blocking connection, as app.ensureSchema does."""
+
+    schema_handler = PostgreSQLHandler(DATABASE_URL, min_connections=1, max_connections=1)
+    try:
+        schema_handler.ensure_user_schema()
+    finally:
+        schema_handler.close_connection()
+
+async def startBackgroundTasks(app):
+    """Open the clients inside the event loop, start the idle expiry thread and the outbox dispatcher."""
+
+    global line_api_client, line_bot_api
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, ensureSchema)
+
+    line_api_client = AsyncApiClient(line_configuration)
+    line_bot_api = AsyncMessagingApi(line_api_client)
+    outbound_queue.line_bot_api = line_bot_api
+    await db_handler.open()
+    await chatpdf_client.open()
+
+    app['loop'] = loop
+    app['exit_event'] = threading.Event()
+    app['check_idle_thread'] = threading.Thread(target=idle_scheduler.run, args=(app['exit_event'],))
+    app['check_idle_thread'].start()
+    app['conversation_writes'] = asyncio.create_task(runConversationWrites())
+    app['outbox_dispatcher'] = asyncio.create_task(outbound_queue.run())
+
+async def stopBackgroundTasks(app):
+    """Let the in-flight messages finish, then stop the idle expiry thread and close the clients."""
+
+    if in_flight_tasks:
+        await asyncio.wait(set(in_flight_tasks))
+
+    # The thread may be waiting for the loop, so it is joined from an executor thread
+    app['exit_event'].set()
+    await asyncio.get_running_loop().run_in_executor(None, app['check_idle_thread'].join)
+
+    # Save the histories of the last answers before the pool is closed, the outbox is retried by the next start
+    app['outbox_dispatcher'].cancel()
+    app['conversation_writes'].cancel()
+    await saveConversations()
+
+    await chatpdf_client.close()
+    await line_api_client.close()
+    await db_handler.close()
+
+app = web.Application()
+app.router.add_post('/', linebot)
+app.router.add_get('/stats', stats)
+app.on_startup.append(startBackgroundTasks)
+app.on_cleanup.append(stopBackgroundTasks)
+
+if __name__ == "__main__":
+    # When running this app in development environment, this block would be ran
+    web.run_app(app, port=int(os.environ.get('PORT', 8080)))
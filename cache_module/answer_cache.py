@@ -0,0 +1,83 @@
+import re
+import threading
+import time
+import unicodedata
+
+from cache_module.ttl_cache import TTLCache
+
+# Punctuation at the end of a question does not change its meaning
+TRAILING_PUNCTUATION = " ?!.,;:~？！。，；：～"
+
+def normalize_question(question):
+    """Normalize a question so trivial variations (case, full-width characters, spaces,
+    trailing punctuation) map to the same cache key."""
+
+    question = unicodedata.normalize('NFKC', question).lower()
+    question = re.sub(r'\s+', ' ', question)
+    return question.strip(TRAILING_PUNCTUATION)
+
+class AnswerCache:
+    """Cache of AI answers keyed by the source document ID and the normalized question.
+
+    The local tier is an in-process TTL/LRU cache. When a shared_store (the PostgreSQLHandler) is given,
+    answers are also stored in the answer_cache table so every gunicorn worker benefits from them.
+    The source document is the one configured at startup; answers of another one are never returned,
+    and purge_shared() deletes them from the shared table."""
+
+    def __init__(self, source_id, max_size=1000, ttl=86400, shared_store=None):
+        self.source_id = source_id
+        self.ttl = ttl
+        self.local_cache = TTLCache(max_size=max_size, ttl=ttl)
+        self.shared_store = shared_store
+
+        self.stats_lock = threading.Lock()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def get(self, question):
+        """Return the cached answer of the question, or None."""
+
+        question = normalize_question(question)
+        answer = self.local_cache.get((self.source_id, question))
+        if answer is not None:
+            with self.stats_lock:
+                self.local_hits += 1
+            return answer
+
+        if self.shared_store is not None:
+            answer = self.shared_store.get_cached_answer(self.source_id, question, time.time() - self.ttl)
+            if answer is not None:
+                self.local_cache.put((self.source_id, question), answer)
+                with self.stats_lock:
+                    self.shared_hits += 1
+                return answer
+
+        with self.stats_lock:
+            self.misses += 1
+        return None
+
+    def put(self, question, answer):
+        question = normalize_question(question)
+        self.local_cache.put((self.source_id, question), answer)
+        if self.shared_store is not None:
+            self.shared_store.put_cached_answer(self.source_id, question, answer)
+
+    def purge_shared(self):
+        """Delete the shared answers that belong to another source document or have expired."""
+
+        if self.shared_store is not None:
+            self.shared_store.delete_stale_answers(self.source_id, time.time() - self.ttl)
+
+    def get_stats(self):
+        with self.stats_lock:
+            lookups = self.local_hits + self.shared_hits + self.misses
+            stats = {
+                'source_id': self.source_id,
+                'local_hits': self.local_hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': (self.local_hits + self.shared_hits) / lookups if lookups else 0.0,
+            }
+        stats['local_cache'] = self.local_cache.get_stats()
+        return stats
@@ -0,0 +1,84 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache_module.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+class ProfileCache:
+    """Cache of LINE display names keyed by userId, in front of line_bot_api.get_profile.
+
+    An entry younger than ttl is served as is. An older one is still served, but a background refresh is started,
+    so a renamed user is picked up by his/her next messages while the hot path never waits for it.
+    Only unknown users (or entries unused for max_stale seconds) wait for get_profile."""
+
+    def __init__(self, get_profile, max_size=10000, ttl=600, max_stale=86400, refresh_workers=2):
+        self.get_profile = get_profile
+        self.ttl = ttl
+
+        # userId -> (fetched_at, display_name)
+        self.cache = TTLCache(max_size=max_size, ttl=max_stale)
+        self.refresh_executor = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix='profile-refresh')
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+        self.fresh_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refresh_failures = 0
+
+    def get_display_name(self, user_id):
+        entry = self.cache.get(user_id)
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+            return self._fetch(user_id)
+
+        fetched_at, display_name = entry
+        if time.monotonic() - fetched_at < self.ttl:
+            with self.lock:
+                self.fresh_hits += 1
+            return display_name
+
+        # Serve the stale name now and refresh it for the next messages
+        with self.lock:
+            self.stale_hits += 1
+            start_refresh = user_id not in self.refreshing
+            self.refreshing.add(user_id)
+        if start_refresh:
+            self.refresh_executor.submit(self._refresh, user_id)
+        return display_name
+
+    def _fetch(self, user_id):
+        display_name = self.get_profile(user_id).display_name
+        self.cache.put(user_id, (time.monotonic(), display_name))
+        return display_name
+
+    def _refresh(self, user_id):
+        try:
+            self._fetch(user_id)
+        except Exception:
+            logger.exception("Could not refresh the profile of %s", user_id)
+            with self.lock:
+                self.refresh_failures += 1
+        finally:
+            with self.lock:
+                self.refreshing.discard(user_id)
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.fresh_hits + self.stale_hits + self.misses
+            return {
+                'size': len(self.cache),
+                'fresh_hits': self.fresh_hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'hit_rate': (self.fresh_hits + self.stale_hits) / lookups if lookups else 0.0,
+                'refreshing': len(self.refreshing),
+                'refresh_failures': self.refresh_failures,
+            }
+
+    def close(self):
+        self.refresh_executor.shutdown(wait=False)
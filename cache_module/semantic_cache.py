@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from cache_module.answer_cache import normalize_question
+
+logger = logging.getLogger(__name__)
+
+# Labeled question pairs the threshold is calibrated on: (question, question, same answer)
+# The different pairs are the near misses a cache must not confuse, they share most of their words
+CALIBRATION_PAIRS = [
+    ("how much is the open water course", "open water course price?", True),
+    ("what time do you open", "what are your opening hours", True),
+    ("where is the shop", "what is your address", True),
+    ("can I rent a wetsuit", "do you have wetsuits for rent", True),
+    ("do I need to know how to swim", "is swimming required for the course", True),
+    ("how long does the course take", "how many days is the course", True),
+    ("開放水域課程多少錢", "開放水域課程的價格是多少", True),
+    ("你們幾點開門", "營業時間是什麼時候", True),
+    ("可以租防寒衣嗎", "有防寒衣可以租借嗎", True),
+    ("how much is the open water course", "開放水域課程多少錢", True),
+    ("how much is the open water course", "how much is the advanced open water course", False),
+    ("what time do you open", "what time do you close", False),
+    ("can I rent a wetsuit", "can I buy a wetsuit", False),
+    ("how long does the course take", "how much does the course cost", False),
+    ("do I need to know how to swim", "do I need a medical certificate", False),
+    ("where is the shop", "where is the dive site", False),
+    ("開放水域課程多少錢", "進階開放水域課程多少錢", False),
+    ("你們幾點開門", "你們幾點關門", False),
+    ("可以租防寒衣嗎", "可以買防寒衣嗎", False),
+    ("is the boat dive included", "is the boat dive extra", False),
+]
+
+class SentenceTransformerEmbedder:
+    """Embed a text with a sentence-transformers model saved in a local directory
+    (SentenceTransformer(name).save(path) on a machine with network access, e.g. paraphrase-multilingual-MiniLM-L12-v2
+    which matches English and Chinese questions). Only a directory is accepted so that nothing is downloaded at startup."""
+
+    def __init__(self, model_path):
+        if not os.path.isdir(model_path):
+            raise ValueError(f"The embedding model must be a local directory, {model_path!r} is not one")
+
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_path, device='cpu')
+        self.dimensions = self.model.get_sentence_embedding_dimension()
+
+    def __call__(self, text):
+        vector = self.model.encode(normalize_question(text), normalize_embeddings=True)
+        return vector.astype(np.float32)
+
+def calibrate_threshold(embed, pairs=CALIBRATION_PAIRS):
+    """Return the lowest similarity threshold that keeps every different pair of pairs apart under embed.
+    A wrong cached answer costs more than a ChatPDF call, so the paraphrases scoring below it are left to ChatPDF;
+    how many of them still match is logged."""
+
+    scores = np.array([float(np.dot(embed(a), embed(b))) for a, b, _ in pairs])
+    same = np.array([same for _, _, same in pairs])
+
+    threshold = float(scores[~same].max()) + 0.01
+    if threshold > 1.0:
+        logger.warning("The embedding model cannot tell the labeled near misses apart, the semantic cache never matches")
+    logger.info(
+        "Semantic cache threshold %.3f, matches %d of the %d labeled paraphrases",
+        threshold, int(np.count_nonzero(scores[same] >= threshold)), int(np.count_nonzero(same))
+    )
+    return threshold
+
+class SemanticCache:
+    """Answer cache matching questions by meaning instead of exact text.
+
+    Questions are embedded (any text -> unit float32 vector callable, e.g. SentenceTransformerEmbedder)
+    into one preallocated capacity x dimensions float32 matrix.
+    A lookup is a single matrix-vector product: the most similar live entry of the same scope (source ID)
+    is returned if its cosine similarity reaches threshold, which defaults to calibrate_threshold(embed).
+    Embedding takes milliseconds of CPU, the asyncio app calls get and put in an executor.
+    When full, an expired entry or else the least recently used one is replaced."""
+
+    def __init__(self, embed, dimensions=None, capacity=1000, threshold=None, ttl=86400):
+        self.embed = embed
+        dimensions = dimensions or embed.dimensions
+        self.capacity = capacity
+        self.threshold = threshold if threshold is not None else calibrate_threshold(embed)
+        self.ttl = ttl
+
+        self.matrix = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.expires_at = np.zeros(capacity, dtype=np.float64)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.scope_ids = np.full(capacity, -1, dtype=np.int32)
+        self.answers = [None] * capacity
+
+        # Scopes are stored as small ints in the matrix rows' metadata
+        self.scopes = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _scope_id(self, scope):
+        return self.scopes.setdefault(scope, len(self.scopes))
+
+    def get(self, question, scope=''):
+        """Return the answer of the most similar cached question, or None."""
+
+        vector = self.embed(question)
+        now = time.monotonic()
+        with self.lock:
+            scores = self.matrix @ vector
+            live = (self.scope_ids == self._scope_id(scope)) & (self.expires_at > now)
+            scores[~live] = -1.0
+
+            index = int(np.argmax(scores))
+            if scores[index] < self.threshold:
+                self.misses += 1
+                return None
+
+            self.last_used[index] = now
+            self.hits += 1
+            return self.answers[index]
+
+    def put(self, question, answer, scope=''):
+        vector = self.embed(question)
+        now = time.monotonic()
+        with self.lock:
+            # Replace a free or expired slot first, otherwise the least recently used one
+            expired = np.flatnonzero(self.expires_at <= now)
+            index = int(expired[0]) if expired.size else int(np.argmin(self.last_used))
+
+            self.matrix[index] = vector
+            self.expires_at[index] = now + self.ttl
+            self.last_used[index] = now
+            self.scope_ids[index] = self._scope_id(scope)
+            self.answers[index] = answer
+
+    def clear(self):
+        with self.lock:
+            self.expires_at[:] = 0
+            self.scope_ids[:] = -1
+            self.answers = [None] * self.capacity
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': int(np.count_nonzero(self.expires_at > time.monotonic())),
+                'capacity': self.capacity,
+                'threshold': self.threshold,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+
+class _Call:
+    """One in-flight call and the callers waiting for it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """Coalesce concurrent calls that have the same key.
+    The first caller runs the function, the callers arriving while it runs wait and get the same result
+    (or exception) instead of starting their own call."""
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, func, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                is_leader = False
+            else:
+                call = self.calls[key] = _Call()
+                self.executed += 1
+                is_leader = True
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def get_stats(self, max_keys=20):
+        """Return the counters and the waiter count of the busiest in-flight keys."""
+
+        with self.lock:
+            waiters = sorted(((call.waiters, key) for key, call in self.calls.items()), reverse=True)[:max_keys]
+            return {
+                'in_flight': len(self.calls),
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                'waiters_per_key': [{'key': str(key)[:100], 'waiters': count} for count, key in waiters],
+            }
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines running on one event loop."""
+
+    def __init__(self):
+        self.futures = {}
+        self.waiters = {}
+
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key, func, *args):
+        future = self.futures.get(key)
+        if future is not None:
+            self.waiters[key] += 1
+            self.coalesced += 1
+            # Shielded, so a cancelled waiter does not cancel the call the others wait for
+            return await asyncio.shield(future)
+
+        future = self.futures[key] = asyncio.ensure_future(func(*args))
+        self.waiters[key] = 0
+        self.executed += 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            del self.futures[key]
+            del self.waiters[key]
+
+    def get_stats(self, max_keys=20):
+        waiters = sorted(((count, key) for key, count in self.waiters.items()), reverse=True)[:max_keys]
+        return {
+            'in_flight': len(self.futures),
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+            'waiters_per_key': [{'key': str(key)[:100], 'waiters': count} for count, key in waiters],
+        }
@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """A thread-safe in-memory cache whose entries expire after ttl seconds.
+    Once max_size entries are stored, the least recently used one is evicted."""
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # key -> (expires_at, value), ordered from the least to the most recently used
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return the cached value, or default if the key is missing or expired."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """Like get(), but without touching the LRU order or the hit/miss counters."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+        return entry[1]
+
+    def put(self, key, value, ttl=None):
+        """Store a value, evicting the least recently used entries when the cache is full."""
+
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Remove a key and return its value."""
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_stats(self):
+        """Return the size and hit/miss counters of the cache."""
+
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,188 @@
+import json
+import time
+
+import asyncpg
+
+from db_module.user_store import USER_COLUMNS, quota_timezone, quota_day
+from db_module.db_operations import USER_EXPRESSIONS
+
+USER_RETURNING = ', '.join(USER_EXPRESSIONS.get(column, "{0}").format(column) for column in USER_COLUMNS)
+
+# The quota left today of a user row u, like db_operations.QUOTA_LEFT
+QUOTA_LEFT = "CASE WHEN u.quotaday = $6::date THEN u.quota ELSE $3::integer END"
+
+class AsyncPostgreSQLHandler:
+    """asyncpg counterpart of the user state operations of PostgreSQLHandler, for the asyncio app.
+    Waiting for a connection or a query only suspends the calling coroutine, so thousands of messages can be
+    in flight with a pool of a few connections. asyncpg prepares and caches every statement per connection."""
+
+    def __init__(self, database_url, min_connections=1, max_connections=10, quota_timezone_name=None):
+        self.database_url = database_url
+        self.quota_timezone = quota_timezone(quota_timezone_name)
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.pool = None
+
+        # Pool wait-time stats, only touched by the event loop thread
+        self.checkouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    async def open(self):
+        """Create the pool, must be called from the event loop that will use it."""
+
+        self.pool = await asyncpg.create_pool(
+            self.database_url,
+            min_size=self.min_connections,
+            max_size=self.max_connections,
+            init=self._init_connection
+        )
+
+    @staticmethod
+    async def _init_connection(connection):
+        # Read and write the jsonb history as Python lists, like psycopg2 does
+        await connection.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+    async def fetch(self, query, *args):
+        start = time.monotonic()
+        async with self.pool.acquire() as connection:
+            wait_time = time.monotonic() - start
+            self.checkouts += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            return await connection.fetch(query, *args)
+
+    async def consume_user_quota(self, user_id, user_name, enter_aimode=False, default_quota=50):
+        """Same statement and result as PostgreSQLHandler.consume_user_quota."""
+
+        query = """
+            WITH previous AS (
+                SELECT userid AS prev_userid, {quota_left} AS prev_quota, aimode AS prev_aimode
+                FROM users AS u WHERE userid = $1 FOR UPDATE
+            ), updated AS (
+                UPDATE users SET
+                    username = $2,
+                    quota = CASE WHEN prev_quota > 0 AND (prev_aimode OR $4::boolean) THEN prev_quota - 1 ELSE prev_quota END,
+                    aimode = CASE WHEN prev_quota > 0 THEN prev_aimode OR $4::boolean ELSE FALSE END,
+                    lastaimsgtime = CASE WHEN prev_quota > 0 AND (prev_aimode OR $4::boolean)
+                        THEN to_timestamp($5::double precision) ELSE lastaimsgtime END,
+                    version = version + 1,
+                    quotaday = $6::date
+                FROM previous
+                WHERE userid = prev_userid
+                RETURNING {returning},
+                    prev_quota > 0 AND (prev_aimode OR $4::boolean) AS consumed,
+                    prev_aimode OR $4::boolean AS requested_ai
+            ), inserted AS (
+                INSERT INTO users (userid, username, quota, aimode, lastaimsgtime, version, quotaday)
+                SELECT
+                    $1, $2,
+                    CASE WHEN $4::boolean THEN $3::integer - 1 ELSE $3::integer END,
+                    $4::boolean,
+                    CASE WHEN $4::boolean THEN to_timestamp($5::double precision) END,
+                    1,
+                    $6::date
+                WHERE NOT EXISTS (SELECT 1 FROM previous)
+                ON CONFLICT (userid) DO NOTHING
+                RETURNING {returning}, $4::boolean AS consumed, $4::boolean AS requested_ai
+            )
+            SELECT * FROM updated UNION ALL SELECT * FROM inserted
+        """.format(returning=USER_RETURNING, quota_left=QUOTA_LEFT)
+
+        # A new user inserted by a concurrent message returns nothing here, the second try updates its row
+        for attempt in range(2):
+            rows = await self.fetch(
+                query, user_id, user_name, default_quota, enter_aimode, time.time(), quota_day(self.quota_timezone)
+            )
+            if rows:
+                return dict(rows[0])
+        return None
+
+    async def refund_user_quota(self, user_id, default_quota=50):
+        """Same statement and result as PostgreSQLHandler.refund_user_quota."""
+
+        query = """
+            UPDATE users SET quota = LEAST(quota + 1, $2::integer), version = version + 1
+            WHERE userid = $1 AND quotaday = $3::date
+            RETURNING {returning}
+        """.format(returning=USER_RETURNING)
+
+        rows = await self.fetch(query, user_id, default_quota, quota_day(self.quota_timezone))
+        return dict(rows[0]) if rows else None
+
+    async def get_user(self, user_id):
+        """Same result as PostgreSQLHandler.get_user."""
+
+        rows = await self.fetch("SELECT {returning} FROM users WHERE userid = $1".format(returning=USER_RETURNING), user_id)
+        return dict(rows[0]) if rows else None
+
+    async def expire_idle_users(self, cutoff):
+        """Same statement and result as PostgreSQLHandler.expire_idle_users."""
+
+        query = """
+            UPDATE users SET aimode = FALSE, version = version + 1
+            WHERE aimode AND lastaimsgtime < to_timestamp($1::double precision)
+            RETURNING {returning}
+        """.format(returning=USER_RETURNING)
+
+        rows = await self.fetch(query, cutoff)
+        return [dict(row) for row in rows]
+
+    async def save_conversation(self, user_id, history):
+        await self.fetch("UPDATE users SET history = $2 WHERE userid = $1", user_id, history)
+
+    async def save_conversations(self, histories):
+        """Same statement as PostgreSQLHandler.save_conversations."""
+
+        await self.fetch("""
+            UPDATE users SET history = v.history::jsonb
+            FROM unnest($1::text[], $2::text[]) AS v(userid, history)
+            WHERE users.userid = v.userid
+        """, list(histories), [json.dumps(history) for history in histories.values()])
+
+    async def enqueue_outbound_message(self, kind, user_id, token, texts, next_attempt_at):
+        """Same statement as PostgreSQLHandler.enqueue_outbound_message."""
+
+        await self.fetch("""
+            INSERT INTO outbound_messages (kind, userid, token, texts, created_at, next_attempt_at)
+            VALUES ($1, $2, $3, $4, to_timestamp($5::double precision), to_timestamp($6::double precision))
+        """, kind, user_id, token, texts, time.time(), next_attempt_at)
+
+    async def claim_outbound_messages(self, limit, now, lease=60):
+        """Same statement and result as PostgreSQLHandler.claim_outbound_messages."""
+
+        rows = await self.fetch("""
+            UPDATE outbound_messages SET next_attempt_at = to_timestamp($3::double precision)
+            WHERE id IN (
+                SELECT id FROM outbound_messages WHERE next_attempt_at <= to_timestamp($2::double precision)
+                ORDER BY next_attempt_at LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, kind, userid, token, texts, attempts,
+                EXTRACT(EPOCH FROM created_at)::double precision AS created_at
+        """, limit, now, now + lease)
+        return [dict(row) for row in rows]
+
+    async def reschedule_outbound_message(self, message_id, kind, token, attempts, next_attempt_at):
+        await self.fetch("""
+            UPDATE outbound_messages SET kind = $2, token = $3, attempts = $4,
+                next_attempt_at = to_timestamp($5::double precision)
+            WHERE id = $1
+        """, message_id, kind, token, attempts, next_attempt_at)
+
+    async def delete_outbound_message(self, message_id):
+        await self.fetch("DELETE FROM outbound_messages WHERE id = $1", message_id)
+
+    def get_stats(self):
+        return {
+            'max_connections': self.max_connections,
+            'size': self.pool.get_size() if self.pool is not None else 0,
+            'idle': self.pool.get_idle_size() if self.pool is not None else 0,
+            'checkouts': self.checkouts,
+            'avg_wait_seconds': self.total_wait_time / self.checkouts if self.checkouts else 0.0,
+            'max_wait_seconds': self.max_wait_time,
+        }
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
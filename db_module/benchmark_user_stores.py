@@ -0,0 +1,85 @@
+"""Run the same user state workload against every storage backend and print throughput and latency.
+
+    python -m db_module.benchmark_user_stores --backends sqlite json
+    python -m db_module.benchmark_user_stores --backends postgres --database-url postgres://...
+
+Every thread sends messages of random users: most of them check the user (get_user), the others use a quota,
+a fifth of which are 'hi ai' greetings. Every 1000 operations a thread also runs the idle users sweep."""
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from db_module.json_user_store import ShardedUserStore
+from db_module.sqlite_store import SQLiteUserStore
+from metrics_module.histogram import LatencyHistogram
+
+# From 10 microseconds to 1 second, the embedded stores answer in microseconds
+BENCHMARK_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+def create_store(backend, directory, database_url=None):
+    if backend == 'sqlite':
+        return SQLiteUserStore(os.path.join(directory, 'users.db'))
+    if backend == 'json':
+        return ShardedUserStore(os.path.join(directory, 'userInfo.json'))
+    if backend == 'postgres':
+        from db_module.db_operations import PostgreSQLHandler
+        return PostgreSQLHandler(database_url, max_connections=16)
+    raise ValueError(f"Unknown backend {backend}")
+
+def run_workload(store, num_threads, operations, num_users, read_ratio):
+    histograms = {name: LatencyHistogram(BENCHMARK_BUCKETS) for name in ('get_user', 'consume_user_quota', 'expire_idle_users')}
+
+    def worker(seed):
+        rng = random.Random(seed)
+        for i in range(operations):
+            user_id = f"U{rng.randrange(num_users)}"
+            if rng.random() < read_ratio:
+                with histograms['get_user'].time():
+                    store.get_user(user_id)
+            else:
+                with histograms['consume_user_quota'].time():
+                    store.consume_user_quota(user_id, 'benchmark', enter_aimode=rng.random() < 0.2, default_quota=10 ** 9)
+            if i % 1000 == 999:
+                with histograms['expire_idle_users'].time():
+                    store.expire_idle_users(time.time() - 300)
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(num_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, histograms
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backends', nargs='+', default=['sqlite', 'json'], choices=['sqlite', 'json', 'postgres'])
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--operations', type=int, default=5000, help="operations per thread")
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--read-ratio', type=float, default=0.5)
+    args = parser.parse_args()
+
+    for backend in args.backends:
+        with tempfile.TemporaryDirectory() as directory:
+            store = create_store(backend, directory, args.database_url)
+            store.ensure_user_schema()
+            try:
+                elapsed, histograms = run_workload(store, args.threads, args.operations, args.users, args.read_ratio)
+            finally:
+                store.close_connection()
+
+        total = sum(histogram.count for histogram in histograms.values())
+        print(f"{backend}: {total} operations in {elapsed:.2f}s, {total / elapsed:.0f} ops/s")
+        for name, histogram in histograms.items():
+            stats = histogram.get_stats()
+            print(f"  {name:<20} count={stats['count']:<8} avg={stats['avg_seconds'] * 1000:.3f}ms "
+                  f"p50<={stats['p50_seconds']}s p99<={stats['p99_seconds']}s")
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,44 @@
+import json
+import re
 import time
+import threading
+from contextlib import contextmanager
 import psycopg2
-from psycopg2 import sql
+from psycopg2 import sql, pool, extensions
+from psycopg2.extras import Json
 
-class PostgreSQLHandler:
+from db_module.user_store import UserStore, USER_COLUMNS, quota_timezone, quota_day
+from db_module.migrations import run_migrations
+from metrics_module.histogram import LatencyHistogram
+
+# lastaimsgtime is a timestamptz, it is converted from/to epoch seconds at the DB boundary,
+# and the quotaday date is returned as an ISO date like the other stores do
+USER_EXPRESSIONS = {
+    'lastaimsgtime': "EXTRACT(EPOCH FROM {0})::double precision AS {0}",
+    'quotaday': "to_char({0}, 'YYYY-MM-DD') AS {0}",
+}
+USER_RETURNING = sql.SQL(', ').join(
+    sql.SQL(USER_EXPRESSIONS.get(column, "{0}")).format(sql.Identifier(column))
+    for column in USER_COLUMNS
+)
+
+# The quota left today of a user row u, a quota counted for an older day starts again from %(quota)s
+QUOTA_LEFT = sql.SQL("CASE WHEN u.quotaday = %(today)s::date THEN u.quota ELSE %(quota)s::integer END")
+
+# Latency buckets of the DB operations, from 0.5 ms
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# A named placeholder of a query, e.g. %(userid)s
+NAMED_PLACEHOLDER = re.compile(r'%\((\w+)\)s')
+
+class PreparingConnection(extensions.connection):
+    """A connection that remembers the statements prepared in its server session."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+class PostgreSQLHandler(UserStore):
     # def __init__(self, dbname, user, password, host, port):
     #     self.connection = psycopg2.connect(
     #         dbname=dbname,
@@ -12,9 +48,40 @@ class PostgreSQLHandler:
     #         port=port
     #     )
     #     self.cursor = self.connection.cursor()
-    def __init__(self, database_url):
-        self.connection = psycopg2.connect(database_url)
-        self.cursor = self.connection.cursor()
+    def __init__(self, database_url, min_connections=1, max_connections=10, prepare_statements=True,
+                 quota_timezone_name=None, metrics=None):
+        self.pool = pool.ThreadedConnectionPool(min_connections, max_connections, database_url,
+                                                connection_factory=PreparingConnection)
+        self.max_connections = max_connections
+
+        # ThreadedConnectionPool raises instead of waiting when every connection is in use,
+        # so callers first wait here for a free slot.
+        self.pool_slots = threading.BoundedSemaphore(max_connections)
+
+        # Pool usage and wait-time stats, guarded by stats_lock
+        self.stats_lock = threading.Lock()
+        self.in_use = 0
+        self.checkouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.reconnects = 0
+
+        # Turned off behind a pooler that does not keep the server session (e.g. pgbouncer in transaction mode)
+        self.prepare_statements = prepare_statements
+
+        # The time zone of the quota days
+        self.quota_timezone = quota_timezone(quota_timezone_name)
+
+        # Prepared statements: parameter order of every statement, and how often each one
+        # was prepared (once per connection) and executed
+        self.statement_params = {}
+        self.statement_prepares = {}
+        self.statement_executions = {}
+
+        # Latency and errors of every operation (the method running the query), in the metrics registry if any
+        self.metrics = metrics
+        self.operation_latency = {}
+        self.operation_errors = {}
 
     def create_table(self, table_name, columns):
         query = sql.SQL("CREATE TABLE IF NOT EXISTS {} ({})").format(
@@ -26,17 +93,70 @@ class PostgreSQLHandler:
                 ) for column_name, column_type in columns.items()
             )
         )
-        self.execute_query(query)
+        self.execute_query(query, operation='create_table')
+
+    def add_column(self, table_name, column_name, column_type):
+        query = sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}").format(
+            sql.Identifier(table_name),
+            sql.Identifier(column_name),
+            sql.SQL(column_type)
+        )
+        self.execute_query(query, operation='add_column')
+
+    def create_index(self, index_name, table_name, columns, unique=False, where=None):
+        query = sql.SQL("CREATE {} IF NOT EXISTS {} ON {} ({})").format(
+            sql.SQL("UNIQUE INDEX" if unique else "INDEX"),
+            sql.Identifier(index_name),
+            sql.Identifier(table_name),
+            sql.SQL(', ').join(map(sql.Identifier, columns))
+        )
+
+        # Partial index
+        if where:
+            query += sql.SQL(" WHERE {}").format(sql.SQL(where))
+
+        self.execute_query(query, operation='create_index')
+
+    def ensure_user_schema(self):
+        """Bring the schema up to date with the versioned migrations."""
+
+        run_migrations(self)
+
+    @staticmethod
+    def where_clause(where):
+        """Build a parameterized WHERE clause from a {column: value} dict, the conditions are ANDed.
+        None matches NULL and a list or tuple matches any of its values, an empty dict matches every row.
+        Return the clause and its parameters."""
+
+        conditions = []
+        params = {}
+        for i, (column, value) in enumerate(where.items()):
+            param = f'where_{i}'
+            if value is None:
+                conditions.append(sql.SQL("{} IS NULL").format(sql.Identifier(column)))
+                continue
+            if isinstance(value, (list, tuple)):
+                conditions.append(sql.SQL("{} = ANY({})").format(sql.Identifier(column), sql.Placeholder(param)))
+                value = list(value)
+            else:
+                conditions.append(sql.SQL("{} = {}").format(sql.Identifier(column), sql.Placeholder(param)))
+            params[param] = value
+
+        if not conditions:
+            return sql.SQL(""), params
+        return sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions), params
 
     def insert_data(self, table_name, data):
         query = sql.SQL("INSERT INTO {} ({}) VALUES ({})").format(
             sql.Identifier(table_name),
             sql.SQL(', ').join(map(sql.Identifier, data.keys())),
-            sql.SQL(', ').join(map(sql.Literal, data.values()))
+            sql.SQL(', ').join(map(sql.Placeholder, data.keys()))
         )
-        self.execute_query(query)
+        self.execute_query(query, data, operation='insert_data')
+
+    def select_data(self, table_name, columns=None, where=None):
+        """Select the rows matching where (a {column: value} dict, see where_clause), every row if it is None."""
 
-    def select_data(self, table_name, columns=None, condition=None):
         if columns:
             query = sql.SQL("SELECT {} FROM {}").format(
                 sql.SQL(', ').join(map(sql.Identifier, columns)),
@@ -45,46 +165,487 @@ class PostgreSQLHandler:
         else:
             query = sql.SQL("SELECT * FROM {}").format(sql.Identifier(table_name))
 
-        if condition:
-            query += sql.SQL(" WHERE {}").format(sql.SQL(condition))
+        where_sql, params = self.where_clause(where or {})
+        return self.execute_query(query + where_sql, params, fetchall=True, operation='select_data')
 
-        return self.execute_query(query, fetchall=True)
+    def update_data(self, table_name, update_data, where):
+        """Update the rows matching where, an empty dict updates every row."""
 
-    def update_data(self, table_name, update_data, condition):
-        query = sql.SQL("UPDATE {} SET {} WHERE {}").format(
+        where_sql, params = self.where_clause(where)
+        query = sql.SQL("UPDATE {} SET {}").format(
             sql.Identifier(table_name),
             sql.SQL(', ').join(
                 sql.SQL("{} = {}").format(
                     sql.Identifier(column),
-                    sql.Literal(value)
-                ) for column, value in update_data.items()
-            ),
-            sql.SQL(condition)
+                    sql.Placeholder(f'set_{column}')
+                ) for column in update_data
+            )
         )
-        self.execute_query(query)
+        params.update({f'set_{column}': value for column, value in update_data.items()})
+        self.execute_query(query + where_sql, params, operation='update_data')
 
-    def delete_data(self, table_name, condition):
-        query = sql.SQL("DELETE FROM {} WHERE {}").format(
-            sql.Identifier(table_name),
-            sql.SQL(condition)
-        )
-        self.execute_query(query)
+    def delete_data(self, table_name, where):
+        """Delete the rows matching where, an empty dict deletes every row."""
+
+        where_sql, params = self.where_clause(where)
+        query = sql.SQL("DELETE FROM {}").format(sql.Identifier(table_name))
+        self.execute_query(query + where_sql, params, operation='delete_data')
+
+    def consume_user_quota(self, user_id, user_name, enter_aimode=False, default_quota=50):
+        """Use one message quota of the user in a single atomic statement.
+        The user is added if it does not exist yet and its display name is refreshed.
+        The quota left is default_quota again when quotaday is not today (of the quota time zone).
+        A quota is only used when the user is in AI mode (or enters it now) and the quota is above zero,
+        in that case aimode/lastaimsgtime are set as well. A user in AI mode without quota leaves AI mode.
+        Needs the unique index on users.userid.
+        Return the resulting row as a dict, with 'consumed' telling if a quota was used
+        and 'requested_ai' telling if the user was (or entered) in AI mode."""
+
+        # "previous" locks the row and is joined by the UPDATE, so the flags are computed from the row as it was
+        # before this statement. (A CTE only read from RETURNING would be scanned after the update and find nothing.)
+        # The row lock makes concurrent messages of one user queue up, each one sees the state left by the one before.
+        query = sql.SQL("""
+            WITH previous AS (
+                SELECT userid AS prev_userid, {quota_left} AS prev_quota, aimode AS prev_aimode
+                FROM users AS u WHERE userid = %(userid)s FOR UPDATE
+            ), updated AS (
+                UPDATE users SET
+                    username = %(username)s,
+                    quota = CASE WHEN prev_quota > 0 AND (prev_aimode OR %(aimode)s::boolean)
+                        THEN prev_quota - 1 ELSE prev_quota END,
+                    aimode = CASE WHEN prev_quota > 0 THEN prev_aimode OR %(aimode)s::boolean ELSE FALSE END,
+                    lastaimsgtime = CASE WHEN prev_quota > 0 AND (prev_aimode OR %(aimode)s::boolean)
+                        THEN to_timestamp(%(now)s::double precision) ELSE lastaimsgtime END,
+                    version = version + 1,
+                    quotaday = %(today)s::date
+                FROM previous
+                WHERE userid = prev_userid
+                RETURNING {returning},
+                    prev_quota > 0 AND (prev_aimode OR %(aimode)s::boolean) AS consumed,
+                    prev_aimode OR %(aimode)s::boolean AS requested_ai
+            ), inserted AS (
+                INSERT INTO users (userid, username, quota, aimode, lastaimsgtime, version, quotaday)
+                SELECT
+                    %(userid)s, %(username)s,
+                    CASE WHEN %(aimode)s::boolean THEN %(quota)s::integer - 1 ELSE %(quota)s::integer END,
+                    %(aimode)s::boolean,
+                    CASE WHEN %(aimode)s::boolean THEN to_timestamp(%(now)s::double precision) END,
+                    1,
+                    %(today)s::date
+                WHERE NOT EXISTS (SELECT 1 FROM previous)
+                ON CONFLICT (userid) DO NOTHING
+                RETURNING {returning}, %(aimode)s::boolean AS consumed, %(aimode)s::boolean AS requested_ai
+            )
+            SELECT * FROM updated UNION ALL SELECT * FROM inserted
+        """).format(returning=USER_RETURNING, quota_left=QUOTA_LEFT)
+        params = {
+            'userid': user_id,
+            'username': user_name,
+            'quota': default_quota,
+            'aimode': enter_aimode,
+            'now': time.time(),
+            'today': quota_day(self.quota_timezone),
+        }
+
+        # A new user inserted by a concurrent message returns nothing here, the second try updates its row
+        for attempt in range(2):
+            rows = self.execute_query(query, params, fetchall=True, prepare_as='consume_user_quota')
+            if rows is None:
+                return None
+            if rows:
+                return dict(zip(USER_COLUMNS + ('consumed', 'requested_ai'), rows[0]))
+        return None
+
+    def get_user(self, user_id):
+        query = sql.SQL("SELECT {returning} FROM users WHERE userid = %(userid)s").format(returning=USER_RETURNING)
+
+        rows = self.execute_query(query, {'userid': user_id}, fetchall=True, prepare_as='get_user')
+        if not rows:
+            return None
+        return dict(zip(USER_COLUMNS, rows[0]))
+
+    def upsert_user(self, user_id, user_name, default_quota=50):
+        query = sql.SQL("""
+            INSERT INTO users AS u (userid, username, quota, aimode, version)
+            VALUES (%(userid)s, %(username)s, %(quota)s, FALSE, 1)
+            ON CONFLICT (userid) DO UPDATE SET username = EXCLUDED.username, version = u.version + 1
+            RETURNING {returning}
+        """).format(returning=USER_RETURNING)
+
+        rows = self.execute_query(query, {'userid': user_id, 'username': user_name, 'quota': default_quota}, fetchall=True, operation='upsert_user')
+        if not rows:
+            return None
+        return dict(zip(USER_COLUMNS, rows[0]))
+
+    def refund_user_quota(self, user_id, default_quota=50):
+        """Give back a quota used today, return the resulting row as a dict (None if there is nothing to give back).
+        A quota of an older day is not touched, it starts again from default_quota anyway."""
+
+        query = sql.SQL("""
+            UPDATE users SET quota = LEAST(quota + 1, %(quota)s::integer), version = version + 1
+            WHERE userid = %(userid)s AND quotaday = %(today)s::date
+            RETURNING {returning}
+        """).format(returning=USER_RETURNING)
+        params = {
+            'userid': user_id,
+            'quota': default_quota,
+            'today': quota_day(self.quota_timezone),
+        }
+
+        rows = self.execute_query(query, params, fetchall=True, prepare_as='refund_user_quota')
+        if not rows:
+            return None
+        return dict(zip(USER_COLUMNS, rows[0]))
+
+    def set_user_aimode(self, user_id, aimode):
+        """Turn the user's AI mode on or off, return the resulting row as a dict (None if there is no such user)."""
+
+        query = sql.SQL("""
+            UPDATE users SET aimode = %(aimode)s, version = version + 1
+            WHERE userid = %(userid)s
+            RETURNING {returning}
+        """).format(returning=USER_RETURNING)
+
+        rows = self.execute_query(query, {'userid': user_id, 'aimode': aimode}, fetchall=True, prepare_as='set_user_aimode')
+        if not rows:
+            return None
+        return dict(zip(USER_COLUMNS, rows[0]))
+
+    def expire_idle_users(self, cutoff):
+        """Take every AI-mode user whose last AI msg is older than cutoff (epoch seconds) out of AI mode,
+        in one statement served by the partial index on lastaimsgtime WHERE aimode.
+        Return the resulting rows as dicts."""
+
+        query = sql.SQL("""
+            UPDATE users SET aimode = FALSE, version = version + 1
+            WHERE aimode AND lastaimsgtime < to_timestamp(%(cutoff)s::double precision)
+            RETURNING {returning}
+        """).format(returning=USER_RETURNING)
+
+        rows = self.execute_query(query, {'cutoff': cutoff}, fetchall=True, prepare_as='expire_idle_users')
+        return [dict(zip(USER_COLUMNS, row)) for row in rows or []]
 
-    def execute_query(self, query, fetchall=False):
+    def load_conversation(self, user_id):
+        """Return the conversation history stored next to the users row."""
+
+        query = sql.SQL("SELECT history FROM users WHERE userid = %(userid)s")
+
+        rows = self.execute_query(query, {'userid': user_id}, fetchall=True, prepare_as='load_conversation')
+        return rows[0][0] if rows else None
+
+    def save_conversation(self, user_id, history):
+        query = sql.SQL("UPDATE users SET history = %(history)s WHERE userid = %(userid)s")
+        self.execute_query(query, {'userid': user_id, 'history': Json(history)}, prepare_as='save_conversation')
+
+    def save_conversations(self, histories):
+        """Save the histories of many users ({user_id: history}) in one statement."""
+
+        query = sql.SQL("""
+            UPDATE users SET history = v.history::jsonb
+            FROM unnest(%(userids)s::text[], %(histories)s::text[]) AS v(userid, history)
+            WHERE users.userid = v.userid
+            RETURNING users.userid
+        """)
+        params = {
+            'userids': list(histories),
+            'histories': [json.dumps(history) for history in histories.values()],
+        }
+        # The rows are only fetched to tell a failure (None) from success
+        if self.execute_query(query, params, fetchall=True, prepare_as='save_conversations') is None:
+            raise RuntimeError("Could not save the conversation histories")
+
+    def get_cached_answer(self, source_id, question, min_created_at):
+        """Return the shared cached answer of the question, if it was stored after min_created_at (epoch seconds)."""
+
+        query = sql.SQL("""
+            SELECT answer FROM answer_cache
+            WHERE source_id = %(source_id)s AND question = %(question)s
+                AND created_at >= to_timestamp(%(min_created_at)s::double precision)
+        """)
+        params = {'source_id': source_id, 'question': question, 'min_created_at': min_created_at}
+
+        rows = self.execute_query(query, params, fetchall=True, prepare_as='get_cached_answer')
+        return rows[0][0] if rows else None
+
+    def put_cached_answer(self, source_id, question, answer):
+        query = sql.SQL("""
+            INSERT INTO answer_cache (source_id, question, answer, created_at)
+            VALUES (%(source_id)s, %(question)s, %(answer)s, to_timestamp(%(now)s::double precision))
+            ON CONFLICT (source_id, question) DO UPDATE SET answer = EXCLUDED.answer, created_at = EXCLUDED.created_at
+        """)
+        params = {'source_id': source_id, 'question': question, 'answer': answer, 'now': time.time()}
+        self.execute_query(query, params, prepare_as='put_cached_answer')
+
+    def delete_stale_answers(self, source_id, min_created_at):
+        """Delete the shared cached answers of other source documents, and the ones older than min_created_at."""
+
+        query = sql.SQL("""
+            DELETE FROM answer_cache
+            WHERE source_id <> %(source_id)s OR created_at < to_timestamp(%(min_created_at)s::double precision)
+        """)
+        self.execute_query(query, {'source_id': source_id, 'min_created_at': min_created_at}, operation='delete_stale_answers')
+
+    def enqueue_outbound_message(self, kind, user_id, token, texts, next_attempt_at):
+        query = sql.SQL("""
+            INSERT INTO outbound_messages (kind, userid, token, texts, created_at, next_attempt_at)
+            VALUES (%(kind)s, %(userid)s, %(token)s, %(texts)s, to_timestamp(%(now)s::double precision),
+                    to_timestamp(%(next_attempt_at)s::double precision))
+        """)
+        params = {
+            'kind': kind,
+            'userid': user_id,
+            'token': token,
+            'texts': Json(texts),
+            'now': time.time(),
+            'next_attempt_at': next_attempt_at,
+        }
+        self.execute_query(query, params, operation='enqueue_outbound_message')
+
+    def claim_outbound_messages(self, limit, now, lease=60):
+        """Return up to limit outbox messages due at now (epoch seconds) as dicts.
+        They are hidden from the other dispatchers for lease seconds, so a dispatcher that dies
+        while sending only delays them."""
+
+        query = sql.SQL("""
+            UPDATE outbound_messages SET next_attempt_at = to_timestamp(%(lease_until)s::double precision)
+            WHERE id IN (
+                SELECT id FROM outbound_messages WHERE next_attempt_at <= to_timestamp(%(now)s::double precision)
+                ORDER BY next_attempt_at LIMIT %(limit)s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, kind, userid, token, texts, attempts, EXTRACT(EPOCH FROM created_at)::double precision
+        """)
+        params = {'limit': limit, 'now': now, 'lease_until': now + lease}
+
+        rows = self.execute_query(query, params, fetchall=True, operation='claim_outbound_messages')
+        columns = ('id', 'kind', 'userid', 'token', 'texts', 'attempts', 'created_at')
+        return [dict(zip(columns, row)) for row in rows or []]
+
+    def reschedule_outbound_message(self, message_id, kind, token, attempts, next_attempt_at):
+        query = sql.SQL("""
+            UPDATE outbound_messages SET kind = %(kind)s, token = %(token)s, attempts = %(attempts)s,
+                next_attempt_at = to_timestamp(%(next_attempt_at)s::double precision)
+            WHERE id = %(id)s
+        """)
+        params = {'id': message_id, 'kind': kind, 'token': token, 'attempts': attempts, 'next_attempt_at': next_attempt_at}
+        self.execute_query(query, params, operation='reschedule_outbound_message')
+
+    def delete_outbound_message(self, message_id):
+        self.execute_query(sql.SQL("DELETE FROM outbound_messages WHERE id = %(id)s"), {'id': message_id}, operation='delete_outbound_message')
+
+    def count_outbound_messages(self):
+        rows = self.execute_query(sql.SQL("SELECT count(*) FROM outbound_messages"), fetchall=True, operation='count_outbound_messages')
+        return rows[0][0] if rows else None
+
+    def sync_rate_limit_buckets(self, buckets, now):
+        """Subtract the tokens taken by a worker from the shared rate limit buckets, refilled up to now
+        (epoch seconds). buckets is a list of (key, taken, rate, burst), sorted by key so concurrent syncs
+        lock the rows in the same order. Return {key: tokens left}."""
+
+        # A bucket two workers create at once only keeps the tokens taken by the first, the limits are approximate
+        query = sql.SQL("""
+            WITH s AS (
+                SELECT * FROM unnest(%(keys)s::text[], %(taken)s::double precision[],
+                                     %(rates)s::double precision[], %(bursts)s::double precision[])
+                    AS s(key, taken, rate, burst)
+            ), updated AS (
+                UPDATE rate_limit_buckets AS b
+                SET tokens = GREATEST(LEAST(s.burst, b.tokens + GREATEST(%(now)s::double precision - EXTRACT(EPOCH FROM b.updated_at), 0) * s.rate) - s.taken, 0),
+                    updated_at = GREATEST(b.updated_at, to_timestamp(%(now)s::double precision))
+                FROM s WHERE b.key = s.key
+                RETURNING b.key, b.tokens
+            ), inserted AS (
+                INSERT INTO rate_limit_buckets (key, tokens, updated_at)
+                SELECT key, GREATEST(burst - taken, 0), to_timestamp(%(now)s::double precision) FROM s
+                WHERE key NOT IN (SELECT key FROM updated)
+                ON CONFLICT (key) DO NOTHING
+                RETURNING key, tokens
+            )
+            SELECT key, tokens FROM updated UNION ALL SELECT key, tokens FROM inserted
+        """)
+        params = {
+            'keys': [bucket[0] for bucket in buckets],
+            'taken': [bucket[1] for bucket in buckets],
+            'rates': [bucket[2] for bucket in buckets],
+            'bursts': [bucket[3] for bucket in buckets],
+            'now': now,
+        }
+
+        rows = self.execute_query(query, params, fetchall=True, prepare_as='sync_rate_limit_buckets')
+        if rows is None:
+            raise RuntimeError("Could not sync the rate limit buckets")
+        return dict(rows)
+
+    def claim_job_run(self, name, due_at):
+        """Record that the run of a job due at due_at (epoch seconds) is taken, return False if a worker
+        already took it or a later one. The conditional update only lets one worker win.
+        A job without a row yet is only seeded with due_at, its first run is the next one due, not a missed one."""
+
+        query = sql.SQL("""
+            WITH seeded AS (
+                INSERT INTO scheduled_jobs (name, last_due_at) VALUES (%(name)s, to_timestamp(%(due_at)s))
+                ON CONFLICT (name) DO NOTHING
+                RETURNING name
+            )
+            UPDATE scheduled_jobs SET last_due_at = to_timestamp(%(due_at)s)
+            WHERE name = %(name)s AND last_due_at < to_timestamp(%(due_at)s) AND NOT EXISTS (SELECT 1 FROM seeded)
+            RETURNING name
+        """)
+
+        rows = self.execute_query(query, {'name': name, 'due_at': due_at}, fetchall=True, operation='claim_job_run')
+        if rows is None:
+            raise RuntimeError(f"Could not claim job {name}")
+        return bool(rows)
+
+    @contextmanager
+    def get_connection(self):
+        """Borrow a connection from the pool, wait for one if all of them are in use.
+        A connection that was dropped by the server is discarded instead of being put back."""
+
+        start = time.monotonic()
+        self.pool_slots.acquire()
         try:
-            self.cursor.execute(query)
-            if fetchall:
-                return self.cursor.fetchall()
-            else:
-                self.connection.commit()
-        except Exception as e:
-            self.connection.rollback()
-            print(f"Error: {e}")
-        # finally:
-        #     self.cursor.close()
+            connection = self.pool.getconn()
+        except Exception:
+            self.pool_slots.release()
+            raise
+        wait_time = time.monotonic() - start
+
+        with self.stats_lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        try:
+            yield connection
+        finally:
+            self.pool.putconn(connection, close=bool(connection.closed))
+            with self.stats_lock:
+                self.in_use -= 1
+            self.pool_slots.release()
+
+    def execute_query(self, query, params=None, fetchall=False, prepare_as=None, operation=None):
+        """Run a query and commit. A query with prepare_as runs as the server-side prepared statement of that name,
+        it is prepared once per connection so Postgres parses and plans it once instead of on every call;
+        its params must be a dict of named placeholders.
+        operation names the query in the latency and error metrics, it defaults to the prepared statement name."""
+
+        operation = operation or prepare_as or 'query'
+        start = time.perf_counter()
+        try:
+            return self._execute_query(query, params, fetchall, prepare_as, operation)
+        finally:
+            self._operation_latency(operation).observe(time.perf_counter() - start)
+
+    def _operation_latency(self, operation):
+        histogram = self.operation_latency.get(operation)
+        if histogram is None:
+            with self.stats_lock:
+                histogram = self.operation_latency.get(operation)
+                if histogram is None:
+                    if self.metrics is not None:
+                        histogram = self.metrics.histogram(
+                            'db_operation_seconds', "Latency of the PostgreSQLHandler operations.",
+                            buckets=DB_BUCKETS, operation=operation
+                        )
+                    else:
+                        histogram = LatencyHistogram(DB_BUCKETS)
+                    self.operation_latency[operation] = histogram
+        return histogram
+
+    def _count_error(self, operation):
+        with self.stats_lock:
+            self.operation_errors[operation] = self.operation_errors.get(operation, 0) + 1
+        if self.metrics is not None:
+            self.metrics.counter('db_errors_total', "Failed PostgreSQLHandler operations.", operation=operation).inc()
+
+    def _execute_query(self, query, params, fetchall, prepare_as, operation):
+        # Each query gets its own connection and cursor, retry once on a fresh connection if it was dropped
+        for attempt in range(2):
+            with self.get_connection() as connection:
+                try:
+                    with connection.cursor() as cursor:
+                        if prepare_as is None or not self.prepare_statements:
+                            cursor.execute(query, params)
+                        else:
+                            self._execute_prepared(connection, cursor, prepare_as, query, params)
+                        result = cursor.fetchall() if fetchall else None
+                    connection.commit()
+                    return result
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                    if connection.closed and attempt == 0:
+                        with self.stats_lock:
+                            self.reconnects += 1
+                        continue
+                    if not connection.closed:
+                        connection.rollback()
+                    print(f"Error: {e}")
+                    self._count_error(operation)
+                    return None
+                except Exception as e:
+                    connection.rollback()
+                    print(f"Error: {e}")
+                    self._count_error(operation)
+                    return None
+
+    def _execute_prepared(self, connection, cursor, name, query, params):
+        if name not in connection.prepared_statements:
+            # PREPARE takes positional $n parameters, in the order of first appearance of the named ones
+            text = query.as_string(connection) if isinstance(query, sql.Composable) else query
+            param_names = []
+
+            def to_positional(match):
+                if match.group(1) not in param_names:
+                    param_names.append(match.group(1))
+                return f"${param_names.index(match.group(1)) + 1}"
+
+            text = NAMED_PLACEHOLDER.sub(to_positional, text)
+            cursor.execute(sql.SQL("PREPARE {} AS ").format(sql.Identifier(name)) + sql.SQL(text))
+            # Committed right away, so a failing EXECUTE cannot take the prepared statement with it
+            connection.commit()
+            connection.prepared_statements.add(name)
+            with self.stats_lock:
+                self.statement_params[name] = param_names
+                self.statement_prepares[name] = self.statement_prepares.get(name, 0) + 1
+
+        param_names = self.statement_params[name]
+        if param_names:
+            execute = sql.SQL("EXECUTE {} ({})").format(
+                sql.Identifier(name),
+                sql.SQL(', ').join(sql.Placeholder() * len(param_names))
+            )
+        else:
+            execute = sql.SQL("EXECUTE {}").format(sql.Identifier(name))
+        cursor.execute(execute, [params[param_name] for param_name in param_names])
+
+        with self.stats_lock:
+            self.statement_executions[name] = self.statement_executions.get(name, 0) + 1
+
+    def get_stats(self):
+        """Return the pool usage and wait-time stats."""
+
+        with self.stats_lock:
+            return {
+                'max_connections': self.max_connections,
+                'in_use': self.in_use,
+                'checkouts': self.checkouts,
+                'avg_wait_seconds': self.total_wait_time / self.checkouts if self.checkouts else 0.0,
+                'max_wait_seconds': self.max_wait_time,
+                'reconnects': self.reconnects,
+                'operation_errors': dict(self.operation_errors),
+                'prepared_statements': {
+                    name: {
+                        'prepares': self.statement_prepares.get(name, 0),
+                        'executions': executions,
+                        # Share of the executions that reused a statement already planned on their connection
+                        'hit_rate': 1 - self.statement_prepares.get(name, 0) / executions,
+                    } for name, executions in self.statement_executions.items()
+                },
+            }
 
     def close_connection(self):
-        self.connection.close()
+        self.pool.closeall()
 
 
 # Example Usage:
@@ -105,16 +666,15 @@ class PostgreSQLHandler:
 # db_handler.insert_data('users', data_to_insert)
 
 # # Select data
-# selected_data = db_handler.select_data('users', condition=f"username = '{user_name}'")
+# selected_data = db_handler.select_data('users', where={'username': user_name})
 # print("Selected Data:", selected_data)
 # print("userName: ", selected_data[0][1])
 
 # #Update data
 # user_id = "Test1234"
 # user_name = "Test5678"
-# update_condition = "True"
 # update_data = {"quota": 50}
-# db_handler.update_data('users', update_data, update_condition)
+# db_handler.update_data('users', update_data, where={'userid': user_id})
 
 
 # # Select updated data
@@ -124,8 +684,7 @@ class PostgreSQLHandler:
 #     print("user id: ", user[1])
 
 # # Delete data
-# delete_condition = "id = 1"
-# db_handler.delete_data('example_table', delete_condition)
+# db_handler.delete_data('example_table', where={'id': 1})
 
 # Close the connection
 # db_handler.close_connection()
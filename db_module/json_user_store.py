@@ -0,0 +1,322 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import zlib
+
+from db_module.user_store import UserStore, quota_timezone, quota_day
+
+logger = logging.getLogger(__name__)
+
+class ShardedUserStore(UserStore):
+    """In-memory user records (the userInfo.json format) indexed by userId, for the JSON-file versions of the bot.
+
+    The records are split into num_shards dicts, each with its own lock, so users on different shards never wait
+    for each other and a lookup is one dict access. Every change appends the new record to the journal.
+    snapshot() atomically writes all the records to snapshot_path (a temp file renamed over it) and starts a new
+    journal. Loading reads the snapshot and replays the journals on top of it; a journal line holds the whole
+    record, so replaying a change the snapshot already has is harmless.
+    Callers never hold a lock while doing network calls: every operation takes the lock of one shard only
+    for the time of a few dict updates.
+    The UserStore operations return rows in the common format, the records keep the userInfo.json keys
+    (plus quotaDay, the day of the quota left; records written before it have their quota counted for the day
+    they are first loaded, as the Postgres migration does)."""
+
+    def __init__(self, snapshot_path, journal_path=None, num_shards=16, fsync=False, quota_timezone_name=None):
+        self.snapshot_path = snapshot_path
+        self.quota_timezone = quota_timezone(quota_timezone_name)
+        self.journal_path = journal_path or snapshot_path + '.journal'
+        self.fsync = fsync
+
+        self.shards = [{} for _ in range(num_shards)]
+        self.shard_locks = [threading.Lock() for _ in range(num_shards)]
+
+        # Journal appends are serialized, they are short buffered writes
+        self.journal_lock = threading.Lock()
+        self.journal = None
+
+        self.journaled_changes = 0
+        self.snapshots = 0
+        self.last_snapshot_seconds = 0.0
+
+    def _shard_index(self, user_id):
+        # crc32 rather than hash(), so a user is on the same shard in every process
+        return zlib.crc32(user_id.encode()) % len(self.shards)
+
+    def load(self):
+        """Load the snapshot and replay the journals, then open the journal for appending."""
+
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as json_file:
+                for user in json.load(json_file):
+                    self.shards[self._shard_index(user['userId'])][user['userId']] = user
+
+        # The previous journal is only left behind if the app stopped in the middle of a snapshot
+        replayed = 0
+        for journal_path in (self.journal_path + '.old', self.journal_path):
+            if not os.path.exists(journal_path):
+                continue
+            with open(journal_path, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        user = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash, the lines after it were added by a later rotation
+                        logger.warning("Skipping a truncated journal line of %s", journal_path)
+                        continue
+                    self.shards[self._shard_index(user['userId'])][user['userId']] = user
+                    replayed += 1
+
+        self.journal = open(self.journal_path, 'a')
+        logger.info("Loaded %d users, replayed %d journaled changes", len(self), replayed)
+
+        # The quotas of the records written before quotaDay were counted for today by the midnight reset
+        # Journaled, so a restart on another day does not count them for that day again
+        today = quota_day(self.quota_timezone).isoformat()
+        for index, shard in enumerate(self.shards):
+            with self.shard_locks[index]:
+                for user in shard.values():
+                    if 'quotaDay' not in user:
+                        user['quotaDay'] = today
+                        self._append_journal(user)
+
+    def _append_journal(self, user):
+        line = json.dumps(user) + '\n'
+        with self.journal_lock:
+            self.journal.write(line)
+            self.journal.flush()
+            if self.fsync:
+                os.fsync(self.journal.fileno())
+            self.journaled_changes += 1
+
+    @staticmethod
+    def _to_row(user):
+        return {
+            'username': user.get('userName'),
+            'userid': user['userId'],
+            'quota': user['quota'],
+            'aimode': user.get('AImode', False),
+            'lastaimsgtime': user.get('lastAImsgTime'),
+            'version': user.get('version', 0),
+            'history': user.get('history', []),
+            'quotaday': user.get('quotaDay'),
+        }
+
+    def ensure_user_schema(self):
+        # Nothing to create, the files are written by the first change and snapshot, only load them once
+        if self.journal is None:
+            self.load()
+
+    def get_user(self, user_id):
+        index = self._shard_index(user_id)
+        with self.shard_locks[index]:
+            user = self.shards[index].get(user_id)
+            return self._to_row(user) if user is not None else None
+
+    def update_user(self, user_id, update):
+        """Run update(record) on the user's record (None for a new user) under the shard lock.
+        update returns (new record or None to leave it unchanged, result), the result is returned."""
+
+        index = self._shard_index(user_id)
+        with self.shard_locks[index]:
+            user = self.shards[index].get(user_id)
+            new_user, result = update(dict(user) if user is not None else None)
+            if new_user is not None and new_user != user:
+                new_user['version'] = new_user.get('version', 0) + 1
+                self.shards[index][user_id] = new_user
+                # Journaled under the shard lock, so the journal has the changes of a user in order
+                self._append_journal(new_user)
+        return result
+
+    def upsert_user(self, user_id, user_name, default_quota=50):
+        def update(user):
+            if user is None:
+                user = {"userName": user_name, "userId": user_id, "quota": default_quota, "AImode": False}
+            user['userName'] = user_name
+            return user, user
+
+        return self._to_row(self.update_user(user_id, update))
+
+    def _start_quota_day(self, user, today, default_quota):
+        # The lazy reset, a quota counted for an older day starts again from default_quota
+        if user.get('quotaDay') != today:
+            user['quota'] = default_quota
+            user['quotaDay'] = today
+
+    def consume_user_quota(self, user_id, user_name, enter_aimode=False, default_quota=50):
+        today = quota_day(self.quota_timezone).isoformat()
+
+        def update(user):
+            requested_ai = enter_aimode or bool(user and user.get('AImode'))
+            if user is None:
+                user = {"userName": user_name, "userId": user_id, "quota": default_quota, "AImode": False}
+            user['userName'] = user_name
+            self._start_quota_day(user, today, default_quota)
+
+            consumed = requested_ai and user['quota'] > 0
+            if consumed:
+                user['quota'] -= 1
+                user['AImode'] = True
+                user['lastAImsgTime'] = time.time()
+            elif user['quota'] <= 0:
+                user['AImode'] = False
+            return user, (user, consumed, requested_ai)
+
+        user, consumed, requested_ai = self.update_user(user_id, update)
+        return dict(self._to_row(user), consumed=consumed, requested_ai=requested_ai)
+
+    def refund_user_quota(self, user_id, default_quota=50):
+        today = quota_day(self.quota_timezone).isoformat()
+
+        def update(user):
+            if user is None or user.get('quotaDay') != today:
+                return None, None
+            user['quota'] = min(user['quota'] + 1, default_quota)
+            return user, user
+
+        user = self.update_user(user_id, update)
+        return self._to_row(user) if user is not None else None
+
+    def set_user_aimode(self, user_id, aimode):
+        def update(user):
+            if user is None:
+                return None, None
+            user['AImode'] = aimode
+            return user, user
+
+        user = self.update_user(user_id, update)
+        return self._to_row(user) if user is not None else None
+
+    def consume_quota(self, user_id, user_name, enter_aimode=False, default_quota=50):
+        """Use one message quota of the user whether or not the user is in AI mode, the rule of the ChatGPT bot,
+        which counts every message. Add the user with default_quota - 1 if it is new.
+        The display name is refreshed, and when a quota is used the user enters AI mode if enter_aimode
+        and the last AI msg time is recorded. Return True if a quota was used."""
+
+        today = quota_day(self.quota_timezone).isoformat()
+
+        def update(user):
+            if user is None:
+                user = {"userName": user_name, "userId": user_id, "quota": default_quota, "AImode": False}
+            user['userName'] = user_name
+            self._start_quota_day(user, today, default_quota)
+
+            if user['quota'] == 0:
+                return user, False
+
+            user['quota'] -= 1
+            if enter_aimode:
+                user['AImode'] = True
+            user['lastAImsgTime'] = time.time()
+            return user, True
+
+        return self.update_user(user_id, update)
+
+    def expire_idle_users(self, cutoff):
+        expired_users = []
+        for index, shard in enumerate(self.shards):
+            with self.shard_locks[index]:
+                for user_id, user in shard.items():
+                    if user.get('AImode') and user.get('lastAImsgTime', 0) < cutoff:
+                        user = shard[user_id] = dict(user, AImode=False, version=user.get('version', 0) + 1)
+                        self._append_journal(user)
+                        expired_users.append(self._to_row(user))
+        return expired_users
+
+    def snapshot(self):
+        """Write every record to the snapshot file and start a new journal."""
+
+        start = time.perf_counter()
+
+        # Take all the locks for the time of a shallow copy, so the snapshot and the journal switch are consistent
+        for lock in self.shard_locks:
+            lock.acquire()
+        try:
+            with self.journal_lock:
+                users = [user for shard in self.shards for user in shard.values()]
+                self.journal.close()
+                self._rotate_journal()
+                self.journal = open(self.journal_path, 'a')
+        finally:
+            for lock in self.shard_locks:
+                lock.release()
+
+        # Records are replaced, never mutated in place, so they can be written out without the locks
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'w') as json_file:
+            json.dump(users, json_file)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+        # The changes of the previous journal are in the snapshot now
+        os.remove(self.journal_path + '.old')
+
+        self.snapshots += 1
+        self.last_snapshot_seconds = time.perf_counter() - start
+
+    def _rotate_journal(self):
+        """Move the journal to journal.old, the changes it holds are not in the snapshot file yet."""
+
+        old_path = self.journal_path + '.old'
+        if not os.path.exists(old_path):
+            os.replace(self.journal_path, old_path)
+            return
+
+        # The previous snapshot failed, so journal.old is not in the snapshot file either: add the journal after it
+        with open(old_path, 'a+') as old_file, open(self.journal_path, 'r') as journal_file:
+            old_file.seek(0, os.SEEK_END)
+            if old_file.tell():
+                old_file.seek(old_file.tell() - 1)
+                if old_file.read(1) != '\n':
+                    # Cut short by a crash, keep the following lines readable
+                    old_file.write('\n')
+            shutil.copyfileobj(journal_file, old_file)
+            old_file.flush()
+            os.fsync(old_file.fileno())
+        os.remove(self.journal_path)
+
+    def run_snapshots(self, exit_event, interval=60):
+        """Snapshot every interval seconds until exit_event is set, and once more on exit."""
+
+        while not exit_event.wait(interval):
+            try:
+                self.snapshot()
+            except Exception:
+                logger.exception("Could not snapshot the user records")
+        self.snapshot()
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def get_stats(self):
+        return {
+            'users': len(self),
+            'shards': len(self.shards),
+            'journaled_changes': self.journaled_changes,
+            'snapshots': self.snapshots,
+            'last_snapshot_seconds': self.last_snapshot_seconds,
+        }
+
+    def load_conversation(self, user_id):
+        user = self.get_user(user_id)
+        return user['history'] if user is not None else None
+
+    def save_conversation(self, user_id, history):
+        def update(user):
+            if user is None:
+                return None, None
+            user['history'] = history
+            return user, None
+
+        self.update_user(user_id, update)
+
+    def save_conversations(self, histories):
+        for user_id, history in histories.items():
+            self.save_conversation(user_id, history)
+
+    def close_connection(self):
+        with self.journal_lock:
+            self.journal.close()
@@ -0,0 +1,168 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Advisory lock key serializing the migrations of the gunicorn workers starting together
+MIGRATIONS_LOCK_ID = 4815162342
+
+# (version, description, statements), applied in order, each version in one transaction.
+# A released migration is never edited, changes go into a new version.
+# The statements are run with the parameter %(quota_timezone)s (QUOTA_TIMEZONE, NULL for the DB's TimeZone),
+# so a literal % is written %%.
+MIGRATIONS = [
+    (1, "Create the users table", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            userid text NOT NULL,
+            username text,
+            quota integer NOT NULL DEFAULT 50,
+            aimode boolean NOT NULL DEFAULT FALSE,
+            lastaimsgtime double precision
+        )
+        """,
+    ]),
+    (2, "Make userid the key of users", [
+        # Tables created before the migrations may have kept duplicates, only one row of a user stays
+        """
+        DELETE FROM users a USING users b
+        WHERE a.userid = b.userid AND a.ctid < b.ctid
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_userid_key ON users (userid)",
+        """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'users'::regclass AND contype = 'p') THEN
+                ALTER TABLE users ADD CONSTRAINT users_userid_key PRIMARY KEY USING INDEX users_userid_key;
+            END IF;
+        END $$
+        """,
+    ]),
+    (3, "Add the version and history columns of the user state", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS history jsonb NOT NULL DEFAULT '[]'",
+    ]),
+    (4, "Store lastaimsgtime as a timestamptz", [
+        """
+        DO $$
+        BEGIN
+            IF (SELECT data_type FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'lastaimsgtime')
+                IN ('double precision', 'real', 'numeric', 'bigint', 'integer') THEN
+                ALTER TABLE users ALTER COLUMN lastaimsgtime TYPE timestamptz USING to_timestamp(lastaimsgtime);
+            END IF;
+        END $$
+        """,
+    ]),
+    (5, "Index the AI-mode users by last AI msg time for the idle sweep", [
+        # Recreated, an index created before migration 4 was built on the epoch column
+        "DROP INDEX IF EXISTS users_idle_idx",
+        "CREATE INDEX users_idle_idx ON users (lastaimsgtime) WHERE aimode",
+    ]),
+    (6, "Create the outbox of the undelivered LINE messages", [
+        """
+        CREATE TABLE IF NOT EXISTS outbound_messages (
+            id bigserial PRIMARY KEY,
+            kind text NOT NULL,
+            userid text NOT NULL,
+            token text NOT NULL,
+            texts jsonb NOT NULL,
+            attempts integer NOT NULL DEFAULT 0,
+            created_at double precision NOT NULL,
+            next_attempt_at double precision NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS outbound_messages_due_idx ON outbound_messages (next_attempt_at)",
+    ]),
+    (7, "Create the shared answer cache", [
+        """
+        CREATE TABLE IF NOT EXISTS answer_cache (
+            source_id text NOT NULL,
+            question text NOT NULL,
+            answer text NOT NULL,
+            created_at double precision NOT NULL
+        )
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS answer_cache_key ON answer_cache (source_id, question)",
+    ]),
+    (8, "Record the last due time run by every scheduled job", [
+        """
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            name text PRIMARY KEY,
+            last_due_at timestamptz NOT NULL
+        )
+        """,
+    ]),
+    (9, "Add the day the quota of a user is counted for", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS quotaday date",
+        # The quotas left were counted for today by the midnight reset, they stay valid until tomorrow
+        # Today is the day of the quota time zone, as quota_day() counts it
+        """
+        UPDATE users SET quotaday = (now() AT TIME ZONE COALESCE(%(quota_timezone)s, current_setting('TimeZone')))::date
+        WHERE quotaday IS NULL
+        """,
+    ]),
+    (10, "Create the rate limit buckets shared by the workers", [
+        """
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            key text PRIMARY KEY,
+            tokens double precision NOT NULL,
+            updated_at double precision NOT NULL
+        )
+        """,
+    ]),
+    (11, "Store the outbox, answer cache and rate limit times as timestamptz", [
+        """
+        ALTER TABLE outbound_messages
+            ALTER COLUMN created_at TYPE timestamptz USING to_timestamp(created_at),
+            ALTER COLUMN next_attempt_at TYPE timestamptz USING to_timestamp(next_attempt_at)
+        """,
+        "ALTER TABLE answer_cache ALTER COLUMN created_at TYPE timestamptz USING to_timestamp(created_at)",
+        "ALTER TABLE rate_limit_buckets ALTER COLUMN updated_at TYPE timestamptz USING to_timestamp(updated_at)",
+    ]),
+]
+
+def run_migrations(db_handler, migrations=MIGRATIONS):
+    """Apply the migrations the database does not have yet, recorded in schema_migrations.
+    Return the versions applied."""
+
+    applied = []
+    params = {'quota_timezone': db_handler.quota_timezone.key if db_handler.quota_timezone else None}
+    with db_handler.get_connection() as connection:
+        with connection.cursor() as cursor:
+            # Session lock, the other workers wait here and then find nothing left to do
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_ID,))
+            connection.commit()
+            try:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version integer PRIMARY KEY,
+                        description text NOT NULL,
+                        applied_at timestamptz NOT NULL DEFAULT now()
+                    )
+                """)
+                cursor.execute("SELECT version FROM schema_migrations")
+                done = {row[0] for row in cursor.fetchall()}
+                connection.commit()
+
+                for version, description, statements in migrations:
+                    if version in done:
+                        continue
+                    try:
+                        for statement in statements:
+                            cursor.execute(statement, params)
+                        cursor.execute(
+                            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                            (version, description)
+                        )
+                        connection.commit()
+                    except Exception:
+                        connection.rollback()
+                        logger.exception("Schema migration %d (%s) failed", version, description)
+                        raise
+                    logger.info("Applied schema migration %d: %s", version, description)
+                    applied.append(version)
+            finally:
+                connection.rollback()
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_ID,))
+                connection.commit()
+    return applied
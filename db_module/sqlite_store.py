@@ -0,0 +1,201 @@
+import json
+import sqlite3
+import threading
+import time
+
+from db_module.user_store import UserStore, USER_COLUMNS, quota_timezone, quota_day
+
+USER_RETURNING = ', '.join(USER_COLUMNS)
+
+# The quota left today of a row, a quota counted for an older day starts again from :quota
+QUOTA_LEFT = "CASE WHEN quotaday = :today THEN quota ELSE :quota END"
+
+class SQLiteUserStore(UserStore):
+    """Embedded SQLite user state store, for small deployments and tests that have no Postgres server.
+
+    The database runs in WAL mode, so readers never wait for the writer. Every thread gets its own connection,
+    and each connection keeps the prepared statements of the constant query texts below in its statement cache,
+    so a hot query is only compiled once per connection. Writes that read before they write (the quota)
+    run in a BEGIN IMMEDIATE transaction, which takes the write lock up front."""
+
+    def __init__(self, path, busy_timeout=5.0, cached_statements=128, quota_timezone_name=None):
+        self.path = path
+        self.quota_timezone = quota_timezone(quota_timezone_name)
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+    def get_connection(self):
+        """Return the connection of the calling thread, open it on first use."""
+
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # Autocommit mode, transactions are started explicitly
+            connection = sqlite3.connect(
+                self.path,
+                timeout=self.busy_timeout,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=self.cached_statements
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    @staticmethod
+    def _to_row(row):
+        user = dict(zip(USER_COLUMNS, row))
+        user['aimode'] = bool(user['aimode'])
+        user['history'] = json.loads(user['history'])
+        return user
+
+    def ensure_user_schema(self):
+        connection = self.get_connection()
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                userid TEXT PRIMARY KEY,
+                username TEXT,
+                quota INTEGER NOT NULL DEFAULT 50,
+                aimode INTEGER NOT NULL DEFAULT 0,
+                lastaimsgtime REAL,
+                version INTEGER NOT NULL DEFAULT 0,
+                history TEXT NOT NULL DEFAULT '[]',
+                quotaday TEXT
+            )
+        """)
+        # Databases created before the lazy quota reset, their quotas left were counted for today by the
+        # midnight reset, as in the Postgres migration
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(users)")]
+        if 'quotaday' not in columns:
+            connection.execute("ALTER TABLE users ADD COLUMN quotaday TEXT")
+            connection.execute("UPDATE users SET quotaday = ?", (quota_day(self.quota_timezone).isoformat(),))
+        connection.execute("CREATE INDEX IF NOT EXISTS users_idle_idx ON users (lastaimsgtime) WHERE aimode")
+
+    def get_user(self, user_id):
+        row = self.get_connection().execute(
+            f"SELECT {USER_RETURNING} FROM users WHERE userid = ?", (user_id,)
+        ).fetchone()
+        return self._to_row(row) if row else None
+
+    def upsert_user(self, user_id, user_name, default_quota=50):
+        row = self.get_connection().execute(f"""
+            INSERT INTO users (userid, username, quota, aimode, version) VALUES (?, ?, ?, 0, 1)
+            ON CONFLICT (userid) DO UPDATE SET username = excluded.username, version = version + 1
+            RETURNING {USER_RETURNING}
+        """, (user_id, user_name, default_quota)).fetchone()
+        return self._to_row(row)
+
+    def consume_user_quota(self, user_id, user_name, enter_aimode=False, default_quota=50):
+        connection = self.get_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            params = {
+                'userid': user_id,
+                'username': user_name,
+                'quota': default_quota,
+                'aimode': int(enter_aimode),
+                'now': time.time(),
+                'today': quota_day(self.quota_timezone).isoformat(),
+            }
+            previous = connection.execute(
+                f"SELECT {QUOTA_LEFT}, aimode FROM users WHERE userid = :userid", params
+            ).fetchone()
+            row = connection.execute(f"""
+                INSERT INTO users (userid, username, quota, aimode, lastaimsgtime, version, quotaday)
+                VALUES (
+                    :userid, :username,
+                    CASE WHEN :aimode THEN :quota - 1 ELSE :quota END,
+                    :aimode,
+                    CASE WHEN :aimode THEN :now END,
+                    1,
+                    :today
+                )
+                ON CONFLICT (userid) DO UPDATE SET
+                    username = excluded.username,
+                    quota = CASE WHEN {QUOTA_LEFT} > 0 AND (aimode OR excluded.aimode)
+                        THEN {QUOTA_LEFT} - 1 ELSE {QUOTA_LEFT} END,
+                    aimode = CASE WHEN {QUOTA_LEFT} > 0 THEN aimode OR excluded.aimode ELSE 0 END,
+                    lastaimsgtime = CASE WHEN {QUOTA_LEFT} > 0 AND (aimode OR excluded.aimode)
+                        THEN :now ELSE lastaimsgtime END,
+                    version = version + 1,
+                    quotaday = excluded.quotaday
+                RETURNING {USER_RETURNING}
+            """, params).fetchone()
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        user = self._to_row(row)
+        if previous is None:
+            user['consumed'] = enter_aimode
+            user['requested_ai'] = enter_aimode
+        else:
+            user['consumed'] = previous[0] > 0 and (bool(previous[1]) or enter_aimode)
+            user['requested_ai'] = bool(previous[1]) or enter_aimode
+        return user
+
+    def refund_user_quota(self, user_id, default_quota=50):
+        row = self.get_connection().execute(f"""
+            UPDATE users SET quota = MIN(quota + 1, ?), version = version + 1
+            WHERE userid = ? AND quotaday = ?
+            RETURNING {USER_RETURNING}
+        """, (default_quota, user_id, quota_day(self.quota_timezone).isoformat())).fetchone()
+        return self._to_row(row) if row else None
+
+    def set_user_aimode(self, user_id, aimode):
+        row = self.get_connection().execute(f"""
+            UPDATE users SET aimode = ?, version = version + 1 WHERE userid = ?
+            RETURNING {USER_RETURNING}
+        """, (int(aimode), user_id)).fetchone()
+        return self._to_row(row) if row else None
+
+    def expire_idle_users(self, cutoff):
+        rows = self.get_connection().execute(f"""
+            UPDATE users SET aimode = 0, version = version + 1
+            WHERE aimode AND lastaimsgtime < ?
+            RETURNING {USER_RETURNING}
+        """, (cutoff,)).fetchall()
+        return [self._to_row(row) for row in rows]
+
+    def load_conversation(self, user_id):
+        row = self.get_connection().execute("SELECT history FROM users WHERE userid = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_conversation(self, user_id, history):
+        self.get_connection().execute(
+            "UPDATE users SET history = ? WHERE userid = ?", (json.dumps(history), user_id)
+        )
+
+    def save_conversations(self, histories):
+        connection = self.get_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "UPDATE users SET history = ? WHERE userid = ?",
+                [(json.dumps(history), user_id) for user_id, history in histories.items()]
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def get_stats(self):
+        with self.connections_lock:
+            return {
+                'path': self.path,
+                'connections': len(self.connections),
+            }
+
+    def close_connection(self):
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
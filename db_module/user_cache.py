@@ -0,0 +1,75 @@
+import threading
+
+from cache_module.ttl_cache import TTLCache
+
+class UserStateCache:
+    """Cache of the users rows of this worker, keyed by userId.
+
+    The quota use, the quota refund and the idle expiry go to the DB first and the rows they return are stored,
+    so a user in AI mode is checked from memory and only costs the one write needed by an AI message.
+    The other changes of a row (the history saves, the writes of other workers) are only seen once the cached
+    row is reloaded or expires after ttl seconds. Each write bumps the row's version, and a row is never
+    replaced by an older version of itself.
+
+    Only rows in AI mode are served from memory: another gunicorn worker may have put the user in AI mode since
+    a row out of AI mode was cached, so the decision to echo is always taken on the row read from the store by
+    load_user(). A stale row in AI mode is harmless, the quota statement re-checks aimode in the DB."""
+
+    def __init__(self, db_handler, max_size=10000, ttl=30):
+        self.db_handler = db_handler
+        self.cache = TTLCache(max_size=max_size, ttl=ttl)
+
+        # Makes the version comparison and the store one step
+        self.lock = threading.Lock()
+
+    def get_user(self, user_id):
+        """Return the cached row of the user if it is in AI mode, or None (not cached, expired, or out of AI mode)."""
+
+        user_state = self.cache.get(user_id)
+        if user_state is None or not user_state['aimode']:
+            return None
+        return user_state
+
+    def load_user(self, user_id):
+        """Read the user's row from the store and cache it, return None if there is no such user."""
+
+        user_state = self.db_handler.get_user(user_id)
+        if user_state is not None:
+            self._store(user_id, user_state)
+        return user_state
+
+    def consume_quota(self, user_id, user_name, enter_aimode=False):
+        """Use one quota of the user in the DB and cache the resulting row."""
+
+        user_state = self.db_handler.consume_user_quota(user_id, user_name, enter_aimode=enter_aimode)
+        if user_state is not None:
+            self._store(user_id, user_state)
+        return user_state
+
+    def refund_quota(self, user_id):
+        """Give back a quota of the user in the DB and cache the resulting row."""
+
+        user_state = self.db_handler.refund_user_quota(user_id)
+        if user_state is not None:
+            self._store(user_id, user_state)
+        return user_state
+
+    def expire_idle_users(self, cutoff):
+        """Take every user idle since cutoff out of AI mode in the DB, and cache the resulting rows."""
+
+        user_states = self.db_handler.expire_idle_users(cutoff)
+        for user_state in user_states:
+            self._store(user_state['userid'], user_state)
+        return user_states
+
+    def _store(self, user_id, user_state):
+        """Cache a row unless a newer version of it is already cached."""
+
+        with self.lock:
+            cached_state = self.cache.peek(user_id)
+            if cached_state is not None and cached_state['version'] > user_state['version']:
+                return
+            self.cache.put(user_id, user_state)
+
+    def get_stats(self):
+        return self.cache.get_stats()
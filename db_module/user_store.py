@@ -0,0 +1,77 @@
+from abc import ABC, abstractmethod
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+# Columns of a user state row, every store returns rows as dicts with these keys
+USER_COLUMNS = ('username', 'userid', 'quota', 'aimode', 'lastaimsgtime', 'version', 'history', 'quotaday')
+
+def quota_timezone(name=None):
+    """Return the time zone the quota days are counted in (e.g. 'Asia/Taipei'), None for the local time."""
+
+    return ZoneInfo(name) if name else None
+
+def quota_day(timezone=None):
+    """Return today's date in timezone, the day the quotas are counted for."""
+
+    return datetime.now(timezone).date()
+
+class UserStore(ABC):
+    """The user state operations the bots rely on, implemented by every storage backend
+    (PostgreSQLHandler, SQLiteUserStore and ShardedUserStore), so they all share the same quota and AI-mode rules.
+
+    A row is a dict with the USER_COLUMNS keys. Every write bumps the row's version.
+    consume_user_quota is the one rule of the bots: a quota is only used when the user is in AI mode (or enters it
+    now) and has quota left, which also records the last AI msg time; a user in AI mode without quota leaves it.
+
+    The quotas reset lazily: quota is what is left of the day quotaday (an ISO date of the quota time zone),
+    and the first consume_user_quota of a user on a new day starts again from default_quota. So there is no
+    midnight job rewriting every user.
+    Every operation is abstract, a backend missing one cannot be instantiated."""
+
+    @abstractmethod
+    def ensure_user_schema(self):
+        """Create whatever the store needs (tables, indexes), it is safe to call on every start."""
+
+    @abstractmethod
+    def get_user(self, user_id):
+        """Return the user's row, or None."""
+
+    @abstractmethod
+    def upsert_user(self, user_id, user_name, default_quota=50):
+        """Add the user if it is new, otherwise refresh its display name. Return the row."""
+
+    @abstractmethod
+    def consume_user_quota(self, user_id, user_name, enter_aimode=False, default_quota=50):
+        """Atomically use one message quota of the user (adding the user if it is new).
+        Return the resulting row, with 'consumed' telling if a quota was used
+        and 'requested_ai' telling if the user was (or entered) in AI mode."""
+
+    @abstractmethod
+    def refund_user_quota(self, user_id, default_quota=50):
+        """Give back a quota used today for a question that was not answered (e.g. shed), up to default_quota.
+        Return the row, or None if there is no such user or its quota has not been used today."""
+
+    @abstractmethod
+    def set_user_aimode(self, user_id, aimode):
+        """Turn the user's AI mode on or off, return the row (None if there is no such user)."""
+
+    @abstractmethod
+    def expire_idle_users(self, cutoff):
+        """Take every AI-mode user whose last AI msg is older than cutoff (epoch seconds) out of AI mode.
+        Return the resulting rows."""
+
+    @abstractmethod
+    def load_conversation(self, user_id):
+        """Return the user's conversation history, [] if there is none."""
+
+    @abstractmethod
+    def save_conversation(self, user_id, history):
+        """Save the user's conversation history."""
+
+    @abstractmethod
+    def save_conversations(self, histories):
+        """Save the histories of many users ({user_id: history}) at once."""
+
+    @abstractmethod
+    def close_connection(self):
+        """Release the connections or files of the store."""
@@ -1,19 +1,66 @@
 from openai import OpenAI
 import os
-from flask import Flask, request
+import sys
+from flask import Flask, request, abort, jsonify
 from linebot import LineBotApi
 from linebot.v3.webhook import WebhookHandler
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+from linebot.v3.exceptions import InvalidSignatureError
 from linebot.models import TextSendMessage
-import json
 import threading
 import time
-from datetime import datetime, timedelta
-import schedule
+
+# Make the shared modules at the root of the repo importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cache_module.semantic_cache import SemanticCache, SentenceTransformerEmbedder
+from ai_module.reply_splitter import split_reply, MAX_REPLY_MESSAGES, MAX_MESSAGE_LENGTH
+from ai_module.conversation_memory import ConversationMemory
+from metrics_module.histogram import LatencyHistogram
+from db_module.json_user_store import ShardedUserStore
+from worker_module.admission_control import AdmissionController, Overloaded
 
 app = Flask(__name__)
 
-# Global lock to synchronize file access
-file_lock = threading.Lock()
+# Initialize LineBot API and the OpenAI client once, their connections are reused by every message
+line_bot_api = LineBotApi(os.environ['CHANNEL_ACCESS_TOKEN'])
+client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+
+# Stream the completions (default), the answer is still replied in one go once complete: streaming measures the
+# time to the first token and stops the generation once the answer no longer fits in one reply
+stream_completions = os.environ.get('OPENAI_STREAM', '1') == '1'
+max_tokens = int(os.environ.get('OPENAI_MAX_TOKENS', 100))
+
+# Recent conversation of every user, trimmed to a token budget (kept in memory only in this version)
+conversation_memory = ConversationMemory(
+    max_messages=int(os.environ.get('CONVERSATION_MAX_MESSAGES', 10)),
+    max_tokens=int(os.environ.get('CONVERSATION_MAX_TOKENS', 1000))
+)
+
+EMPTY_ANSWER_MESSAGE = "Sorry, the AI could not answer this question. Please try asking it another way."
+
+# Latency of ChatGPT: time to the first token and to the whole answer
+first_token_latency = LatencyHistogram()
+completion_latency = LatencyHistogram()
+
+# At most OPENAI_MAX_CONCURRENCY questions are sent to OpenAI at once, the others wait up to
+# ADMISSION_QUEUE_TIMEOUT seconds for a slot and are answered busy instead of waiting longer
+admission_controller = AdmissionController(
+    max_concurrency=int(os.environ.get('OPENAI_MAX_CONCURRENCY', 8)),
+    queue_timeout=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10)),
+    max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', 100))
+)
+
+# Initialize Webhook Handler
+handler = WebhookHandler(os.environ['CHANNEL_SECRET'])
+
+# Optional cache answering near-duplicate questions without asking ChatGPT
+semantic_cache = SemanticCache(
+    embed=SentenceTransformerEmbedder(os.environ['SEMANTIC_CACHE_MODEL']),
+    threshold=float(os.environ['SEMANTIC_CACHE_THRESHOLD']) if os.environ.get('SEMANTIC_CACHE_THRESHOLD') else None
+) if os.environ.get('SEMANTIC_CACHE_MODEL') else None
+
+# The user records, kept in memory and saved to userInfo.json by periodic snapshots plus a journal of the changes
+user_store = ShardedUserStore('./userInfo.json', quota_timezone_name=os.environ.get('QUOTA_TIMEZONE'))
 
 @app.route("/", methods=['POST'])
 def linebot():
@@ -22,28 +69,26 @@ def linebot():
     # Get the request body as text
     body = request.get_data(as_text=True)
 
-    # Parse the body asJSON
-    json_data = json.loads(body)
+    # Get signature from request headers
+    signature = request.headers.get('X-Line-Signature', '')
 
+    # Verify the signature and handle every event of the batch in order
     try:
-        # Inintialize LineBot API and Webhook Handler
-        line_bot_api = LineBotApi(os.environ['CHANNEL_ACCESS_TOKEN'])
-        handler = WebhookHandler(os.environ['CHANNEL_SECRET'])
+        handler.handle(body, signature)
+    except InvalidSignatureError:
+        abort(400)
 
-        # Get OpenAI API key from environment variables
-        api_key = os.environ.get("OPENAI_API_KEY")
-        client = OpenAI()
-        
-        # Get signature from request headers
-        signature = request.headers['X-Line-Signature']
+    return 'OK'
 
-        # Handle the webhook events
-        handler.handle(body, signature)
+@handler.add(MessageEvent, message=TextMessageContent)
+def handleTextMessage(event):
+    """Reply to one text message of the webhook batch."""
 
-        # Extract reply token and user's message from the JSON data
-        user_id = json_data['events'][0]['source']['userId']
-        reply_token = json_data['events'][0]['replyToken']
-        user_message = json_data['events'][0]['message']['text']
+    try:
+        # Extract reply token and user's message from the event
+        user_id = event.source.user_id
+        reply_token = event.reply_token
+        user_message = event.message.text
         # Use user_id to get the profile of the user
         profile = line_bot_api.get_profile(user_id)
         user_name = profile.display_name
@@ -53,175 +98,149 @@ def linebot():
 
             # Extract the first six characters of the message in lowercase
             ai_msg = user_message[:6].lower()
-            reply_msg = ''
+            reply_msgs = []
 
             # Check if the message starts with 'hi ai:
             if ai_msg == 'hi ai ':
                 
                 # User message starts with 'hi ai', direct the question to ChatGPT
-                reply_msg = askChatGPT(client, user_message)
+                # A long answer is split at sentence boundaries into the messages of one reply, an empty one is not sent
+                try:
+                    reply_msgs = split_reply(askChatGPT(client, user_id, user_message)) or [EMPTY_ANSWER_MESSAGE]
+                except Overloaded:
+                    # The question was not answered, give its quota back
+                    user_store.refund_user_quota(user_id)
+                    reply_msgs = ["Sorry, the AI is busy right now. Please try again shortly."]
 
             else:
                 # If not a special command, echo the user's message
-                reply_msg = user_message
+                reply_msgs = [user_message]
 
         # The user does not have enough quota to ask question
         else:
-            reply_msg = "We're sorry, but you've reached the message limit of the day. Please ask again tomorrow."
+            reply_msgs = ["We're sorry, but you've reached the message limit of the day. Please ask again tomorrow."]
         
-        # Send the reply message back to the user
-        text_message = TextSendMessage(text=reply_msg)
-        line_bot_api.reply_message(reply_token,text_message)
+        # Send the reply messages back to the user
+        text_messages = [TextSendMessage(text=reply_msg) for reply_msg in reply_msgs]
+        line_bot_api.reply_message(reply_token,text_messages)
 
     except Exception as e:
-        # Print any exceptions for debugging purposes
+        # Print any exceptions for debugging purposes, and go on with the next event
         print(e)
-    return 'OK'
 
-def checkUserMsgQuota(user_id, user_name):
-    """First check if user has change his/her profile name (display name), if he/she has, modify it in userInfo.json.
-    Then, check if the userId exists and has enough quota of messages to ask question.
-    If the user has enough quota, return true to enable asking chatPDF question.
-    If the user has no quota, return false to reject the user from asking.
-    If the user is a new user to this LineBot, add his/her  userId to the userInfo.json, and return ture to enable asking question."""
-    
-    # Acquire the lock before reading/modifying the file
-    with file_lock:
-
-        # Read the JSON file
-        with open('./userInfo.json', 'r') as json_file:
-
-            # Load JSON data
-            data = json.load(json_file)
-            
-            # Check if this user_id exists and has enough quota of messages to ask
-            for user in data:
-                if user.get("userId") == user_id:
-                    
-                    # Check if this user has modified his/her profile name(display name); if he/her had, modify in userInfo.json
-                    if user['userName'] != user_name:
-                        modifyUserName(data, user, user_name)
-
-                    if user['quota'] == 0:
-                        return False
-                    else:
-                        # User have enough quota, quota-=1
-                        userMsgQuotaDecreaseOne(data, user, user['quota'])
-                        return True
-                    
-            # Cannot find this user_id, then it is a new user.
-            # Add this user to the JSON file
-            addUser(data, user_id, user_name)
-            return True
-        
-    # Automatically release the lock after this section been executed
-
-def modifyUserName(json_data, user, user_name):
-    """Modify user's profile name (display name) in userInfo.json."""
-
-    # Update the old user name to new user name
-    user.update({"userName": user_name})
+@handler.default()
+def handleOtherEvent(event):
+    """Events other than text messages (stickers, images, follow, unfollow...) do not need a reply."""
 
-    # Write the updated info to the ./userInfo.json
-    with open('./userInfo.json', 'w') as json_file:
-        json.dump(json_data, json_file, indent=4)
-
-    return 'OK'
+    print(f"Ignoring {event.type} event")
 
-def addUser(json_data, user_id, user_name):
-    """Add the userId of the new user to the userInfo.json, and set the quota to 49,
-    because the user would use 1 quota upon asking question."""
-    
-    # Set the info of new_user
-    new_user = {"userName": f"{user_name}", "userId": f"{user_id}", "quota": 49}
-
-    # Append the new user info to the bottom of the userInfo.json
-    json_data.append(new_user)
-    with open('./userInfo.json', 'w') as json_file:
-        json.dump(json_data, json_file, indent=4)
-
-    return 'OK'
+@app.route("/stats", methods=['GET'])
+def stats():
+    """Expose the latency of ChatGPT and the user store metrics."""
 
-def userMsgQuotaDecreaseOne(json_data, user, quota):
-    """Decrease the quota of message of a specific user."""
+    return jsonify({
+        'first_token_latency': first_token_latency.get_stats(),
+        'completion_latency': completion_latency.get_stats(),
+        'conversation_memory': conversation_memory.get_stats(),
+        'user_store': user_store.get_stats(),
+        'admission_controller': admission_controller.get_stats(),
+    })
 
-    # Update remain quota of the user
-    quota -= 1
-    user.update({"quota": quota})
-
-    # Write the updated info to the ./userInfo.json
-    with open('./userInfo.json', 'w') as json_file:
-        json.dump(json_data, json_file, indent=4)
-
-    return 'OK'
+def checkUserMsgQuota(user_id, user_name):
+    """Use one message quota of the user and refresh his/her profile name (display name).
+    If the user has enough quota, return true to enable asking question.
+    If the user has no quota, return false to reject the user from asking.
+    A new user is added with a quota of 49, because the user uses 1 quota upon asking question."""
+
+    # Only the user's shard is locked, and only for the update itself
+    return user_store.consume_quota(user_id, user_name)
+
+def askChatGPT(client, user_id, user_message):
+    """Call OpenAI API to ask ChatGPT-3.5 questions, with the user's recent conversation as context."""
+
+    question = user_message[6:]
+    history = conversation_memory.get_history(user_id)
+    context = conversation_memory.build_context(history, question)
+
+    # Answer near-duplicate questions from the semantic cache, unless they are follow-ups of a conversation
+    if semantic_cache is not None and not context:
+        answer = semantic_cache.get(question)
+        if answer is not None:
+            conversation_memory.add_exchange(user_id, history, question, answer)
+            return answer
+
+    # Send the user_message to OpenAI for processing, once admitted (Overloaded is raised if the call is shed)
+    # The slot is held until the whole streamed answer is read
+    with admission_controller.admit():
+        start = time.perf_counter()
+        completion = client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=[
+                {"role": "system", "content": "You're a customer services assistant who can speak both English and Chinese(TW) fluently."},
+                *context,
+                {"role": "user", "content": f"{question}"}
+            ],
+            max_tokens=max_tokens,
+            stream=stream_completions
+        )
+        print(f"User asked: {user_message}")
+
+        if stream_completions:
+            answer = readStreamedAnswer(completion, start)
+        else:
+            answer = completion.choices[0].message.content or ''
+        completion_latency.observe(time.perf_counter() - start)
 
-def askChatGPT(client, user_message):
-    """Call OpenAI API to ask ChatGPT-3.5 questions."""
-
-    # Send the user_message to OpenAI for processing
-    completion = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You're a customer services assistant who can speak both English and Chinese(TW) fluently."},
-            {"role": "user", "content": f"{user_message[6:]}"}
-        ],
-        max_tokens=100
-    )
-    print(f"User asked: {user_message}")
-    return completion.choices[0].message.content
-
-def reset_status():
-    """Load the userInfo.json, reset the "quota" to 50 of every user, and save it back."""
-    
-    # Acquire the lock
-    with file_lock:
-        
-        with open("./userInfo.json", 'r') as json_file:
-            data = json.load(json_file)
+    # An empty answer is not cached, the next paraphrase asks again
+    if semantic_cache is not None and not context and answer.strip():
+        semantic_cache.put(question, answer)
+    conversation_memory.add_exchange(user_id, history, question, answer)
+    return answer
 
-            # Reset every users' quota of messages to 50
-            for user in data:
-                user['quota'] = 50
-    # Release the lock
+def readStreamedAnswer(stream, start):
+    """Collect the chunks of a streamed completion as they arrive.
+    Stop early once the answer no longer fits in one LINE reply, there is no point in generating the rest."""
 
-    # Acquire the lock
-    with file_lock:
+    max_answer_length = MAX_REPLY_MESSAGES * MAX_MESSAGE_LENGTH
+    parts = []
+    answer_length = 0
 
-        with open("./userInfo.json", 'w') as json_file:
-            json.dump(data, json_file, indent=4)
-    # Release the lock after writing to the file       
+    for chunk in stream:
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
 
-def scheduled_reset(exit_event):
-    """Reset users' quota to 50 upon everyday midnight """
-    schedule.every().day.at("00:00").do(reset_status)
+        if not parts:
+            first_token_latency.observe(time.perf_counter() - start)
 
-    while not exit_event.is_set():
-        # Check if there are any scheduled tasks that need to be executed
-        schedule.run_pending()
+        parts.append(chunk.choices[0].delta.content)
+        answer_length += len(parts[-1])
+        if answer_length >= max_answer_length:
+            stream.response.close()
+            break
 
-        # Introduces a small delay of 1 sec between iterations of the loop, 
-        # preventing the loop from consuming excessive CPU resources
-        time.sleep(30)
+    return ''.join(parts)
 
 def main():
-    """Ran as a background task and continuously check the time
-     to check if resetting users' quota of message is needed."""
+    """Run the Flask app with the background snapshots of the user records.
+     The daily quotas reset lazily, on the next message of each user."""
     
     # Create an Event to  signal the thread to exit.(Upon Ctrl+c is pressed)
     exit_event = threading.Event()
 
-    # Start a thread for the scheduled task
-    schedule_thread = threading.Thread(target=scheduled_reset, args=(exit_event,))
-    schedule_thread.start()
+    # Load the user records, and snapshot them every minute
+    user_store.load()
+    snapshot_thread = threading.Thread(target=user_store.run_snapshots, args=(exit_event, 60))
+    snapshot_thread.start()
 
     try:
-        # Run the Flask app
-        app.run(debug=True)
+        # Run the Flask app, without the reloader: its parent process would run a second set of background threads
+        app.run(debug=True, use_reloader=False)
 
     except KeyboardInterrupt:
         # Ctrl+c is pressed, set the exit event and wait for the thread to exit
         exit_event.set()
-        schedule_thread.join()
+        snapshot_thread.join()
+        user_store.close_connection()
 
 if __name__ == "__main__":
 
@@ -0,0 +1,76 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the latency buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class LatencyHistogram:
+    """A fixed-bucket latency histogram. An observation is one bisect and a few additions under a lock,
+    so it is cheap enough to leave on in the hot path."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+
+        # One count per bucket, plus the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        """Observe how long the with block takes."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self):
+        """Return (cumulative bucket counts, sum, count), the cumulative counts end with the +Inf bucket."""
+
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+
+        cumulative = []
+        running = 0
+        for bucket_count in counts:
+            running += bucket_count
+            cumulative.append(running)
+        return cumulative, total, count
+
+    def quantile(self, q):
+        """Estimate a quantile by the upper bound of the bucket it falls in (None if empty)."""
+
+        cumulative, _, count = self.snapshot()
+        if count == 0:
+            return None
+
+        rank = q * count
+        for upper_bound, running in zip(self.buckets + (float('inf'),), cumulative):
+            if running >= rank:
+                return upper_bound
+        return float('inf')
+
+    def get_stats(self):
+        cumulative, total, count = self.snapshot()
+        return {
+            'count': count,
+            'sum_seconds': total,
+            'avg_seconds': total / count if count else 0.0,
+            'p50_seconds': self.quantile(0.5),
+            'p95_seconds': self.quantile(0.95),
+            'p99_seconds': self.quantile(0.99),
+            'buckets': {str(upper_bound): running for upper_bound, running in zip(self.buckets + ('+Inf',), cumulative)},
+        }
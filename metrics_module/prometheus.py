@@ -0,0 +1,121 @@
+import functools
+import threading
+import time
+
+from metrics_module.histogram import LatencyHistogram, DEFAULT_BUCKETS
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Counter:
+    """A monotonically increasing count, incremented under a lock."""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+def timed(histogram, func):
+    """Wrap func so every call observes its duration in histogram."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class MetricsRegistry:
+    """The metrics of the process, rendered in the Prometheus text format for a /metrics endpoint.
+
+    A metric is a family (name, type, help) plus label values. The hot path only touches the metric objects
+    (LatencyHistogram.observe, Counter.inc), which are looked up once and kept by the callers; the registry
+    lock is only taken to create a metric and to render. Metrics that other components already count
+    (queue depths, pool usage...) are registered as callbacks read at render time."""
+
+    def __init__(self, namespace='linebot'):
+        self.namespace = namespace
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def _metric(self, name, metric_type, help_text, labels, create):
+        full_name = f'{self.namespace}_{name}' if self.namespace else name
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.get(full_name)
+            if family is None:
+                family = self.families[full_name] = (metric_type, help_text, {})
+            elif family[0] != metric_type:
+                raise ValueError(f"Metric {full_name} is already registered as a {family[0]}")
+            metrics = family[2]
+            if key not in metrics:
+                metrics[key] = create()
+            return metrics[key]
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS, **labels):
+        """Return the latency histogram (seconds) of name and labels, creating it on first use."""
+
+        return self._metric(name, 'histogram', help_text, labels, lambda: LatencyHistogram(buckets))
+
+    def register_histogram(self, name, help_text, histogram, **labels):
+        """Expose a histogram a component already keeps."""
+
+        return self._metric(name, 'histogram', help_text, labels, lambda: histogram)
+
+    def counter(self, name, help_text, **labels):
+        """Return the counter of name and labels, creating it on first use. name should end with _total."""
+
+        return self._metric(name, 'counter', help_text, labels, Counter)
+
+    def register_callback(self, name, metric_type, help_text, func, **labels):
+        """Expose a value read by func() at render time, metric_type is 'gauge' or 'counter'."""
+
+        return self._metric(name, metric_type, help_text, labels, lambda: func)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+
+        with self.lock:
+            families = [(name, family[0], family[1], list(family[2].items())) for name, family in self.families.items()]
+
+        lines = []
+        for name, metric_type, help_text, metrics in sorted(families):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, metric in metrics:
+                if isinstance(metric, LatencyHistogram):
+                    cumulative, total, count = metric.snapshot()
+                    for upper_bound, running in zip(metric.buckets + (float('inf'),), cumulative):
+                        lines.append(f'{name}_bucket{_format_labels(labels, [("le", _format_value(upper_bound))])} {running}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(total)}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {count}')
+                elif isinstance(metric, Counter):
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(metric.value)}')
+                else:
+                    try:
+                        value = metric()
+                    except Exception:
+                        # A failing callback must not take the whole endpoint down
+                        continue
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
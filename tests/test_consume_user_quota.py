@@ -0,0 +1,72 @@
+"""consume_user_quota against a real Postgres, set TEST_DATABASE_URL to run it (the tables are created in that DB)."""
+
+import asyncio
+import os
+
+import pytest
+
+from db_module.db_operations import PostgreSQLHandler
+from db_module.async_db_operations import AsyncPostgreSQLHandler
+
+DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+pytestmark = pytest.mark.skipif(not DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+USER_ID = 'test-consume-user-quota'
+
+@pytest.fixture(params=[True, False], ids=['prepared', 'unprepared'])
+def db_handler(request):
+    db_handler = PostgreSQLHandler(DATABASE_URL, prepare_statements=request.param)
+    db_handler.ensure_user_schema()
+    db_handler.execute_query("DELETE FROM users WHERE userid = %(userid)s", {'userid': USER_ID})
+    yield db_handler
+    db_handler.execute_query("DELETE FROM users WHERE userid = %(userid)s", {'userid': USER_ID})
+    db_handler.close_connection()
+
+def flags(user_state):
+    return user_state['quota'], user_state['aimode'], user_state['consumed'], user_state['requested_ai']
+
+def test_greeting_follow_up_and_exhausted_quota(db_handler):
+    # A message out of AI mode is echoed, it uses no quota
+    assert flags(db_handler.consume_user_quota(USER_ID, 'name')) == (50, False, False, False)
+
+    # 'hi ai' enters AI mode, and the follow-ups of the user in AI mode use a quota each
+    assert flags(db_handler.consume_user_quota(USER_ID, 'name', enter_aimode=True)) == (49, True, True, True)
+    assert flags(db_handler.consume_user_quota(USER_ID, 'name')) == (48, True, True, True)
+
+    # The last quota is used, then the user is rejected and taken out of AI mode
+    db_handler.execute_query("UPDATE users SET quota = 1 WHERE userid = %(userid)s", {'userid': USER_ID})
+    assert flags(db_handler.consume_user_quota(USER_ID, 'name')) == (0, True, True, True)
+    assert flags(db_handler.consume_user_quota(USER_ID, 'name')) == (0, False, False, True)
+
+    # A greeting without quota is rejected too, and the user stays out of AI mode
+    assert flags(db_handler.consume_user_quota(USER_ID, 'name', enter_aimode=True)) == (0, False, False, True)
+    assert flags(db_handler.consume_user_quota(USER_ID, 'name')) == (0, False, False, False)
+
+def test_quota_of_an_older_day_starts_again(db_handler):
+    db_handler.consume_user_quota(USER_ID, 'name', enter_aimode=True)
+    db_handler.execute_query(
+        "UPDATE users SET quota = 0, quotaday = quotaday - 1 WHERE userid = %(userid)s", {'userid': USER_ID}
+    )
+    assert flags(db_handler.consume_user_quota(USER_ID, 'name')) == (49, True, True, True)
+
+def test_async_handler_has_the_same_rule():
+    async def run():
+        db_handler = AsyncPostgreSQLHandler(DATABASE_URL)
+        await db_handler.open()
+        try:
+            await db_handler.fetch("DELETE FROM users WHERE userid = $1", USER_ID)
+            results = [
+                flags(await db_handler.consume_user_quota(USER_ID, 'name', enter_aimode=True)),
+                flags(await db_handler.consume_user_quota(USER_ID, 'name')),
+            ]
+            await db_handler.fetch("UPDATE users SET quota = 0 WHERE userid = $1", USER_ID)
+            results.append(flags(await db_handler.consume_user_quota(USER_ID, 'name', enter_aimode=True)))
+            await db_handler.fetch("DELETE FROM users WHERE userid = $1", USER_ID)
+        finally:
+            await db_handler.close()
+        return results
+
+    # The async app only runs on a schema the sync handler migrated
+    PostgreSQLHandler(DATABASE_URL).ensure_user_schema()
+    assert asyncio.run(run()) == [(49, True, True, True), (48, True, True, True), (0, False, False, True)]
@@ -0,0 +1,210 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from metrics_module.histogram import LatencyHistogram
+
+class Overloaded(Exception):
+    """The upstream is saturated, the call was shed instead of waiting longer than the queue timeout."""
+
+class _Waiter:
+    __slots__ = ('priority', 'granted', 'cancelled', 'event')
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.granted = False
+        self.cancelled = False
+        self.event = threading.Event()
+
+    def wake(self):
+        self.event.set()
+
+class _AsyncWaiter:
+    __slots__ = ('priority', 'granted', 'cancelled', 'future')
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.granted = False
+        self.cancelled = False
+        self.future = asyncio.get_running_loop().create_future()
+
+    def wake(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+class AdmissionController:
+    """Cap the calls running at once on an upstream (ChatPDF, OpenAI) to max_concurrency.
+
+    The other callers wait in a priority queue (lower priority values first, in arrival order within a
+    priority), and a freed slot is handed to the first waiter. A caller is shed, i.e. admit() raises Overloaded,
+    when it waited queue_timeout seconds, when max_queue callers are already waiting, or right away when the
+    expected wait is already over queue_timeout: the callers ahead of it times the average call duration,
+    divided by max_concurrency."""
+
+    waiter_class = _Waiter
+
+    def __init__(self, max_concurrency=8, queue_timeout=10.0, max_queue=100, tier_priorities=None, default_priority=1):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.tier_priorities = tier_priorities if tier_priorities is not None else {'vip': 0}
+        self.default_priority = default_priority
+
+        self.lock = threading.Lock()
+        self.active = 0
+        self.queue = []
+        self.queued = 0
+        self.sequence = itertools.count()
+
+        # Moving average of the call durations, for the expected wait
+        self.average_call_seconds = 0.0
+        self.completed = 0
+
+        self.queue_wait = LatencyHistogram()
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+        self.max_queue_depth = 0
+
+    def priority_of(self, tier):
+        return self.tier_priorities.get(tier, self.default_priority)
+
+    def _expected_wait(self, priority):
+        # Only the waiters that go first count, the lower priorities wait behind
+        ahead = sum(1 for _, _, waiter in self.queue if waiter.priority <= priority and not waiter.cancelled)
+        return (ahead + 1) * self.average_call_seconds / self.max_concurrency
+
+    def _enqueue(self, priority):
+        """Take a free slot and return None, or queue a waiter and return it. Raise Overloaded if the call is shed."""
+
+        with self.lock:
+            if self.active < self.max_concurrency and not self.queued:
+                self.active += 1
+                self.admitted += 1
+                self.queue_wait.observe(0.0)
+                return None
+
+            if self.queued >= self.max_queue or self._expected_wait(priority) > self.queue_timeout:
+                self.shed += 1
+                raise Overloaded(f"{self.queued} calls waiting, the wait would be over {self.queue_timeout}s")
+
+            waiter = self.waiter_class(priority)
+            heapq.heappush(self.queue, (priority, next(self.sequence), waiter))
+            self.queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queued)
+            return waiter
+
+    def _admitted(self, waiter, start):
+        """Count the waiter in once its wait is over, raise Overloaded if it was not given a slot."""
+
+        with self.lock:
+            # A slot may have been handed over right after the wait timed out
+            if not waiter.granted:
+                waiter.cancelled = True
+                self.queued -= 1
+                self.timed_out += 1
+                raise Overloaded(f"No upstream slot within {self.queue_timeout}s")
+            self.admitted += 1
+        self.queue_wait.observe(time.perf_counter() - start)
+
+    def acquire(self, priority=None):
+        """Take a slot, waiting in the queue. Raise Overloaded if the call is shed."""
+
+        priority = self.default_priority if priority is None else priority
+        start = time.perf_counter()
+        waiter = self._enqueue(priority)
+        if waiter is not None:
+            waiter.event.wait(self.queue_timeout)
+            self._admitted(waiter, start)
+
+    def release(self, call_seconds=None):
+        """Free a slot, handing it to the first waiter if there is one."""
+
+        with self.lock:
+            if call_seconds is not None:
+                self.completed += 1
+                if self.completed == 1:
+                    self.average_call_seconds = call_seconds
+                else:
+                    self.average_call_seconds += 0.1 * (call_seconds - self.average_call_seconds)
+
+            while self.queue:
+                _, _, waiter = heapq.heappop(self.queue)
+                if not waiter.cancelled:
+                    # The slot stays taken, it now belongs to the waiter
+                    waiter.granted = True
+                    self.queued -= 1
+                    waiter.wake()
+                    return
+            self.active -= 1
+
+    @contextmanager
+    def admit(self, priority=None):
+        """Run the with block in a slot, raise Overloaded if the call is shed."""
+
+        self.acquire(priority)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
+
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                'max_concurrency': self.max_concurrency,
+                'active': self.active,
+                'queue_depth': self.queued,
+                'max_queue_depth': self.max_queue_depth,
+                'admitted': self.admitted,
+                'shed': self.shed,
+                'timed_out': self.timed_out,
+                'average_call_seconds': self.average_call_seconds,
+            }
+        stats['queue_wait'] = self.queue_wait.get_stats()
+        return stats
+
+class AsyncAdmissionController(AdmissionController):
+    """AdmissionController for the coroutines of the asyncio app, a priority semaphore on the event loop.
+    The waiters await a future instead of blocking a thread; acquire, release and admit are only called
+    from the event loop, the lock is never held across an await."""
+
+    waiter_class = _AsyncWaiter
+
+    async def acquire(self, priority=None):
+        """Take a slot, waiting in the queue. Raise Overloaded if the call is shed."""
+
+        priority = self.default_priority if priority is None else priority
+        start = time.perf_counter()
+        waiter = self._enqueue(priority)
+        if waiter is None:
+            return
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # The caller is gone, a slot handed over meanwhile goes to the next waiter
+            with self.lock:
+                if not waiter.granted:
+                    waiter.cancelled = True
+                    self.queued -= 1
+            if waiter.granted:
+                self.release()
+            raise
+        self._admitted(waiter, start)
+
+    @asynccontextmanager
+    async def admit(self, priority=None):
+        """Run the async with block in a slot, raise Overloaded if the call is shed."""
+
+        await self.acquire(priority)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+import uuid
+
+from linebot.v3.messaging import ApiException, PushMessageRequest, ReplyMessageRequest, TextMessage
+
+from worker_module.outbound_queue import RETRY_STATUS_CODES, OutboundQueue
+
+logger = logging.getLogger(__name__)
+
+def is_invalid_reply_token(error):
+    """Tell if a LINE v3 error means the reply token expired or was already used."""
+
+    return isinstance(error, ApiException) and error.status == 400 and 'reply token' in str(error).lower()
+
+def is_retryable(error):
+    """Timeouts, connection errors and 429/5xx are retried, the other LINE v3 errors are not."""
+
+    return not isinstance(error, ApiException) or error.status in RETRY_STATUS_CODES
+
+class AsyncOutboundQueue(OutboundQueue):
+    """OutboundQueue for the asyncio app: the same outbox table, backoff and reply-to-push fallback,
+    sending with the LINE v3 AsyncMessagingApi and storing with the AsyncPostgreSQLHandler.
+    The dispatcher is a task of the event loop instead of a thread."""
+
+    async def reply(self, user_id, reply_token, texts):
+        """Reply to a user's message, or queue the texts if LINE does not accept them now."""
+
+        error = await self._attempt(lambda: self.line_bot_api.reply_message(
+            ReplyMessageRequest(reply_token=reply_token, messages=self._to_messages(texts))))
+        if error is None:
+            return
+
+        if is_invalid_reply_token(error):
+            # The user waited too long for the answer, it can still be pushed
+            self.fallback_pushes += 1
+            await self.push(user_id, texts)
+        elif is_retryable(error):
+            await self._enqueue('reply', user_id, reply_token, texts)
+        else:
+            self._drop(user_id, error)
+
+    async def push(self, user_id, texts):
+        """Push texts to a user, or queue them if LINE does not accept them now."""
+
+        retry_key = str(uuid.uuid4())
+        error = await self._attempt(lambda: self._push(user_id, texts, retry_key))
+        if error is None:
+            return
+
+        if is_retryable(error):
+            await self._enqueue('push', user_id, retry_key, texts)
+        else:
+            self._drop(user_id, error)
+
+    def _push(self, user_id, texts, retry_key):
+        return self.line_bot_api.push_message(
+            PushMessageRequest(to=user_id, messages=self._to_messages(texts)), x_line_retry_key=retry_key)
+
+    @staticmethod
+    def _to_messages(texts):
+        return [TextMessage(text=text) for text in texts]
+
+    async def _attempt(self, send):
+        """Run one send, return the error or None on success."""
+
+        start = time.perf_counter()
+        try:
+            await send()
+            error = None
+        except ApiException as e:
+            # A push retried with a retry key LINE already accepted
+            accepted = e.status == 409 and (e.headers or {}).get('x-line-accepted-request-id')
+            error = None if accepted else e
+        except Exception as e:
+            error = e
+        self.send_latency.observe(time.perf_counter() - start)
+
+        self.attempts += 1
+        if error is not None:
+            self.failed_attempts += 1
+            logger.warning("Could not send a LINE message: %s", error)
+        return error
+
+    async def _enqueue(self, kind, user_id, token, texts):
+        """Store a message for the dispatcher. token is the reply token of a reply, the retry key of a push."""
+
+        await self.store.enqueue_outbound_message(kind, user_id, token, texts, time.time() + self._retry_delay(1))
+        self.queued += 1
+
+    async def run(self):
+        """Retry the due outbox messages until cancelled."""
+
+        while True:
+            try:
+                messages = await self.store.claim_outbound_messages(self.batch_size, time.time())
+            except Exception:
+                logger.exception("Could not read the outbox")
+                messages = []
+
+            for message in messages:
+                await self._retry(message)
+
+            # Poll again right away while there is a backlog
+            if len(messages) < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _retry(self, message):
+        texts = message['texts']
+        if message['kind'] == 'reply':
+            error = await self._attempt(lambda: self.line_bot_api.reply_message(
+                ReplyMessageRequest(reply_token=message['token'], messages=self._to_messages(texts))))
+            if is_invalid_reply_token(error):
+                self.fallback_pushes += 1
+                message['kind'], message['token'] = 'push', str(uuid.uuid4())
+
+        if message['kind'] == 'push':
+            error = await self._attempt(lambda: self._push(message['userid'], texts, message['token']))
+
+        if error is None:
+            await self.store.delete_outbound_message(message['id'])
+            self.delivery_latency.observe(time.time() - message['created_at'])
+            self.delivered += 1
+            return
+
+        attempts = message['attempts'] + 1
+        if attempts >= self.max_attempts or not is_retryable(error):
+            await self.store.delete_outbound_message(message['id'])
+            self._drop(message['userid'], error)
+            return
+
+        await self.store.reschedule_outbound_message(
+            message['id'], message['kind'], message['token'], attempts, time.time() + self._retry_delay(attempts))
+
+    def get_stats(self):
+        # The outbox size needs a DB query, the stats of the asyncio app stay in memory
+        stats = self._counters()
+        stats['send_latency'] = self.send_latency.get_stats()
+        stats['delivery_latency'] = self.delivery_latency.get_stats()
+        return stats
@@ -0,0 +1,111 @@
+import heapq
+import logging
+import threading
+import time
+
+from metrics_module.histogram import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+class IdleExpiryScheduler:
+    """Take users out of AI mode once they have been idle for idle_timeout seconds.
+
+    Every AI-mode user has a deadline (last AI msg time + idle_timeout) kept in a min-heap, so the thread only
+    wakes up when a user is actually expiring. A user's deadline is moved by pushing a new heap entry;
+    entries that no longer match the user's current deadline are skipped when they are popped.
+    When a deadline passes, expire_idle_users(cutoff) expires every user idle since cutoff at once, including
+    the users touched by other gunicorn workers, which are also swept every resync_interval seconds."""
+
+    def __init__(self, expire_idle_users, idle_timeout=300, resync_interval=60):
+        self.expire_idle_users = expire_idle_users
+        self.idle_timeout = idle_timeout
+        self.resync_interval = resync_interval
+
+        # Heap of (deadline, user_id), and the current deadline of every scheduled user
+        self.heap = []
+        self.deadlines = {}
+        self.condition = threading.Condition()
+
+        self.sweep_latency = LatencyHistogram()
+        self.expired = 0
+        self.sweeps = 0
+
+    def touch(self, user_id, last_msg_time):
+        """(Re)schedule the expiry of a user after an AI message at last_msg_time (epoch seconds)."""
+
+        deadline = last_msg_time + self.idle_timeout
+        with self.condition:
+            self.deadlines[user_id] = deadline
+            heapq.heappush(self.heap, (deadline, user_id))
+
+            # Wake the thread up if this is now the first deadline
+            if self.heap[0][1] == user_id:
+                self.condition.notify()
+
+    def discard(self, user_id):
+        """Forget a user, e.g. because it already left AI mode. Its heap entries become stale."""
+
+        with self.condition:
+            self.deadlines.pop(user_id, None)
+
+    def _pop_due_users(self, now):
+        """Pop the users whose deadline has passed, skipping the stale heap entries."""
+
+        due_users = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, user_id = heapq.heappop(self.heap)
+            if self.deadlines.get(user_id) == deadline:
+                del self.deadlines[user_id]
+                due_users.append(user_id)
+        return due_users
+
+    def run(self, exit_event):
+        """Expire the idle users until exit_event is set."""
+
+        # Sweep right away to catch the users that went idle while the app was down
+        next_resync = time.monotonic()
+
+        while not exit_event.is_set():
+            with self.condition:
+                due_users = self._pop_due_users(time.time())
+
+            if due_users or time.monotonic() >= next_resync:
+                self._sweep()
+                next_resync = time.monotonic() + self.resync_interval
+
+            with self.condition:
+                # Sleep until the next deadline or resync, at most 1 sec so exit_event is noticed
+                timeout = min(next_resync - time.monotonic(), 1.0)
+                if self.heap:
+                    timeout = min(timeout, self.heap[0][0] - time.time())
+                if timeout > 0:
+                    self.condition.wait(timeout)
+
+    def _sweep(self):
+        """Expire every user idle since the cutoff in one go."""
+
+        cutoff = time.time() - self.idle_timeout
+        try:
+            with self.sweep_latency.time():
+                expired_user_ids = self.expire_idle_users(cutoff)
+        except Exception:
+            logger.exception("Could not expire the idle users")
+            return
+
+        with self.condition:
+            for user_id in expired_user_ids:
+                self.deadlines.pop(user_id, None)
+            self.expired += len(expired_user_ids)
+            self.sweeps += 1
+
+    def get_stats(self):
+        with self.condition:
+            stats = {
+                'scheduled_users': len(self.deadlines),
+                'heap_size': len(self.heap),
+                'next_deadline_in_seconds': self.heap[0][0] - time.time() if self.heap else None,
+                'expired': self.expired,
+                'sweeps': self.sweeps,
+            }
+        stats['sweep_latency'] = self.sweep_latency.get_stats()
+        return stats
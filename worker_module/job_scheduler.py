@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+
+from metrics_module.histogram import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+# Job durations, from 10 ms to 10 min
+JOB_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0)
+
+class LocalJobStore:
+    """Last run times kept in memory, for a single process without a shared store.
+    Nothing is known of the runs before the process started, so the runs due before it are not caught up
+    (a restart in the afternoon must not reset the quotas again)."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.last_runs = {}
+        self.lock = threading.Lock()
+
+    def claim_job_run(self, name, due_at):
+        with self.lock:
+            if self.last_runs.get(name, self.started_at) >= due_at:
+                return False
+            self.last_runs[name] = due_at
+            return True
+
+class Job:
+    """A job due every interval seconds."""
+
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+
+        self.duration = LatencyHistogram(JOB_BUCKETS)
+        self.runs = 0
+        self.failures = 0
+        self.last_due_at = None
+        self.last_run_at = None
+
+    def latest_due_at(self, now):
+        """Return the latest time (epoch seconds) at or before now at which the job was due."""
+
+        return now - now % self.interval
+
+class JobScheduler:
+    """Run periodic jobs from one thread, each job being registered once by name.
+
+    On every tick a job whose latest due time has not been run yet is claimed in the store
+    (claim_job_run(name, due_at) records the due time and returns False if it is already recorded).
+    With the PostgreSQLHandler as store the claim is one conditional upsert, so only one gunicorn worker
+    runs each due run, without any worker keeping a lock connection; and a run missed while the app was down
+    is run on the first tick after the restart (once, however many runs were missed). A job new to the store
+    is only recorded by its first claim, like LocalJobStore it first runs at its next due time."""
+
+    def __init__(self, store=None, tick_interval=30):
+        self.store = store or LocalJobStore()
+        self.tick_interval = tick_interval
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def add_interval(self, name, func, seconds):
+        """Run func every seconds seconds."""
+
+        self._add(Job(name, func, interval=seconds))
+
+    def _add(self, job):
+        with self.lock:
+            if job.name in self.jobs:
+                raise ValueError(f"Job {job.name} is already registered")
+            self.jobs[job.name] = job
+
+    def run(self, exit_event):
+        """Run the due jobs until exit_event is set."""
+
+        while not exit_event.is_set():
+            self.run_pending()
+            exit_event.wait(self.tick_interval)
+
+    def run_pending(self):
+        now = time.time()
+        with self.lock:
+            jobs = list(self.jobs.values())
+
+        for job in jobs:
+            due_at = job.latest_due_at(now)
+            # Already run by this process, no need to ask the store
+            if job.last_due_at is not None and job.last_due_at >= due_at:
+                continue
+
+            try:
+                claimed = self.store.claim_job_run(job.name, due_at)
+            except Exception:
+                logger.exception("Could not claim job %s", job.name)
+                continue
+            job.last_due_at = due_at
+            if claimed:
+                self._run_job(job)
+
+    def _run_job(self, job):
+        start = time.perf_counter()
+        try:
+            job.func()
+            failed = False
+        except Exception:
+            logger.exception("Job %s failed", job.name)
+            failed = True
+        elapsed = time.perf_counter() - start
+
+        job.duration.observe(elapsed)
+        with self.lock:
+            job.runs += 1
+            job.failures += failed
+            job.last_run_at = time.time()
+        logger.info("Job %s ran in %.3fs", job.name, elapsed)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                name: {
+                    'runs': job.runs,
+                    'failures': job.failures,
+                    'last_run_at': job.last_run_at,
+                    'duration': job.duration.get_stats(),
+                } for name, job in self.jobs.items()
+            }
@@ -0,0 +1,199 @@
+import logging
+import random
+import threading
+import time
+import uuid
+
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+
+from metrics_module.histogram import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+# LINE errors worth retrying, every other error status fails right away
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def is_invalid_reply_token(error):
+    """Tell if a LINE error means the reply token expired or was already used."""
+
+    return isinstance(error, LineBotApiError) and error.status_code == 400 and 'reply token' in str(error).lower()
+
+def is_retryable(error):
+    """Timeouts, connection errors and 429/5xx are retried, the other LINE errors are not."""
+
+    return not isinstance(error, LineBotApiError) or error.status_code in RETRY_STATUS_CODES
+
+class OutboundQueue:
+    """Deliver the reply and push messages, and keep the ones LINE did not accept in a durable outbox.
+
+    A message is sent right away. If that fails it is stored in the outbox table (the store is the
+    PostgreSQLHandler) and the dispatcher thread retries it with jittered exponential backoff until
+    max_attempts. A reply whose token has expired is sent as a push message instead. Every push carries a
+    retry key, so LINE ignores a retried push it already accepted.
+    The dispatcher claims due messages with FOR UPDATE SKIP LOCKED, so several gunicorn workers can share
+    the outbox without sending a message twice."""
+
+    def __init__(self, line_bot_api, store, max_attempts=8, backoff=2.0, max_backoff=300,
+                 poll_interval=1.0, batch_size=50):
+        self.line_bot_api = line_bot_api
+        self.store = store
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+
+        # Latency of every LINE call, and how long the outbox messages waited until they were delivered
+        self.send_latency = LatencyHistogram()
+        self.delivery_latency = LatencyHistogram(buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+
+        self.stats_lock = threading.Lock()
+        self.attempts = 0
+        self.failed_attempts = 0
+        self.delivered = 0
+        self.queued = 0
+        self.fallback_pushes = 0
+        self.dropped = 0
+
+    def reply(self, user_id, reply_token, texts):
+        """Reply to a user's message, or queue the texts if LINE does not accept them now."""
+
+        error = self._attempt(lambda: self.line_bot_api.reply_message(reply_token, self._to_messages(texts)))
+        if error is None:
+            return
+
+        if is_invalid_reply_token(error):
+            # The user waited too long for the answer, it can still be pushed
+            with self.stats_lock:
+                self.fallback_pushes += 1
+            self.push(user_id, texts)
+        elif is_retryable(error):
+            self._enqueue('reply', user_id, reply_token, texts)
+        else:
+            self._drop(user_id, error)
+
+    def push(self, user_id, texts):
+        """Push texts to a user, or queue them if LINE does not accept them now."""
+
+        retry_key = str(uuid.uuid4())
+        error = self._attempt(lambda: self.line_bot_api.push_message(user_id, self._to_messages(texts), retry_key=retry_key))
+        if error is None:
+            return
+
+        if is_retryable(error):
+            self._enqueue('push', user_id, retry_key, texts)
+        else:
+            self._drop(user_id, error)
+
+    def queue_pushes(self, user_ids, texts):
+        """Queue push messages whose first attempt failed elsewhere (e.g. in a multicast batch)."""
+
+        for user_id in user_ids:
+            self._enqueue('push', user_id, str(uuid.uuid4()), texts)
+
+    @staticmethod
+    def _to_messages(texts):
+        return [TextSendMessage(text=text) for text in texts]
+
+    def _attempt(self, send):
+        """Run one send, return the error or None on success."""
+
+        try:
+            with self.send_latency.time():
+                send()
+            error = None
+        except LineBotApiError as e:
+            # A push retried with a retry key LINE already accepted
+            error = None if e.status_code == 409 and e.accepted_request_id else e
+        except Exception as e:
+            error = e
+
+        with self.stats_lock:
+            self.attempts += 1
+            if error is not None:
+                self.failed_attempts += 1
+        if error is not None:
+            logger.warning("Could not send a LINE message: %s", error)
+        return error
+
+    def _enqueue(self, kind, user_id, token, texts):
+        """Store a message for the dispatcher. token is the reply token of a reply, the retry key of a push."""
+
+        self.store.enqueue_outbound_message(kind, user_id, token, texts, time.time() + self._retry_delay(1))
+        with self.stats_lock:
+            self.queued += 1
+
+    def _drop(self, user_id, error):
+        logger.error("Dropping a LINE message to %s: %s", user_id, error)
+        with self.stats_lock:
+            self.dropped += 1
+
+    def _retry_delay(self, attempts):
+        # Full jitter, so the messages that failed together are not retried together
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempts - 1)))
+
+    def run(self, exit_event):
+        """Retry the due outbox messages until exit_event is set."""
+
+        while not exit_event.is_set():
+            try:
+                messages = self.store.claim_outbound_messages(self.batch_size, time.time())
+            except Exception:
+                logger.exception("Could not read the outbox")
+                messages = []
+
+            for message in messages:
+                self._retry(message)
+
+            # Poll again right away while there is a backlog
+            if len(messages) < self.batch_size:
+                exit_event.wait(self.poll_interval)
+
+    def _retry(self, message):
+        texts = message['texts']
+        if message['kind'] == 'reply':
+            error = self._attempt(lambda: self.line_bot_api.reply_message(message['token'], self._to_messages(texts)))
+            if is_invalid_reply_token(error):
+                with self.stats_lock:
+                    self.fallback_pushes += 1
+                message['kind'], message['token'] = 'push', str(uuid.uuid4())
+
+        if message['kind'] == 'push':
+            error = self._attempt(lambda: self.line_bot_api.push_message(
+                message['userid'], self._to_messages(texts), retry_key=message['token']))
+
+        if error is None:
+            self.store.delete_outbound_message(message['id'])
+            self.delivery_latency.observe(time.time() - message['created_at'])
+            with self.stats_lock:
+                self.delivered += 1
+            return
+
+        attempts = message['attempts'] + 1
+        if attempts >= self.max_attempts or not is_retryable(error):
+            self.store.delete_outbound_message(message['id'])
+            self._drop(message['userid'], error)
+            return
+
+        self.store.reschedule_outbound_message(
+            message['id'], message['kind'], message['token'], attempts, time.time() + self._retry_delay(attempts))
+
+    def _counters(self):
+        with self.stats_lock:
+            return {
+                'attempts': self.attempts,
+                'failed_attempts': self.failed_attempts,
+                'failure_rate': self.failed_attempts / self.attempts if self.attempts else 0.0,
+                'queued': self.queued,
+                'delivered_from_outbox': self.delivered,
+                'fallback_pushes': self.fallback_pushes,
+                'dropped': self.dropped,
+            }
+
+    def get_stats(self):
+        stats = self._counters()
+        stats['pending'] = self.store.count_outbound_messages()
+        stats['send_latency'] = self.send_latency.get_stats()
+        stats['delivery_latency'] = self.delivery_latency.get_stats()
+        return stats
@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics_module.histogram import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+# LINE accepts up to 500 recipients per multicast request
+MAX_MULTICAST_RECIPIENTS = 500
+
+class PushSender:
+    """Send the same messages to many users.
+    The users are split into LINE multicast batches of up to max_batch_size recipients (a single user gets a plain
+    push), the batches are sent concurrently by a small thread pool, and requests are spaced out to stay under
+    max_requests_per_second."""
+
+    def __init__(self, line_bot_api, max_batch_size=MAX_MULTICAST_RECIPIENTS, max_concurrency=4, max_requests_per_second=10):
+        self.line_bot_api = line_bot_api
+        self.max_batch_size = min(max_batch_size, MAX_MULTICAST_RECIPIENTS)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='push-sender')
+
+        # Requests are given start times at least min_interval apart
+        self.min_interval = 1.0 / max_requests_per_second
+        self.next_request_at = 0.0
+        self.rate_lock = threading.Lock()
+
+        self.batch_latency = LatencyHistogram()
+        self.stats_lock = threading.Lock()
+        self.batches = 0
+        self.recipients = 0
+        self.failed_batches = 0
+        self.failed_recipients = 0
+
+    def send(self, user_ids, messages):
+        """Send the messages to every user and wait until all the batches are done.
+        Return the user ids whose batch failed."""
+
+        batches = [user_ids[i:i + self.max_batch_size] for i in range(0, len(user_ids), self.max_batch_size)]
+        failed_user_ids = []
+        for batch, succeeded in zip(batches, self.executor.map(lambda batch: self._send_batch(batch, messages), batches)):
+            if not succeeded:
+                failed_user_ids.extend(batch)
+        return failed_user_ids
+
+    def _wait_for_rate_limit(self):
+        with self.rate_lock:
+            now = time.monotonic()
+            start_at = max(now, self.next_request_at)
+            self.next_request_at = start_at + self.min_interval
+        if start_at > now:
+            time.sleep(start_at - now)
+
+    def _send_batch(self, user_ids, messages):
+        self._wait_for_rate_limit()
+
+        start = time.perf_counter()
+        try:
+            if len(user_ids) == 1:
+                self.line_bot_api.push_message(user_ids[0], messages=messages)
+            else:
+                self.line_bot_api.multicast(user_ids, messages=messages)
+            succeeded = True
+        except Exception:
+            logger.exception("Could not send a batch of %d push messages", len(user_ids))
+            succeeded = False
+        self.batch_latency.observe(time.perf_counter() - start)
+
+        with self.stats_lock:
+            self.batches += 1
+            self.recipients += len(user_ids)
+            if not succeeded:
+                self.failed_batches += 1
+                self.failed_recipients += len(user_ids)
+        return succeeded
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = {
+                'batches': self.batches,
+                'recipients': self.recipients,
+                'failed_batches': self.failed_batches,
+                'failed_recipients': self.failed_recipients,
+            }
+        stats['batch_latency'] = self.batch_latency.get_stats()
+        return stats
+
+    def close(self):
+        self.executor.shutdown(wait=True)
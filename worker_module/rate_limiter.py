@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from metrics_module.histogram import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+# Key of the bucket shared by every user
+GLOBAL_KEY = '*'
+
+def parse_tiers(spec):
+    """Parse tiers written as 'name:rate:burst,...' (rate in requests per second), e.g. 'default:0.2:5,vip:1:20'."""
+
+    tiers = {}
+    for item in spec.split(','):
+        if item.strip():
+            name, rate, burst = item.strip().split(':')
+            tiers[name] = (float(rate), float(burst))
+    return tiers
+
+class TokenBucket:
+    """Up to burst tokens, refilled at rate tokens per second. unsynced counts the tokens taken since the
+    last sync with the shared store."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at', 'unsynced')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+        self.unsynced = 0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+class RateLimiter:
+    """Token-bucket rate limits per user, by tier, and one global limit over every user.
+
+    allow() only touches in-memory buckets under one lock, so a decision takes microseconds and never waits
+    for the DB. A user's token is given back when the global bucket is empty, so a global rejection does not
+    use up the user's own limit. The least recently used buckets are dropped past max_buckets; a bucket unused
+    for that long is full again anyway.
+
+    With a shared_store (PostgreSQLHandler), run() syncs the buckets every sync_interval seconds: the tokens
+    taken by this process are subtracted from the shared buckets in one statement, and the local buckets are
+    set to the shared levels. So the gunicorn workers share the limits, going over them by at most what each
+    worker allows in one sync interval."""
+
+    def __init__(self, tiers, default_tier='default', global_rate=20.0, global_burst=40.0,
+                 shared_store=None, sync_interval=1.0, max_buckets=100000):
+        self.tiers = tiers
+        self.default_tier = default_tier
+        self.user_tiers = {}
+        self.shared_store = shared_store
+        self.sync_interval = sync_interval
+        self.max_buckets = max_buckets
+
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.global_bucket = TokenBucket(global_rate, global_burst, time.monotonic())
+
+        self.allowed = 0
+        self.rejected_user = 0
+        self.rejected_global = 0
+        self.sync_latency = LatencyHistogram()
+        self.sync_failures = 0
+
+    def set_tier(self, user_id, tier):
+        """Put a user in a tier, its bucket gets the tier's limits on its next request."""
+
+        if tier not in self.tiers:
+            raise ValueError(f"Unknown rate limit tier {tier}")
+        with self.lock:
+            self.user_tiers[user_id] = tier
+            self.buckets.pop(user_id, None)
+
+    def tier_of(self, user_id):
+        return self.user_tiers.get(user_id, self.default_tier)
+
+    def allow(self, user_id):
+        """Take a token of the user and a global one, return False if either bucket is empty."""
+
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                rate, burst = self.tiers[self.tier_of(user_id)]
+                bucket = self.buckets[user_id] = TokenBucket(rate, burst, now)
+                if len(self.buckets) > self.max_buckets:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(user_id)
+
+            bucket.refill(now)
+            if bucket.tokens < 1:
+                self.rejected_user += 1
+                return False
+
+            self.global_bucket.refill(now)
+            if self.global_bucket.tokens < 1:
+                self.rejected_global += 1
+                return False
+
+            bucket.tokens -= 1
+            bucket.unsynced += 1
+            self.global_bucket.tokens -= 1
+            self.global_bucket.unsynced += 1
+            self.allowed += 1
+            return True
+
+    def refund(self, user_id):
+        """Give back the tokens taken by allow() for a message that turned out not to be an AI question."""
+
+        with self.lock:
+            self.allowed -= 1
+            buckets = [self.global_bucket]
+            if user_id in self.buckets:
+                buckets.append(self.buckets[user_id])
+            for bucket in buckets:
+                bucket.tokens = min(bucket.burst, bucket.tokens + 1)
+                # A token already synced stays taken in the shared bucket
+                if bucket.unsynced:
+                    bucket.unsynced -= 1
+
+    def run(self, exit_event):
+        """Sync the buckets with the shared store until exit_event is set."""
+
+        while not exit_event.wait(self.sync_interval):
+            try:
+                self.sync()
+            except Exception:
+                self.sync_failures += 1
+                logger.exception("Could not sync the rate limit buckets")
+
+    def sync(self):
+        """Subtract the tokens taken since the last sync from the shared buckets, and take their levels."""
+
+        # Only the buckets this process took tokens from, the others are refilled by the shared store's time
+        with self.lock:
+            buckets = {key: bucket for key, bucket in self.buckets.items() if bucket.unsynced}
+            if self.global_bucket.unsynced:
+                buckets[GLOBAL_KEY] = self.global_bucket
+            taken = {key: bucket.unsynced for key, bucket in buckets.items()}
+            for bucket in buckets.values():
+                bucket.unsynced = 0
+        if not taken:
+            return
+
+        start = time.perf_counter()
+        try:
+            levels = self.shared_store.sync_rate_limit_buckets(
+                [(key, taken[key], bucket.rate, bucket.burst) for key, bucket in sorted(buckets.items())],
+                time.time()
+            )
+        except Exception:
+            # The tokens are subtracted on the next sync
+            with self.lock:
+                for key, bucket in buckets.items():
+                    bucket.unsynced += taken[key]
+            raise
+        finally:
+            self.sync_latency.observe(time.perf_counter() - start)
+
+        now = time.monotonic()
+        with self.lock:
+            for key, tokens in levels.items():
+                bucket = buckets[key]
+                # Keep what was taken here while the sync was running
+                bucket.tokens = max(0.0, tokens - bucket.unsynced)
+                bucket.updated_at = now
+
+    def get_stats(self):
+        with self.lock:
+            decisions = self.allowed + self.rejected_user + self.rejected_global
+            stats = {
+                'tiers': {name: {'rate': rate, 'burst': burst} for name, (rate, burst) in self.tiers.items()},
+                'buckets': len(self.buckets),
+                'allowed': self.allowed,
+                'rejected_user': self.rejected_user,
+                'rejected_global': self.rejected_global,
+                'reject_rate': (self.rejected_user + self.rejected_global) / decisions if decisions else 0.0,
+                'global_tokens': self.global_bucket.tokens,
+                'sync_failures': self.sync_failures,
+            }
+        stats['sync_latency'] = self.sync_latency.get_stats()
+        return stats
@@ -0,0 +1,107 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class ReplyWorkerPool:
+    """A bounded in-process work queue drained by a fixed pool of worker threads.
+    The webhook puts jobs on the queue and returns right away, the workers run them in the background.
+    Every worker owns its own queue and jobs are routed by key (the userId), so the jobs of one user
+    run in order on one worker while different users are handled concurrently."""
+
+    def __init__(self, num_workers=4, max_queue_size=1000):
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+
+        # Split the capacity between the per-worker queues
+        shard_size = max(1, -(-max_queue_size // num_workers))
+        self.job_queues = [queue.Queue(maxsize=shard_size) for _ in range(num_workers)]
+        self.threads = []
+
+        # Counters for the metrics, guarded by stats_lock
+        self.stats_lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def start(self):
+        """Start the worker threads."""
+
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._run, args=(self.job_queues[i],), name=f"reply-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, func, *args):
+        """Put a job on the queue of the worker that owns the key, without blocking.
+        Return False if that queue is full so the caller can tell LINE to redeliver later."""
+
+        job_queue = self.job_queues[hash(key) % self.num_workers]
+        try:
+            job_queue.put_nowait((time.monotonic(), func, args))
+        except queue.Full:
+            with self.stats_lock:
+                self.rejected += 1
+            return False
+
+        with self.stats_lock:
+            self.submitted += 1
+        return True
+
+    def _run(self, job_queue):
+        """Take jobs from the worker's queue and run them until a stop sentinel (None) is received."""
+
+        while True:
+            job = job_queue.get()
+            if job is None:
+                job_queue.task_done()
+                break
+
+            enqueued_at, func, args = job
+            wait_time = time.monotonic() - enqueued_at
+            try:
+                func(*args)
+                failed = False
+            except Exception:
+                logger.exception("Reply job %s failed", getattr(func, '__name__', func))
+                failed = True
+            finally:
+                job_queue.task_done()
+
+            with self.stats_lock:
+                self.processed += 1
+                self.failed += failed
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def stop(self, timeout=None):
+        """Let the workers finish the queued jobs and then exit."""
+
+        for job_queue in self.job_queues:
+            job_queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def get_stats(self):
+        """Return a snapshot of queue depth and wait-time metrics."""
+
+        with self.stats_lock:
+            avg_wait_time = self.total_wait_time / self.processed if self.processed else 0.0
+            return {
+                'workers': self.num_workers,
+                'queue_depth': sum(job_queue.qsize() for job_queue in self.job_queues),
+                'max_shard_depth': max(job_queue.qsize() for job_queue in self.job_queues),
+                'queue_capacity': sum(job_queue.maxsize for job_queue in self.job_queues),
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'processed': self.processed,
+                'failed': self.failed,
+                'avg_wait_seconds': avg_wait_time,
+                'max_wait_seconds': self.max_wait_time,
+            }